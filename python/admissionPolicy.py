@@ -0,0 +1,172 @@
+"""
+Decides whether a newly playing track, or the idle image, is worth a panel
+refresh.
+
+A 7-colour refresh takes around 30 seconds. Starting one for a 20 second
+interlude, or for every track the listener is skipping through, keeps the
+panel busy with frames nobody gets to see. Each new track gets one of
+three decisions:
+
+    show   refresh now
+    wait   poll again; the track is shown once it has played long enough
+    skip   not worth it, the previous frame stays up
+
+A track is skipped when less than the refresh time plus 'admission_min_dwell'
+seconds of it is left (from progress_ms and duration_ms), so it would not
+stay on screen for long. After a skip (a track that changed within
+'admission_skip_s' seconds without reaching its end) the next track has to
+play for 'admission_settle_s' seconds first, multiplied by the number of
+skips in the last 'admission_skip_window' seconds, so rapid skipping settles
+before the panel follows.
+
+The refresh time is the median of the measured 'display' stage once there
+is one, until then 'admission_refresh_s' or the refresh time the display
+backend declares.
+
+Between tracks or during a device handoff the API briefly reports that
+nothing is playing. The idle image is only admitted after
+'idle_grace_polls' empty polls in a row that span at least 'idle_grace_s'
+seconds, so such a gap does not cost a refresh to idle and one back.
+
+Every decision is logged and counted (admission_show, admission_wait,
+admission_skip), once per track; admitted idle periods as admission_idle
+and gaps that ended before that as idle_gaps.
+
+Settings (in the [DEFAULT] section of eink_options.ini):
+    admission = True
+    admission_refresh_s =      ; default: declared by the display backend
+    admission_min_dwell = 20
+    admission_settle_s = 5
+    admission_skip_s = 30
+    admission_skip_window = 120
+    idle_grace_polls = 2       ; 1 and idle_grace_s = 0 show idle right away
+    idle_grace_s = 5
+"""
+import logging
+import time
+from collections import deque
+
+from displayBackends import capabilities
+
+logger = logging.getLogger('spotipy_logger')
+
+# A track that changes this close to its end ran out rather than being skipped
+_END_TOLERANCE_S = 10.0
+
+
+class AdmissionPolicy:
+    def __init__(self, refresh_s: float = 30.0, min_dwell: float = 20.0, settle_s: float = 5.0,
+                 skip_s: float = 30.0, skip_window: float = 120.0, idle_grace_polls: int = 2,
+                 idle_grace_s: float = 5.0, metrics=None, enabled: bool = True):
+        self.refresh_s = refresh_s
+        self.min_dwell = min_dwell
+        self.settle_s = settle_s
+        self.skip_s = skip_s
+        self.skip_window = skip_window
+        self.idle_grace_polls = idle_grace_polls
+        self.idle_grace_s = idle_grace_s
+        self.metrics = metrics
+        self.enabled = enabled
+        self._skips = deque(maxlen=32)
+        self._key = None
+        self._since = None
+        self._seen_at = None
+        self._remaining = None
+        self._decision = None
+        self._empty_polls = 0
+        self._empty_since = None
+        self._idle_admitted = False
+
+    @classmethod
+    def from_settings(cls, settings, metrics=None) -> 'AdmissionPolicy':
+        """From a config section: [DEFAULT], or an [account:<name>] of multiAccountHost.py."""
+        refresh_s = capabilities(settings).refresh_s
+        return cls(refresh_s=settings.getfloat('admission_refresh_s', fallback=refresh_s),
+                   min_dwell=settings.getfloat('admission_min_dwell', fallback=20.0),
+                   settle_s=settings.getfloat('admission_settle_s', fallback=5.0),
+                   skip_s=settings.getfloat('admission_skip_s', fallback=30.0),
+                   skip_window=settings.getfloat('admission_skip_window', fallback=120.0),
+                   idle_grace_polls=settings.getint('idle_grace_polls', fallback=2),
+                   idle_grace_s=settings.getfloat('idle_grace_s', fallback=5.0),
+                   metrics=metrics,
+                   enabled=settings.getboolean('admission', fallback=True))
+
+    def refresh_estimate(self) -> float:
+        """Median measured panel refresh, or the configured refresh time before the first one."""
+        median = self.metrics.quantile('display', 0.5) if self.metrics is not None else None
+        return self.refresh_s if median is None else median
+
+    def recent_skips(self, now: float = None) -> int:
+        now = time.monotonic() if now is None else now
+        return sum(1 for at in self._skips if now - at <= self.skip_window)
+
+    def _track_changed(self, key: str, now: float):
+        # A track that was last seen long ago was stopped, not skipped
+        if self._key is not None and now - self._seen_at <= self.skip_window:
+            played = now - self._since
+            # Whatever the previous track had left when it was last seen, minus the time since
+            left = None if self._remaining is None else self._remaining - (now - self._seen_at)
+            if played < self.skip_s and (left is None or left > _END_TOLERANCE_S):
+                self._skips.append(now)
+        self._key = key
+        self._since = now
+        self._decision = None
+
+    def decide(self, key: str, progress_ms: int = None, duration_ms: int = None, label: str = None,
+               now: float = None) -> str:
+        """
+        Returns 'show', 'wait' or 'skip' for the track 'key' that is playing
+        now; called on every poll until the track is shown. 'label' names
+        the track in the log.
+        """
+        now = time.monotonic() if now is None else now
+        if key != self._key:
+            self._track_changed(key, now)
+        self._seen_at = now
+        playing = progress_ms / 1000 if progress_ms is not None else now - self._since
+        self._remaining = (duration_ms - progress_ms) / 1000 if None not in (progress_ms, duration_ms) else None
+        if not self.enabled:
+            return 'show'
+
+        refresh_s = self.refresh_estimate()
+        skips = self.recent_skips(now)
+        settle = self.settle_s * skips
+        if self._remaining is not None and self._remaining < refresh_s + self.min_dwell:
+            decision, reason = 'skip', (f'{self._remaining:.0f}s left, less than the {refresh_s:.0f}s refresh '
+                                        f'plus {self.min_dwell:.0f}s on screen')
+        elif skips and playing < settle:
+            decision, reason = 'wait', f'{skips} recent skips, waiting until it has played {settle:.0f}s'
+        else:
+            decision, reason = 'show', f'{skips} recent skips' if skips else None
+        if decision != self._decision:
+            self._decision = decision
+            if self.metrics is not None:
+                self.metrics.inc(f'admission_{decision}')
+            if decision != 'show' or reason:
+                logger.info(f'Admission: {decision} {label or key}' + (f' ({reason})' if reason else ''))
+        return decision
+
+    def admit_idle(self, now: float = None) -> bool:
+        """Called on every poll that found nothing playing: whether the idle image may be shown."""
+        now = time.monotonic() if now is None else now
+        if self._empty_polls == 0:
+            self._empty_since = now
+        self._empty_polls += 1
+        if self._idle_admitted:
+            return True
+        if self._empty_polls < self.idle_grace_polls or now - self._empty_since < self.idle_grace_s:
+            return False
+        self._idle_admitted = True
+        if self.metrics is not None:
+            self.metrics.inc('admission_idle')
+        return True
+
+    def playing(self, now: float = None):
+        """Called on every poll that found something playing; ends a gap."""
+        if self._empty_polls and not self._idle_admitted:
+            now = time.monotonic() if now is None else now
+            if self.metrics is not None:
+                self.metrics.inc('idle_gaps')
+            logger.info(f'Playback resumed after a {now - self._empty_since:.0f}s gap, idle image not shown')
+        self._empty_polls = 0
+        self._idle_admitted = False
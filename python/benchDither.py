@@ -0,0 +1,58 @@
+"""
+Render time and error of every dithering mode in dither.py.
+
+Each mode quantizes the same frame to the 7-colour palette. The error is the
+mean CIELAB distance (delta E) between the source and the dithered frame
+after both are blurred, which approximates how the dots mix at viewing
+distance: lower is closer to the original.
+
+Usage:
+    python benchDither.py [image ...] [--frames 5] [--size 640x400] [--out DIR]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter
+
+import dither
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def _perceived_error(source: Image, dithered: Image, radius: float = 1.5) -> float:
+    a = dither.rgb_to_lab(np.asarray(source.filter(ImageFilter.GaussianBlur(radius))))
+    b = dither.rgb_to_lab(np.asarray(dithered.convert('RGB').filter(ImageFilter.GaussianBlur(radius))))
+    return float(np.sqrt(((a - b) ** 2).sum(axis=-1)).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the dithering modes for the 7-colour panels')
+    parser.add_argument('images', nargs='*', default=[os.path.join(BASE_DIR, 'resources', 'default.jpg')])
+    parser.add_argument('--frames', type=int, default=5)
+    parser.add_argument('--size', default='640x400')
+    parser.add_argument('--out', help='write the dithered frames to this directory')
+    args = parser.parse_args()
+    size = tuple(int(v) for v in args.size.split('x'))
+
+    print(f'{"image":<20}{"mode":<17}{"ms/frame":>10}{"delta E":>9}')
+    for path in args.images:
+        # Same saturation boost as PanelRenderer.quantize for Waveshare panels
+        source = ImageEnhance.Color(Image.open(path).convert('RGB').resize(size)).enhance(2)
+        name = os.path.splitext(os.path.basename(path))[0]
+        for mode in dither.MODES:
+            dither.dither(source, mode=mode)  # builds the lookup tables outside the timing
+            start = time.perf_counter()
+            for _ in range(args.frames):
+                indices = dither.dither(source, mode=mode)
+            elapsed = (time.perf_counter() - start) / args.frames
+            frame = dither.to_image(indices)
+            print(f'{name[:19]:<20}{mode:<17}{elapsed * 1000:>10.1f}{_perceived_error(source, frame):>9.2f}')
+            if args.out:
+                os.makedirs(args.out, exist_ok=True)
+                frame.convert('RGB').save(os.path.join(args.out, f'{name}-{mode}.png'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Displays-per-core benchmark for multiAccountHost.py against the local mock API.
+
+Starts mockSpotify.py in a separate process (so its CPU time is not counted)
+with a trace of regular track changes staggered per account, runs a
+MultiAccountHost with N virtual displays for a while and reports the CPU the
+host used. Displays per core is the number of displays one fully busy core
+could serve at the measured per-display cost.
+
+Usage:
+    python benchHost.py [--accounts 1 10 50] [--duration 30] [--song-s 15] [--render-workers 1]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from metrics import registry as metrics
+from multiAccountHost import MultiAccountHost
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def _cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _write_trace(workdir: str, duration: float, song_s: float) -> str:
+    events = [{'at': i * song_s, 'type': 'track', 'id': f't{i}', 'title': f'Track {i}', 'artist': 'Band'}
+              for i in range(int(duration * 2 / song_s) + 2)]
+    path = os.path.join(workdir, 'trace.json')
+    with open(path, 'w') as f:
+        json.dump({'name': 'bench', 'duration': duration * 2, 'events': events}, f)
+    return path
+
+
+def _write_config(workdir: str, api_prefix: str, accounts: int, render_workers: int) -> str:
+    config_file = os.path.join(workdir, f'eink_options_{accounts}.ini')
+    with open(config_file, 'w') as f:
+        f.write(f"""[DEFAULT]
+model = virtual
+virtual_output_dir = {os.path.join(workdir, 'frames')}
+display_async = false
+width = 640
+height = 400
+album_cover_small = False
+album_cover_small_px = 200
+display_refresh_counter = 1000
+idle_display_time = 300
+spotify_api_prefix = {api_prefix}
+spotipy_log =
+log_level = WARNING
+render_workers = {render_workers}
+no_song_cover = {os.path.join(BASE_DIR, 'resources', 'default.jpg')}
+font_path = {os.path.join(BASE_DIR, 'resources', 'CircularStd-Bold.otf')}
+font_size_title = 45
+font_size_artist = 35
+offset_px_left = 20
+offset_px_right = 20
+offset_px_top = 0
+offset_px_bottom = 20
+offset_text_px_shadow = 4
+text_direction = bottom-up
+background_mode = fit
+""")
+        for i in range(accounts):
+            token_file = os.path.join(workdir, f'.cache-{i}')
+            with open(token_file, 'w') as token:
+                json.dump({
+                    'access_token': f'bench-token-{i}',
+                    'token_type': 'Bearer',
+                    'expires_in': 3600,
+                    'expires_at': int(time.time()) + 24 * 3600,
+                    'refresh_token': f'bench-refresh-{i}',
+                    'scope': 'user-modify-playback-state user-read-currently-playing',
+                }, token)
+            f.write(f'\n[account:user{i}]\nusername = user{i}\ntoken_file = {token_file}\n')
+    return config_file
+
+
+def run(accounts: int, duration: float, song_s: float, render_workers: int, port: int) -> dict:
+    for key, value in (('SPOTIPY_CLIENT_ID', 'bench-client'),
+                       ('SPOTIPY_CLIENT_SECRET', 'bench-secret'),
+                       ('SPOTIPY_REDIRECT_URI', 'http://127.0.0.1:8888/callback/spotify')):
+        os.environ.setdefault(key, value)
+
+    with tempfile.TemporaryDirectory(prefix='spotipi-bench-') as workdir:
+        trace = _write_trace(workdir, duration, song_s)
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'mockSpotify.py'),
+                                   'serve', trace, '--port', str(port), '--stagger', str(song_s)],
+                                  stdout=subprocess.PIPE, text=True)
+        try:
+            server.stdout.readline()
+            config_file = _write_config(workdir, f'http://127.0.0.1:{port}/v1/', accounts, render_workers)
+            host = MultiAccountHost(config_file)
+            counters = dict(metrics.counters)
+            cpu_start, wall_start = _cpu_seconds(), time.monotonic()
+            host.start(duration)
+            cpu, wall = _cpu_seconds() - cpu_start, time.monotonic() - wall_start
+        finally:
+            server.terminate()
+            server.wait()
+
+    polls = metrics.counters.get('api_calls', 0) - counters.get('api_calls', 0)
+    frames = metrics.counters.get('refreshes', 0) - counters.get('refreshes', 0)
+    poll_hist = metrics.histograms.get('poll')
+    return {
+        'accounts': accounts,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'polls_per_s': polls / wall,
+        'frames': frames,
+        'poll_p99': poll_hist.quantiles().get(0.99) if poll_hist else None,
+        'cores_used': cpu / wall,
+        'displays_per_core': accounts / (cpu / wall) if cpu else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Displays-per-core benchmark of the multi-account host')
+    parser.add_argument('--accounts', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--song-s', type=float, default=15.0, help='seconds between track changes')
+    parser.add_argument('--render-workers', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8898)
+    args = parser.parse_args()
+
+    print(f'{"accounts":>8}{"polls/s":>9}{"frames":>8}{"poll p99":>10}{"cores":>7}{"displays/core":>15}')
+    for accounts in args.accounts:
+        r = run(accounts, args.duration, args.song_s, args.render_workers, args.port)
+        print(f'{r["accounts"]:>8}{r["polls_per_s"]:>9.1f}{r["frames"]:>8}'
+              f'{(r["poll_p99"] or 0) * 1000:>8.1f}ms{r["cores_used"]:>7.2f}{r["displays_per_core"]:>15.0f}')
+
+
+if __name__ == '__main__':
+    main()
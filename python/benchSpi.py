@@ -0,0 +1,127 @@
+"""
+SPI transfer throughput benchmark against a fake SPI device.
+
+Runs the epdconfig spi_writebyte2 paths with an in-memory spidev stand-in
+and a fake software-SPI library, so the Python-side cost of pushing one
+640x400 frame (128,000 bytes) can be compared without hardware:
+
+  - list:   the old getbuffer() list handed to writebytes2, converted per element
+  - bytes:  the bytearray from getbuffer(), sent as zero-copy memoryview chunks
+  - jetson: the software-SPI byte loop, old indexed form vs. the bound loop
+
+Usage:
+    python benchSpi.py [--frames 20] [--speed-hz 4000000]
+"""
+import argparse
+import os
+import sys
+import time
+import types
+
+FRAME_BYTES = 640 * 400 // 2
+
+
+class FakeSpiDev:
+    """Mimics spidev.SpiDev: lists are converted element by element, buffers are not."""
+
+    def __init__(self):
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.bytes_written = 0
+        self.transfers = 0
+        self.bufsiz = 4096
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def writebytes(self, data):
+        self.writebytes2(data)
+
+    def writebytes2(self, data):
+        if isinstance(data, list):
+            # spidev copies each int into its transmit buffer, bufsiz at a time
+            for start in range(0, len(data), self.bufsiz):
+                bytes(data[start:start + self.bufsiz])
+                self.transfers += 1
+        else:
+            view = memoryview(data)
+            for start in range(0, len(view), self.bufsiz):
+                view[start:start + self.bufsiz]
+                self.transfers += 1
+        self.bytes_written += len(data)
+
+    xfer3 = writebytes2
+
+
+class FakeSoftSpi:
+    """Stands in for sysfs_software_spi.so, one call per byte."""
+
+    def __init__(self):
+        self.calls = 0
+
+        def transfer(byte):
+            self.calls += 1
+        self.SYSFS_software_spi_transfer = transfer
+
+
+def _install_fakes():
+    gpio = types.ModuleType('RPi.GPIO')
+    for name in ('setmode', 'setwarnings', 'setup', 'output', 'cleanup'):
+        setattr(gpio, name, lambda *args, **kwargs: None)
+    gpio.input = lambda pin: 0
+    gpio.BCM, gpio.OUT, gpio.IN = 11, 0, 1
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = gpio
+    spidev = types.ModuleType('spidev')
+    spidev.SpiDev = FakeSpiDev
+    sys.modules.update({'RPi': rpi, 'RPi.GPIO': gpio, 'spidev': spidev})
+    os.environ['EPD_PLATFORM'] = 'raspberrypi'
+
+
+def _legacy_jetson_writebyte2(spi, data):
+    for i in range(len(data)):
+        spi.SYSFS_software_spi_transfer(data[i])
+
+
+def _run(label, frames, func, frame_bytes, speed_hz):
+    start = time.perf_counter()
+    for _ in range(frames):
+        func()
+    elapsed = (time.perf_counter() - start) / frames
+    wire = frame_bytes * 8 / speed_hz
+    print(f'{label:<22}{elapsed * 1000:>10.2f} ms/frame{frame_bytes / elapsed / 1e6:>10.1f} MB/s'
+          f'{wire * 1000:>12.1f} ms on the wire')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SPI transfer throughput against a fake device')
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--speed-hz', type=int, default=4000000)
+    args = parser.parse_args()
+
+    _install_fakes()
+    from lib import epdconfig
+
+    rpi = epdconfig.implementation
+    rpi.set_spi_speed_hz(args.speed_hz)
+    rpi.module_init()
+    print(f'spidev chunk size {rpi.chunk_size} bytes, SPI clock {rpi.SPI.max_speed_hz} Hz')
+
+    frame_list = [0x11] * FRAME_BYTES
+    frame_bytes = bytearray(b'\x11' * FRAME_BYTES)
+    _run('rpi list', args.frames, lambda: rpi.spi_writebyte2(frame_list), FRAME_BYTES, args.speed_hz)
+    _run('rpi bytes', args.frames, lambda: rpi.spi_writebyte2(frame_bytes), FRAME_BYTES, args.speed_hz)
+
+    jetson = epdconfig.JetsonNano.__new__(epdconfig.JetsonNano)
+    jetson.SPI = FakeSoftSpi()
+    _run('jetson indexed (old)', max(1, args.frames // 4),
+         lambda: _legacy_jetson_writebyte2(jetson.SPI, frame_list), FRAME_BYTES, args.speed_hz)
+    _run('jetson bytes', max(1, args.frames // 4),
+         lambda: jetson.spi_writebyte2(frame_bytes), FRAME_BYTES, args.speed_hz)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,19 @@ import sys
 import os
 import configparser
 import spotipy
-import spotipy.util as util
 import signal
 import RPi.GPIO as GPIO
 import time
+from quotaBudget import QuotaBudget
+from tokenStore import TokenStore
 
 # some global stuff.
 # initial status
 current_state = 'context'
-# initial Configuration file
-dir = os.path.dirname(__file__)
-config_file = os.path.join(dir, '..', 'config', 'eink_options.ini')
-# Configuration for the matrix
-config = configparser.ConfigParser()
-config.read(config_file)
+# Configuration, token cache and API request budget, set by setup()
+config = None
+token_store = None
+api_budget = None
 # Gpio pins for each button (from top to bottom)
 BUTTONS = [5, 6, 16, 24]
 # These correspond to buttons A, B, C and D respectively
@@ -24,6 +23,15 @@ LABELS = ['A', 'B', 'C', 'D']
 playlists = None
 current_playlist_index = 0
 
+def setup(config_parser, store: TokenStore = None, budget: QuotaBudget = None):
+    # Token cache shared with the display service and the token refresher,
+    # API request budget shared with the other services, button presses go first.
+    # spotipiService.py passes its own, so nothing is opened twice.
+    global config, token_store, api_budget
+    config = config_parser
+    token_store = store if store is not None else TokenStore(config['DEFAULT']['token_file'])
+    api_budget = budget if budget is not None else QuotaBudget.from_config(config)
+
 def get_state(current_state: str) -> str:
     states = ['track', 'context', 'off']
     index = states.index(current_state)
@@ -37,14 +45,14 @@ def get_state(current_state: str) -> str:
 def handle_button(pin):
     global current_state
     global config
-    # do this every time to load the latest refresh token from the displayCoverArt.py->getSongInfo.py
-    scope = 'user-read-currently-playing,user-modify-playback-state'
-    token = util.prompt_for_user_token(
-        username=config['DEFAULT']['username'],
-        scope=scope, cache_path=config['DEFAULT']['token_file'])
+    # the store re-reads the token file whenever another service has refreshed it
+    token = token_store.access_token()
     if not token:
         print(f"Error with token: {config['DEFAULT']['token_file']}")
         return
+    if not api_budget.acquire('button', timeout=5):
+        print("Spotify API budget exhausted, ignoring button press")
+        return
     sp = spotipy.Spotify(auth=token)
     label = LABELS[BUTTONS.index(pin)]
     if label == 'A':
@@ -115,4 +123,10 @@ def main():
         signal_handler(None, None)
 
 if __name__ == "__main__":
+    # initial Configuration file
+    dir = os.path.dirname(__file__)
+    config_file = os.path.join(dir, '..', 'config', 'eink_options.ini')
+    config_parser = configparser.ConfigParser()
+    config_parser.read(config_file)
+    setup(config_parser)
     main()
@@ -0,0 +1,225 @@
+"""
+Checks a Waveshare panel driver without the panel, on the recording fake
+platform of lib/epdconfig.py (EPD_PLATFORM=fake).
+
+Frames: renders the same frames for '--model' and for the virtual model
+emulating it (virtual_model = <model>), in every dither mode and in
+landscape and portrait, packs the hardware frames with the driver's
+getbuffer() and unpacks them again. Every buffer has to decode to exactly
+the pixels the virtual panel shows.
+
+Sequence: runs init(), display(), Clear() and sleep() and checks the
+recorded SPI stream: the frame follows command 0x10 byte for byte in
+spidev-sized transfers, nothing is sent as a list, every busy wait
+releases, and a busy pin that never releases raises TimeoutError. The
+recorded commands (with data length, transfer count and a hash of the data)
+can be written with --trace and compared against an earlier trace with
+--expect, so a driver change that alters what reaches the panel shows up.
+
+Exits with status 1 if anything fails.
+
+Usage:
+    python checkDriver.py [image ...] [--model waveshare7] [--trace FILE] [--expect FILE]
+"""
+import argparse
+import configparser
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+
+from PIL import Image
+
+from displayBackends import backend_class
+from panelRenderer import PanelRenderer
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+_HIGH = bytes(value >> 4 for value in range(256))
+_LOW = bytes(value & 0x0f for value in range(256))
+
+
+def unpack_nibbles(buf) -> bytes:
+    """Inverse of the drivers' 4 bit packing: one palette index per byte, left pixel first."""
+    buf = bytes(buf)
+    indices = bytearray(2 * len(buf))
+    indices[0::2] = buf.translate(_HIGH)
+    indices[1::2] = buf.translate(_LOW)
+    return bytes(indices)
+
+
+def _settings(model: str, size: tuple, rotation: int, dither_mode: str, virtual: bool):
+    width, height = size[::-1] if rotation in (90, 270) else size
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = {
+        'model': 'virtual' if virtual else model,
+        'virtual_model': model if virtual else '',
+        'virtual_output_dir': os.path.join(BASE_DIR, 'log', 'virtual'),
+        'rotation': str(rotation),
+        'dither_mode': dither_mode,
+        'width': str(width),
+        'height': str(height),
+        'album_cover_small': 'True',
+        'album_cover_small_px': str(min(width, height) * 5 // 8),
+        'no_song_cover': os.path.join(BASE_DIR, 'resources', 'default.jpg'),
+        'font_path': os.path.join(BASE_DIR, 'resources', 'CircularStd-Bold.otf'),
+        'font_size_title': '45',
+        'font_size_artist': '35',
+        'offset_px_left': '20',
+        'offset_px_right': '20',
+        'offset_px_top': '0',
+        'offset_px_bottom': '20',
+        'offset_text_px_shadow': '4',
+        'text_direction': 'bottom-up',
+        'background_mode': 'fit',
+    }
+    return config['DEFAULT']
+
+
+def _dither_modes() -> list:
+    try:
+        import dither
+    except ImportError:
+        # The other modes need NumPy
+        return ['pillow']
+    return list(dither.MODES)
+
+
+def check_frames(epd, model: str, images: list) -> int:
+    size = (epd.width, epd.height)
+    failures = 0
+    print(f'{"image":<20}{"mode":<17}{"rot":>4}{"render ms":>11}{"getbuffer ms":>14}  result')
+    for path in images:
+        cover = Image.open(path).convert('RGB')
+        name = os.path.splitext(os.path.basename(path))[0]
+        for mode in _dither_modes():
+            for rotation in (0, 90):
+                hardware = PanelRenderer(_settings(model, size, rotation, mode, virtual=False))
+                virtual = PanelRenderer(_settings(model, size, rotation, mode, virtual=True))
+                start = time.perf_counter()
+                frame = hardware.render(cover, 'Artist', 'Title', True)
+                render_ms = (time.perf_counter() - start) * 1000
+                expected = virtual.render(cover, 'Artist', 'Title', True)
+                start = time.perf_counter()
+                buf = epd.getbuffer(frame)
+                pack_ms = (time.perf_counter() - start) * 1000
+
+                problems = []
+                if frame.size != size:
+                    problems.append(f'frame is {frame.size[0]}x{frame.size[1]}')
+                if (expected.mode, expected.size, expected.tobytes()) != (frame.mode, frame.size, frame.tobytes()):
+                    problems.append('virtual frame differs')
+                if len(buf) != size[0] * size[1] // 2:
+                    problems.append(f'buffer has {len(buf)} bytes')
+                elif unpack_nibbles(buf) != expected.tobytes():
+                    problems.append('buffer does not decode to the virtual frame')
+                failures += bool(problems)
+                print(f'{name[:19]:<20}{mode:<17}{rotation:>4}{render_ms:>11.1f}{pack_ms:>14.1f}  '
+                      f'{", ".join(problems) or "ok"}')
+    return failures
+
+
+def _trace(fake) -> list:
+    return [{'command': f'0x{command:02x}', 'bytes': len(data), 'transfers': transfers,
+             'sha1': hashlib.sha1(data).hexdigest()[:12]} for command, data, transfers in fake.commands()]
+
+
+def _frame_problems(fake, frame: bytes, command: int = 0x10) -> list:
+    problems = []
+    sent = [(data, transfers) for c, data, transfers in fake.commands() if c == command]
+    if len(sent) != 1:
+        return [f'command 0x{command:02x} sent {len(sent)} times']
+    data, transfers = sent[0]
+    if data != frame:
+        problems.append(f'{len(data)} bytes after 0x{command:02x} differ from the {len(frame)} byte frame')
+    expected = -(-len(frame) // fake.chunk_size)
+    if transfers != expected:
+        problems.append(f'frame sent in {transfers} transfers, expected {expected}')
+    if any(kind == 'data_list' for _, kind, _ in fake.events):
+        problems.append('data sent as a list')
+    if not all(value[2] for _, kind, value in fake.events if kind == 'busy'):
+        problems.append('a busy wait did not release')
+    return problems
+
+
+def check_sequence(driver, frame: bytes) -> tuple:
+    """Runs each driver operation on the fake platform; returns (failures, trace)."""
+    fake = driver.epdconfig.implementation
+    epd = driver.EPD()
+    clear = bytes([0x11]) * (epd.width * epd.height // 2)
+    steps = (('init', epd.init, None), ('display', lambda: epd.display(frame), frame),
+             ('Clear', epd.Clear, clear), ('sleep', epd.sleep, None))
+    failures = 0
+    trace = {}
+    print(f'{"step":<10}{"commands":>9}{"bytes":>9}{"transfers":>10}{"busy":>6}{"spi ms":>8}  result')
+    for step, run, expected in steps:
+        fake.clear_events()
+        run()
+        commands = fake.commands()
+        data = [event for event in fake.events if event[1] in ('data', 'data_list')]
+        spi_s = sum(len(value) * 8 / fake.spi_speed_hz for _, _, value in data)
+        busy = sum(1 for event in fake.events if event[1] == 'busy')
+        problems = _frame_problems(fake, expected) if expected is not None else []
+        if fake.dropped:
+            problems.append(f'{fake.dropped} events dropped, EPD_FAKE_EVENTS is too small')
+        failures += bool(problems)
+        trace[step] = _trace(fake)
+        print(f'{step:<10}{len(commands):>9}{sum(len(value) for _, _, value in data):>9}{len(data):>10}{busy:>6}'
+              f'{spi_s * 1000:>8.0f}  {", ".join(problems) or "ok"}')
+
+    # A panel that never releases the busy pin must not hang the display thread
+    fake.busy_stuck = True
+    epd.busy_timeout_ms = 100
+    try:
+        epd.display(frame)
+        print('stuck busy pin: display() returned, expected TimeoutError')
+        failures += 1
+    except TimeoutError:
+        print('stuck busy pin: TimeoutError  ok')
+    finally:
+        fake.busy_stuck = False
+    return failures, trace
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a panel driver on the recording fake platform')
+    parser.add_argument('images', nargs='*', default=[os.path.join(BASE_DIR, 'resources', 'default.jpg')])
+    parser.add_argument('--model', default='waveshare7')
+    parser.add_argument('--trace', help='write the recorded command sequence to this JSON file')
+    parser.add_argument('--expect', help='compare the recorded command sequence with this JSON file')
+    args = parser.parse_args()
+
+    backend = backend_class(args.model)
+    if not hasattr(backend, 'driver'):
+        parser.error(f'{args.model} has no driver in lib/ to check')
+    os.environ['EPD_PLATFORM'] = 'fake'
+    driver = importlib.import_module(f'lib.{backend.driver}')
+    epd = driver.EPD()
+    print(f'{args.model}: lib/{backend.driver}.py, {epd.width}x{epd.height}')
+
+    failures = check_frames(epd, args.model, args.images)
+    cover = Image.open(args.images[0]).convert('RGB')
+    size = (epd.width, epd.height)
+    frame = PanelRenderer(_settings(args.model, size, 0, 'pillow', virtual=False)).render(cover, 'Artist', 'Title', True)
+    sequence_failures, trace = check_sequence(driver, bytes(epd.getbuffer(frame)))
+    failures += sequence_failures
+
+    if args.trace:
+        with open(args.trace, 'w') as f:
+            json.dump(trace, f, indent=1)
+    if args.expect:
+        with open(args.expect) as f:
+            expected = json.load(f)
+        for step in expected:
+            if trace.get(step) != expected[step]:
+                print(f'{step}: recorded commands differ from {args.expect}')
+                failures += 1
+
+    print(f'{failures} failed' if failures else 'Driver checks passed')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Decides when a panel should be cleaned.
+
+Every refresh leaves a little ghosting on an e-ink panel. The scheduler keeps
+a ghosting budget: each frame spends 1.0, or with transition statistics the
+share of pixels that changed colour, weighted by how far apart the old and
+new colours are (a full black/white swap of the whole panel costs more than
+recolouring a corner). Consecutive quantized ('P' mode) frames are compared
+for that; other frames always cost 1.0.
+
+Once 'budget' is spent a clean is due and runs the next time the panel has
+been idle for 'idle_after' seconds, or sooner in quiet hours, followed by a
+redraw of the frame that was on screen. Only when the budget is exhausted
+('hard_budget') does a clean run in front of a new frame.
+"""
+import threading
+import time
+
+
+class CleanScheduler:
+    def __init__(self, budget: float = 20.0, hard_budget: float = None, idle_after: float = 60.0,
+                 quiet_hours: str = '', transition_stats: bool = False):
+        self.budget = budget
+        self.hard_budget = hard_budget if hard_budget is not None else budget * 2
+        self.idle_after = idle_after
+        self.quiet_hours = self._parse_hours(quiet_hours)
+        self.transition_stats = transition_stats
+        self.used = 0.0
+        self._weights = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse_hours(value: str) -> tuple:
+        """'1-6' -> (1, 6): from 01:00 up to 06:00, may wrap past midnight ('22-6')."""
+        if not value:
+            return None
+        start, end = value.split('-', 1)
+        return int(start) % 24, int(end) % 24
+
+    def in_quiet_hours(self, now: float = None) -> bool:
+        if self.quiet_hours is None:
+            return False
+        hour = time.localtime(now).tm_hour
+        start, end = self.quiet_hours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    @property
+    def due(self) -> bool:
+        return self.used >= self.budget
+
+    @property
+    def exhausted(self) -> bool:
+        return self.used >= self.hard_budget
+
+    def idle_delay(self):
+        """Seconds of idle time after which a due clean should run, None if none is due."""
+        if not self.due:
+            return None
+        return min(self.idle_after, 5.0) if self.in_quiet_hours() else self.idle_after
+
+    def frame_cost(self, previous, frame) -> float:
+        if (not self.transition_stats or previous is None or previous.mode != 'P' or frame.mode != 'P'
+                or previous.size != frame.size):
+            return 1.0
+        import numpy as np
+        weights = self._transition_weights(frame.getpalette())
+        n = len(weights)
+        old = np.asarray(previous, dtype=np.intp).ravel()
+        new = np.asarray(frame, dtype=np.intp).ravel()
+        counts = np.bincount(old * n + new, minlength=n * n)
+        return float((counts * weights.ravel()).sum() / old.size)
+
+    def _transition_weights(self, palette: list):
+        """
+        Lab distance between every pair of palette entries, scaled so the
+        average change between two different colours costs 1.0.
+        """
+        key = tuple(palette)
+        if key not in self._weights:
+            import numpy as np
+            from dither import rgb_to_lab
+            colours = np.array(palette).reshape(-1, 3)
+            lab = rgb_to_lab(colours)
+            dist = np.sqrt(((lab[:, None, :] - lab[None, :, :]) ** 2).sum(axis=-1))
+            unique = rgb_to_lab(np.unique(colours, axis=0))
+            unique_dist = np.sqrt(((unique[:, None, :] - unique[None, :, :]) ** 2).sum(axis=-1))
+            self._weights[key] = dist / unique_dist[unique_dist > 0].mean()
+        return self._weights[key]
+
+    def record(self, cost: float):
+        with self._lock:
+            self.used += cost
+
+    def reset(self):
+        with self._lock:
+            self.used = 0.0
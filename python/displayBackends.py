@@ -0,0 +1,309 @@
+"""
+Display backends: one class per panel model, registered under the name used
+for 'model' in eink_options.ini.
+
+Besides driving the hardware, every backend declares what the rest of the
+service needs to know about its panel, as Capabilities:
+    size        native resolution (width, height)
+    palette     the colours the panel shows, in the order of the values sent
+                to it; frames are rendered straight into it (None: the
+                panel takes full colour frames)
+    boost       colour enhancement applied before the palette is matched
+    rotation    degrees (counter-clockwise) the rendered picture is turned
+                to match the panel, from the panel's 'rotation' option
+    refresh_s   duration of one refresh, and clean_s of a clean
+
+The renderer uses size, palette and rotation so frames come out of the
+render workers (and the frame cache) ready to send; the admission policy and
+the clean scheduler use the refresh and clean times. A new panel model is a
+new Backend subclass with @register('<model>'), nothing else changes.
+
+Backends import their panel library on first use, never at start-up, and
+capabilities() works without it, so render worker processes can call it.
+"""
+import importlib
+import os
+import time
+
+from PIL import Image
+
+BACKENDS = {}
+
+# 7-colour ACeP order of the Waveshare 4.01" and 7.3" panels, index = value sent to the panel
+PALETTE_7 = (
+    (0x00, 0x00, 0x00),  # black
+    (0xff, 0xff, 0xff),  # white
+    (0x00, 0xff, 0x00),  # green
+    (0x00, 0x00, 0xff),  # blue
+    (0xff, 0x00, 0x00),  # red
+    (0xff, 0xff, 0x00),  # yellow
+    (0xff, 0x80, 0x00),  # orange
+)
+
+# Inky Impression palettes (same colour order), blended by the inky library
+# between the ideal and the measured colours at 'saturation'
+_INKY_DESATURATED = ((0, 0, 0), (255, 255, 255), (0, 255, 0), (0, 0, 255), (255, 0, 0), (255, 255, 0),
+                     (255, 140, 0))
+_INKY_SATURATED = {
+    'uc8159': ((57, 48, 57), (255, 255, 255), (58, 91, 70), (61, 59, 94), (156, 72, 75), (208, 190, 71),
+               (177, 106, 73)),
+    'ac073tc1a': ((0, 0, 0), (217, 242, 255), (3, 124, 76), (27, 46, 198), (245, 80, 34), (255, 255, 68),
+                  (239, 121, 44)),
+}
+_INKY_CONTROLLERS = {(600, 448): 'uc8159', (640, 400): 'uc8159', (800, 480): 'ac073tc1a'}
+
+_TRANSPOSE = {90: Image.Transpose.ROTATE_90, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_270}
+
+
+def inky_palette(controller: str, saturation: float = 0.5) -> tuple:
+    """
+    The palette the inky library quantizes to, see Inky._palette_blend(),
+    including its eighth entry (white, the 'clean' colour) so that frames
+    come out exactly as the library would quantize them.
+    """
+    blended = tuple(tuple(int(s * saturation + d * (1.0 - saturation)) for s, d in zip(saturated, desaturated))
+                    for saturated, desaturated in zip(_INKY_SATURATED[controller], _INKY_DESATURATED))
+    return blended + ((255, 255, 255),)
+
+
+class Capabilities:
+    def __init__(self, size: tuple, palette: tuple = None, boost: float = 1.0, rotation: int = 0,
+                 refresh_s: float = 30.0, clean_s: float = 30.0):
+        self.size = size
+        self.palette = palette
+        self.boost = boost
+        self.rotation = rotation
+        self.refresh_s = refresh_s
+        self.clean_s = clean_s
+
+    def orient(self, frame: Image) -> Image:
+        """Turns a rendered frame into the panel's orientation."""
+        return frame.transpose(_TRANSPOSE[self.rotation]) if self.rotation else frame
+
+
+def register(model: str):
+    def inner(cls):
+        cls.model = model
+        BACKENDS[model] = cls
+        return cls
+    return inner
+
+
+def backend_class(model: str):
+    try:
+        return BACKENDS[model]
+    except KeyError:
+        raise ValueError(f"Unknown display model {model!r}, expected one of {', '.join(BACKENDS)}") from None
+
+
+def capabilities(settings) -> Capabilities:
+    """Capabilities of the panel described by a config section, without loading its library."""
+    return backend_class(settings.get('model', fallback='inky')).capabilities(settings)
+
+
+def _rotation(settings) -> int:
+    rotation = settings.getint('rotation', fallback=0) % 360
+    if rotation not in (0, 90, 180, 270):
+        raise ValueError(f'rotation must be 0, 90, 180 or 270, not {rotation}')
+    return rotation
+
+
+def _configured_size(settings) -> tuple:
+    """The native size of a panel whose picture size is configured, rotation taken into account."""
+    size = (settings.getint('width', fallback=640), settings.getint('height', fallback=400))
+    return size[::-1] if _rotation(settings) in (90, 270) else size
+
+
+class Backend:
+    """Hardware side of one Panel. Methods other than capabilities() run on its hardware thread."""
+
+    model = None
+
+    def __init__(self, panel):
+        self.panel = panel
+        self.settings = panel.settings
+        self.logger = panel.logger
+        self.metrics = panel.metrics
+
+    @classmethod
+    def capabilities(cls, settings) -> Capabilities:
+        raise NotImplementedError
+
+    def show(self, frame: Image):
+        raise NotImplementedError
+
+    def clean(self):
+        raise NotImplementedError
+
+    def sleep(self):
+        """Puts the panel into deep sleep, if it has one."""
+
+    def reset(self):
+        """Forgets the panel state after a failed refresh, so the next one starts over."""
+
+
+@register('inky')
+class InkyBackend(Backend):
+    """Pimoroni Inky Impression 4", 5.7" and 7.3", detected by inky.auto."""
+
+    def __init__(self, panel):
+        super().__init__(panel)
+        self._auto = None
+        self._clean_colour = None
+
+    @classmethod
+    def capabilities(cls, settings) -> Capabilities:
+        size = _configured_size(settings)
+        controller = _INKY_CONTROLLERS.get(size)
+        # An unknown size gets full colour frames, the library quantizes them itself
+        palette = inky_palette(controller) if controller else None
+        # A clean is two full refreshes with a second's pause after each
+        return Capabilities(size, palette, rotation=_rotation(settings), refresh_s=30.0, clean_s=62.0)
+
+    def _inky(self):
+        if self._auto is None:
+            self.logger.info(f'[{self.panel.name}] Loading Pimoroni Inky library')
+            from inky.auto import auto
+            from inky.inky_uc8159 import CLEAN
+            self._clean_colour = CLEAN
+            self._auto = auto
+        return self._auto()
+
+    def show(self, frame: Image):
+        inky = self._inky()
+        # 'P' frames are already in the panel's palette and are sent as they are
+        with self.metrics.span('quantize'):
+            inky.set_image(frame, saturation=0.5)
+        with self.metrics.span('show'):
+            inky.show()
+
+    def clean(self):
+        inky = self._inky()
+        for _ in range(2):
+            for y in range(inky.height):
+                for x in range(inky.width):
+                    inky.set_pixel(x, y, self._clean_colour)
+            inky.show()
+            time.sleep(1.0)
+
+
+@register('waveshare4')
+class Waveshare4Backend(Backend):
+    """Waveshare 4.01" 7-colour ACeP panel, lib/epd4in01f.py."""
+
+    driver = 'epd4in01f'
+
+    def __init__(self, panel):
+        super().__init__(panel)
+        self.busy_timeout_ms = int(self.settings.getfloat('busy_timeout_s', fallback=60) * 1000)
+        self._lib = None
+        # Kept initialised between frames until the power manager sleeps it
+        self._epd = None
+
+    @classmethod
+    def capabilities(cls, settings) -> Capabilities:
+        return Capabilities((640, 400), PALETTE_7, boost=2.0, rotation=_rotation(settings),
+                            refresh_s=30.0, clean_s=30.0)
+
+    def _load(self):
+        if self._lib is None:
+            self.logger.info(f'[{self.panel.name}] Loading Waveshare library lib/{self.driver}.py')
+            lib = importlib.import_module(f'lib.{self.driver}')
+            spi_speed_hz = self.settings.getint('spi_speed_hz', fallback=0)
+            if spi_speed_hz:
+                lib.epdconfig.set_spi_speed_hz(spi_speed_hz)
+            self._lib = lib
+        return self._lib
+
+    def _device(self):
+        """Returns the EPD, initialising it if it was put to deep sleep."""
+        if self._epd is None:
+            epd = self._load().EPD()
+            epd.busy_timeout_ms = self.busy_timeout_ms
+            epd.init()
+            self._epd = epd
+        return self._epd
+
+    def show(self, frame: Image):
+        epd = self._device()
+        if frame.mode != 'P':
+            with self.metrics.span('quantize'):
+                frame = self.panel.quantize(frame)
+        with self.metrics.span('getbuffer'):
+            buf = epd.getbuffer(frame)
+        with self.metrics.span('show'):
+            epd.display(buf)
+        self._record_driver_timings(epd)
+
+    def clean(self):
+        epd = self._device()
+        epd.Clear()
+        self._record_driver_timings(epd)
+
+    def sleep(self):
+        if self._epd is not None:
+            epd, self._epd = self._epd, None
+            epd.sleep()
+
+    def reset(self):
+        self._epd = None
+
+    def _record_driver_timings(self, epd):
+        """Feeds the SPI transfer and busy-wait time measured by the driver into the metrics."""
+        for stage, seconds in getattr(epd, 'timings', {}).items():
+            self.metrics.observe(stage, seconds)
+        for seconds in getattr(epd, 'busy_durations', []):
+            self.metrics.observe('busy_wait', seconds)
+        self.logger.debug(f"Busy waits: {', '.join(f'{s:.2f}s' for s in getattr(epd, 'busy_durations', []))}")
+
+
+@register('waveshare7')
+class Waveshare7Backend(Waveshare4Backend):
+    """Waveshare 7.3" 7-colour ACeP panel (800x480), lib/epd7in3f.py."""
+
+    driver = 'epd7in3f'
+
+    @classmethod
+    def capabilities(cls, settings) -> Capabilities:
+        # Same colours as the 4.01"; the larger panel takes a few seconds longer per refresh
+        return Capabilities((800, 480), PALETTE_7, boost=2.0, rotation=_rotation(settings),
+                            refresh_s=35.0, clean_s=35.0)
+
+
+@register('virtual')
+class VirtualBackend(Backend):
+    """
+    Writes frames to 'virtual_output_dir' instead of a panel (replay and soak
+    harnesses). With 'virtual_model' it declares the size and palette of
+    that model, so its frames are exactly what that panel would get.
+    """
+
+    def __init__(self, panel):
+        super().__init__(panel)
+        self.directory = self.settings.get('virtual_output_dir',
+                                           fallback=os.path.join(os.path.dirname(__file__), '..', 'log', 'virtual'))
+        self.refresh_s = self.settings.getfloat('virtual_refresh_s', fallback=0.0)
+        self.file = 'current.png' if panel.section == 'DEFAULT' else f'{panel.name}.png'
+        os.makedirs(self.directory, exist_ok=True)
+        self.logger.info(f'[{panel.name}] Using virtual display, frames written to {self.directory}')
+
+    @classmethod
+    def capabilities(cls, settings) -> Capabilities:
+        refresh_s = settings.getfloat('virtual_refresh_s', fallback=0.0)
+        emulated = settings.get('virtual_model', fallback='')
+        if emulated:
+            if emulated == cls.model:
+                raise ValueError('virtual_model must name a hardware model')
+            capabilities = backend_class(emulated).capabilities(settings)
+        else:
+            capabilities = Capabilities(_configured_size(settings), rotation=_rotation(settings))
+        capabilities.refresh_s = capabilities.clean_s = refresh_s
+        return capabilities
+
+    def show(self, frame: Image):
+        with self.metrics.span('show'):
+            time.sleep(self.refresh_s)
+            frame.convert('RGB').save(os.path.join(self.directory, self.file))
+
+    def clean(self):
+        time.sleep(self.refresh_s)
@@ -0,0 +1,203 @@
+"""
+Non-blocking front end for the e-ink panels.
+
+Panel refreshes (SPI transfer plus the busy waits) take 20-30 seconds. The
+DisplayDriver runs them on a dedicated hardware thread so the caller can keep
+polling and rendering: show() and clean() return a Future immediately.
+
+If several frames are queued while the panel is busy only the newest one is
+shown; the older Futures are cancelled. Cleans are never dropped.
+
+Deep sleep is no longer entered after every frame. The PowerManager looks at
+how long the panel is expected to stay idle and either sleeps right away or
+keeps the panel initialised for 'sleep_after' seconds in case another frame
+arrives.
+
+Maintenance such as a panel clean can be handed in as 'idle_job': the hardware
+thread runs it once the queue has been empty for 'idle_delay()' seconds.
+"""
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger('spotipy_logger')
+
+
+class PowerManager:
+    """Decides when an idle panel should enter deep sleep."""
+
+    def __init__(self, sleep_after: float = 120.0, min_idle: float = 60.0, history: int = 8):
+        # Longest time an initialised panel is kept awake waiting for a frame
+        self.sleep_after = sleep_after
+        # Expected idle time above which the panel sleeps straight away
+        self.min_idle = min_idle
+        self._gaps = deque(maxlen=history)
+        self._last_frame = None
+
+    def record_frame(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        if self._last_frame is not None:
+            self._gaps.append(now - self._last_frame)
+        self._last_frame = now
+
+    def expected_idle(self):
+        """Median of recent gaps between frames, or None without history."""
+        return statistics.median(self._gaps) if self._gaps else None
+
+    def sleep_delay(self, expected_idle: float = None) -> float:
+        """Seconds to stay awake after a frame before entering deep sleep."""
+        if expected_idle is None:
+            expected_idle = self.expected_idle()
+        if expected_idle is not None and expected_idle >= self.min_idle:
+            return 0.0
+        return self.sleep_after
+
+
+class _Job:
+    def __init__(self, kind: str, func, args: tuple, expected_idle: float = None):
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.expected_idle = expected_idle
+        self.future = Future()
+
+
+class DisplayDriver:
+    """
+    Runs 'show' and 'clean' on a hardware thread and calls 'sleep' when the
+    PowerManager decides the panel can power down.
+    """
+
+    def __init__(self, show, clean, sleep, power_manager: PowerManager = None, asynchronous: bool = True,
+                 idle_job=None, idle_delay=None):
+        self._show = show
+        self._clean = clean
+        self._sleep = sleep
+        # idle_delay() returns the idle seconds before idle_job() should run, or None
+        self._idle_job = idle_job
+        self._idle_delay = idle_delay
+        self.power = power_manager or PowerManager()
+        self.asynchronous = asynchronous
+        self.awake = False
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = None
+        if asynchronous:
+            self._thread = threading.Thread(target=self._run, name='display-hw', daemon=True)
+            self._thread.start()
+
+    def show(self, image, callback=None, expected_idle: float = None) -> Future:
+        """Queues 'image'; a newer show() replaces it if it has not started yet."""
+        job = _Job('show', self._show, (image,), expected_idle)
+        return self._submit(job, callback)
+
+    def clean(self, callback=None) -> Future:
+        return self._submit(_Job('clean', self._clean, ()), callback)
+
+    def pending(self, kind: str = 'show') -> bool:
+        """Whether a job of 'kind' is queued and not started yet."""
+        with self._cond:
+            return any(job.kind == kind for job in self._queue)
+
+    def _submit(self, job: _Job, callback) -> Future:
+        if callback is not None:
+            job.future.add_done_callback(callback)
+        if not self.asynchronous:
+            self._execute(job)
+            self._after_job(job)
+            return job.future
+        with self._cond:
+            if job.kind == 'show':
+                for pending in [j for j in self._queue if j.kind == 'show']:
+                    self._queue.remove(pending)
+                    pending.future.cancel()
+            self._queue.append(job)
+            self._cond.notify()
+        return job.future
+
+    def _execute(self, job: _Job):
+        if not job.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = job.func(*job.args)
+        except BaseException as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+        self.awake = True
+
+    def _after_job(self, job: _Job):
+        # Without the hardware thread there is nobody to sleep the panel
+        # later, so keep the old behaviour of sleeping after every job
+        if job.kind == 'show':
+            self.power.record_frame()
+        self._enter_sleep()
+
+    def _enter_sleep(self):
+        if not self.awake:
+            return
+        try:
+            self._sleep()
+        except Exception as e:
+            logger.error(f'Display sleep error: {e}')
+        self.awake = False
+
+    def _idle_at(self):
+        delay = self._idle_delay() if self._idle_delay is not None else None
+        return None if delay is None else time.monotonic() + delay
+
+    def _run(self):
+        sleep_at = None
+        idle_at = None
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    wake_at = min((t for t in (sleep_at, idle_at) if t is not None), default=None)
+                    timeout = None if wake_at is None else max(0.0, wake_at - time.monotonic())
+                    if timeout == 0.0:
+                        break
+                    self._cond.wait(timeout)
+                if not self._queue:
+                    if self._closing:
+                        break
+                    job = None
+                else:
+                    job = self._queue.popleft()
+
+            if job is None:
+                if idle_at is not None and time.monotonic() >= idle_at:
+                    logger.debug('Display idle, running idle job')
+                    try:
+                        self._idle_job()
+                    except Exception as e:
+                        logger.error(f'Display idle job error: {e}')
+                    self.awake = True
+                    idle_at = self._idle_at()
+                    sleep_at = time.monotonic() + self.power.sleep_delay()
+                    continue
+                if sleep_at is not None and time.monotonic() >= sleep_at:
+                    logger.debug('Display idle, entering deep sleep')
+                    self._enter_sleep()
+                    sleep_at = None
+                continue
+
+            self._execute(job)
+            if job.kind == 'show':
+                self.power.record_frame()
+            sleep_at = time.monotonic() + self.power.sleep_delay(job.expected_idle)
+            idle_at = self._idle_at()
+        self._enter_sleep()
+
+    def close(self, timeout: float = None):
+        """Finishes queued work, puts the panel to sleep and stops the thread."""
+        if self._thread is None:
+            self._enter_sleep()
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(timeout)
@@ -0,0 +1,60 @@
+"""
+Small JSON file with what the panels are showing, so a restarted service can
+carry on where it stopped: no initial clean when a panel still shows a known
+frame, no re-render of the track that is already on screen, and the idle
+image cycle and clean counter continue.
+
+The file is replaced atomically and only written when a panel shows a new
+frame or the loop state changes, which keeps SD card writes rare.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('spotipy_logger')
+
+STATE_VERSION = 1
+
+
+class DisplayState:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._last = None
+
+    def load(self) -> dict:
+        """Saved state, or {} if there is none or it cannot be read."""
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable state file {self.path}: {e}')
+            return {}
+        if state.get('version') != STATE_VERSION:
+            return {}
+        self._last = {key: value for key, value in state.items() if key != 'saved_at'}
+        return state
+
+    def save(self, state: dict):
+        """Atomically replaces the file, unless nothing changed."""
+        if not self.path:
+            return
+        state = dict(state, version=STATE_VERSION)
+        with self._lock:
+            if state == self._last:
+                return
+            tmp_path = f'{self.path}.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(dict(state, saved_at=time.time()), f, indent=1)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.error(f'Could not write state file {self.path}: {e}')
+                return
+            self._last = state
@@ -0,0 +1,160 @@
+"""
+Dithering of RGB frames onto the fixed palettes of colour e-ink panels.
+
+Colours are matched in CIELAB, so the closest palette entry is the one that
+looks closest rather than the one with the smallest RGB distance. Matching
+goes through a 64x64x64 lookup table built once per palette, which makes the
+per-pixel cost a single indexed read.
+
+Modes (the 'dither_mode' option, per panel):
+    pillow           Pillow's built-in Floyd-Steinberg with RGB matching (previous behaviour)
+    none             nearest colour only, fastest, flat areas band
+    bayer            ordered dithering with an 8x8 Bayer threshold matrix
+    blue-noise       ordered dithering with a 64x64 blue-noise threshold matrix
+    floyd-steinberg  error diffusion, processed in anti-diagonal wavefronts so
+                     every pixel of a wavefront is updated in one NumPy operation
+
+python benchDither.py compares the render time and error of every mode.
+"""
+import numpy as np
+from PIL import Image
+
+from displayBackends import PALETTE_7
+
+MODES = ('pillow', 'none', 'bayer', 'blue-noise', 'floyd-steinberg')
+
+# Amplitude of the ordered-dither offset in RGB units; the 7-colour palettes
+# are coarse, so it has to span most of the distance between entries
+ORDERED_SPREAD = 192.0
+
+LUT_BITS = 6
+
+_luts = {}
+_blue_noise = None
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """sRGB (0-255, shape (..., 3)) to CIELAB under D65."""
+    c = np.asarray(rgb, dtype=np.float64) / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124, 0.2126, 0.0193],
+                        [0.3576, 0.7152, 0.1192],
+                        [0.1805, 0.0722, 0.9505]])
+    xyz /= np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16,
+                     500 * (f[..., 0] - f[..., 1]),
+                     200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def _lut(palette: tuple) -> np.ndarray:
+    """Palette index of the perceptually nearest colour for every 6-bit RGB cell."""
+    lut = _luts.get(palette)
+    if lut is None:
+        size = 1 << LUT_BITS
+        step = 256 // size
+        levels = np.arange(size) * step + step // 2
+        grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+        grid_lab = rgb_to_lab(grid)
+        palette_lab = rgb_to_lab(np.array(palette))
+        dist = ((grid_lab[:, None, :] - palette_lab[None, :, :]) ** 2).sum(axis=-1)
+        lut = _luts[palette] = dist.argmin(axis=1).astype(np.uint8).reshape(size, size, size)
+    return lut
+
+
+def _nearest(rgb: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    q = np.clip(rgb, 0, 255).astype(np.uint8) >> (8 - LUT_BITS)
+    return lut[q[..., 0], q[..., 1], q[..., 2]]
+
+
+def _bayer(n: int = 8) -> np.ndarray:
+    m = np.zeros((1, 1))
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return (m + 0.5) / m.size
+
+
+def _blue_noise_matrix(size: int = 64) -> np.ndarray:
+    """
+    Blue-noise threshold matrix: white noise with the low frequencies filtered
+    out, ranked so the thresholds are uniformly distributed. Built once.
+    """
+    global _blue_noise
+    if _blue_noise is None:
+        noise = np.random.default_rng(0).random((size, size))
+        freq = np.fft.fftfreq(size)
+        radius = np.sqrt(freq[:, None] ** 2 + freq[None, :] ** 2)
+        filtered = np.real(np.fft.ifft2(np.fft.fft2(noise) * radius ** 2))
+        ranks = filtered.ravel().argsort().argsort().reshape(size, size)
+        _blue_noise = (ranks + 0.5) / ranks.size
+    return _blue_noise
+
+
+def _ordered(rgb: np.ndarray, lut: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    h, w = rgb.shape[:2]
+    mh, mw = matrix.shape
+    tiled = np.tile(matrix, (h // mh + 1, w // mw + 1))[:h, :w]
+    return _nearest(rgb + ((tiled - 0.5) * ORDERED_SPREAD)[..., None], lut)
+
+
+def _floyd_steinberg(rgb: np.ndarray, lut: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """
+    Floyd-Steinberg error diffusion. Pixel (y, x) only depends on pixels with
+    a smaller x + 2y, so each wavefront x + 2y = t is quantized at once. Rows
+    are skewed by 2y so that a wavefront is one contiguous slice.
+    """
+    h, w = rgb.shape[:2]
+    waves = w + 2 * (h - 1)
+    # skew[t, y] holds pixel (y, t - 2y); the extra row and columns catch diffused error
+    skew = np.zeros((waves + 3, h + 1, 3), dtype=np.float32)
+    for y in range(h):
+        skew[2 * y:2 * y + w, y] = rgb[y]
+    indices = np.zeros((waves, h), dtype=np.uint8)
+    for t in range(waves):
+        y0 = max(0, (t - w) // 2 + 1)
+        y1 = min(h - 1, t // 2) + 1
+        old = np.clip(skew[t, y0:y1], 0, 255)
+        idx = _nearest(old, lut)
+        indices[t, y0:y1] = idx
+        err = old - palette[idx]
+        skew[t + 1, y0:y1] += err * (7 / 16)
+        skew[t + 1, y0 + 1:y1 + 1] += err * (3 / 16)
+        skew[t + 2, y0 + 1:y1 + 1] += err * (5 / 16)
+        skew[t + 3, y0 + 1:y1 + 1] += err * (1 / 16)
+    out = np.empty((h, w), dtype=np.uint8)
+    for y in range(h):
+        out[y] = indices[2 * y:2 * y + w, y]
+    return out
+
+
+def _pillow(image: Image, palette: tuple) -> np.ndarray:
+    palette_image = Image.new('P', (1, 1))
+    palette_image.putpalette([v for colour in palette for v in colour] + [0, 0, 0] * (256 - len(palette)))
+    image.load()
+    palette_image.load()
+    return np.asarray(image._new(image.im.convert('P', True, palette_image.im)))
+
+
+def dither(image: Image, palette: tuple = PALETTE_7, mode: str = 'floyd-steinberg') -> np.ndarray:
+    """Returns the (height, width) array of palette indices for an image."""
+    image = image.convert('RGB')
+    if mode == 'pillow':
+        return _pillow(image, palette)
+    lut = _lut(palette)
+    rgb = np.asarray(image, dtype=np.float32)
+    if mode == 'none':
+        return _nearest(rgb, lut)
+    if mode == 'bayer':
+        return _ordered(rgb, lut, _bayer())
+    if mode == 'blue-noise':
+        return _ordered(rgb, lut, _blue_noise_matrix())
+    if mode == 'floyd-steinberg':
+        return _floyd_steinberg(rgb, lut, np.array(palette, dtype=np.float32))
+    raise ValueError(f'Unknown dither mode {mode!r}, expected one of {", ".join(MODES)}')
+
+
+def to_image(indices: np.ndarray, palette: tuple = PALETTE_7) -> Image:
+    """Palette ('P' mode) image from an array of palette indices."""
+    image = Image.fromarray(indices.astype(np.uint8), mode='P')
+    image.putpalette([v for colour in palette for v in colour] + [0, 0, 0] * (256 - len(palette)))
+    return image
@@ -0,0 +1,122 @@
+"""
+On-disk cache of finished panel frames.
+
+A frame is stored under a digest of everything that decides how it looks:
+the panel settings, the cover (its URL, or path and modification time for a
+local file), the title, the artist and whether the small cover is shown. A
+hit skips the cover download, the decode and the render; the service looks
+frames up before fetching anything, and python/warmCache.py fills the cache
+ahead of time for a playlist, a list of tracks or a folder of images.
+
+Frames are kept as PNG files and the least recently used ones are removed
+once the cache grows over its size limit. Every new track writes a file, so
+the cache is off unless 'frame_cache_mb' is set; on an SD card consider
+pointing 'frame_cache_dir' at a tmpfs such as /dev/shm.
+
+Settings (in the [DEFAULT] section of eink_options.ini):
+    frame_cache_dir = ../config/frame_cache   ; where the frames are kept
+    frame_cache_mb = 0                        ; size limit, 0 = cache disabled
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from PIL import Image
+
+logger = logging.getLogger('spotipy_logger')
+
+
+def file_cover_id(path: str) -> str:
+    """Cover id of a local image; changes when the file is replaced."""
+    st = os.stat(path)
+    return f'file:{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}'
+
+
+class FrameCache:
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._total = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path and self.max_bytes)
+
+    @staticmethod
+    def key(settings, cover_id: str, artist: str, title: str, show_small_cover: bool) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for name, value in sorted(settings.items()):
+            h.update(f'{name}={value}\n'.encode())
+        h.update(repr((cover_id, artist, title, bool(show_small_cover))).encode())
+        return h.hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.png')
+
+    def get(self, key: str) -> Image:
+        if not self.enabled:
+            return None
+        path = self._file(key)
+        try:
+            with Image.open(path) as image:
+                image.load()
+            # The modification time orders the files for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f'Ignoring unreadable cached frame {path}: {e}')
+            return None
+        return image
+
+    def __contains__(self, key: str) -> bool:
+        return self.enabled and os.path.exists(self._file(key))
+
+    def put(self, key: str, frame: Image):
+        if not self.enabled:
+            return
+        path = self._file(key)
+        tmp_path = f'{path}.tmp'
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            frame.save(tmp_path, format='PNG', compress_level=1)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            logger.error(f'Could not write cached frame {path}: {e}')
+            return
+        with self._lock:
+            if self._total is None:
+                self._total = self.nbytes()
+            else:
+                self._total += size
+            if self._total > self.max_bytes:
+                self._total -= self.prune(self.max_bytes * 3 // 4)
+
+    def _entries(self) -> list:
+        try:
+            with os.scandir(self.path) as it:
+                return [entry for entry in it if entry.name.endswith('.png')]
+        except FileNotFoundError:
+            return []
+
+    def nbytes(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def prune(self, max_bytes: int) -> int:
+        """Removes the least recently used frames down to 'max_bytes'; returns the bytes freed."""
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        freed = 0
+        for entry in entries:
+            if total - freed <= max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                freed += size
+            except OSError:
+                pass
+        return freed
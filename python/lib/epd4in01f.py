@@ -34,6 +34,7 @@
 #
 
 import logging
+import time
 from . import epdconfig
 
 # Display resolution
@@ -58,6 +59,15 @@ class EPD:
         self.RED = 0x0000ff  # 0100
         self.YELLOW = 0x00ffff  # 0101
         self.ORANGE = 0x0080ff  # 0110
+        # Seconds spent per stage ('spi', 'busy') during the last display()/Clear()
+        self.timings = {}
+        # Every busy wait of the last display()/Clear(), in seconds
+        self.busy_durations = []
+        # Give up on a busy pin that never releases instead of hanging
+        self.busy_timeout_ms = 60000
+
+    def _add_timing(self, stage, start):
+        self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
 
     # Hardware reset
     def reset(self):
@@ -82,22 +92,35 @@ class EPD:
 
     # send a lot of data
     def send_data2(self, data):
+        start = time.perf_counter()
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte2(data)
         epdconfig.digital_write(self.cs_pin, 1)
+        self._add_timing('spi', start)
 
-    def ReadBusyHigh(self):
+    def _wait_busy(self, level):
         logger.debug("e-Paper busy")
-        while (epdconfig.digital_read(self.busy_pin) == 0):      # 0: idle, 1: busy
-            epdconfig.delay_ms(10)
-        logger.debug("e-Paper busy release")
+        start = time.perf_counter()
+        if hasattr(epdconfig, 'wait_for_level'):
+            released = epdconfig.wait_for_level(self.busy_pin, level, self.busy_timeout_ms)
+        else:
+            while (epdconfig.digital_read(self.busy_pin) != level):
+                if time.perf_counter() - start > self.busy_timeout_ms / 1000.0:
+                    break
+                epdconfig.delay_ms(10)
+            released = epdconfig.digital_read(self.busy_pin) == level
+        self._add_timing('busy', start)
+        self.busy_durations.append(time.perf_counter() - start)
+        if not released:
+            raise TimeoutError(f"e-Paper busy pin did not release within {self.busy_timeout_ms} ms")
+        logger.debug(f"e-Paper busy release after {self.busy_durations[-1]:.2f}s")
+
+    def ReadBusyHigh(self):
+        self._wait_busy(1)      # 0: idle, 1: busy
 
     def ReadBusyLow(self):
-        logger.debug("e-Paper busy")
-        while (epdconfig.digital_read(self.busy_pin) == 1):      # 0: idle, 1: busy
-            epdconfig.delay_ms(10)
-        logger.debug("e-Paper busy release")
+        self._wait_busy(0)      # 0: idle, 1: busy
 
     def init(self):
         if (epdconfig.module_init() != 0):
@@ -136,7 +159,7 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        buf = [0x00] * int(self.width * self.height / 2)
+        buf = bytearray(int(self.width * self.height / 2))
         image_monocolor = image.convert('RGB')  # Picture mode conversion
         imwidth, imheight = image_monocolor.size
         pixels = image_monocolor.load()
@@ -188,6 +211,8 @@ class EPD:
         return buf
 
     def display(self, image):
+        self.timings = {}
+        self.busy_durations = []
         self.send_command(0x61)  # Set Resolution setting
         self.send_data(0x02)
         self.send_data(0x80)
@@ -204,13 +229,15 @@ class EPD:
         # epdconfig.delay_ms(500)
 
     def Clear(self):
+        self.timings = {}
+        self.busy_durations = []
         self.send_command(0x61)  # Set Resolution setting
         self.send_data(0x02)
         self.send_data(0x80)
         self.send_data(0x01)
         self.send_data(0x90)
         self.send_command(0x10)
-        self.send_data2([0x11] * int(EPD_HEIGHT) * int(EPD_WIDTH / 2))
+        self.send_data2(b"\x11" * (int(EPD_HEIGHT) * int(EPD_WIDTH / 2)))
         # BLACK   0x00    /// 0000
         # WHITE   0x11    /// 0001
         # GREEN   0x22    /// 0010
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+# *****************************************************************************
+# * | File        :	  epd7in3f.py
+# * | Author      :   Waveshare team
+# * | Function    :   Electronic paper driver
+# * | Info        :
+# *----------------
+# * | This version:   V1.1
+# * | Date        :   2026-10-19
+# # | Info        :   packs frames without per-pixel loops, sends bytes,
+# # |                 waits for the busy pin on edges with a timeout
+# *----------------
+# * | This version:   V1.0
+# * | Date        :   2022-10-20
+# # | Info        :   python demo
+# -----------------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to  whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS OR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import logging
+import time
+from PIL import Image
+from . import epdconfig
+
+# Display resolution
+EPD_WIDTH = 800
+EPD_HEIGHT = 480
+
+# Colour order of the panel, index = 4 bit value sent for a pixel. Same as
+# displayBackends.PALETTE_7, repeated because the drivers in lib/ import
+# nothing but epdconfig and also run on their own
+PALETTE = (
+    (0x00, 0x00, 0x00),  # 0000 black
+    (0xff, 0xff, 0xff),  # 0001 white
+    (0x00, 0xff, 0x00),  # 0010 green
+    (0x00, 0x00, 0xff),  # 0011 blue
+    (0xff, 0x00, 0x00),  # 0100 red
+    (0xff, 0xff, 0x00),  # 0101 yellow
+    (0xff, 0x80, 0x00),  # 0110 orange
+)
+# 0111 is 'clean', unavailable (afterimage)
+
+_HIGH_NIBBLE = bytes((value & 0x0f) << 4 for value in range(256))
+_LOW_NIBBLE = bytes(value & 0x0f for value in range(256))
+
+logger = logging.getLogger()
+
+
+def pack_nibbles(indices):
+    # Packs one palette index per byte into two pixels per byte, the left
+    # pixel in the high nibble. Slicing, translate() and one big integer OR
+    # all run in C: a few milliseconds for a full frame.
+    indices = bytes(indices)
+    high = indices[0::2].translate(_HIGH_NIBBLE)
+    low = indices[1::2].translate(_LOW_NIBBLE)
+    return bytearray((int.from_bytes(high, 'big') | int.from_bytes(low, 'big')).to_bytes(len(high), 'big'))
+
+
+def palette_image():
+    image = Image.new('P', (1, 1))
+    image.putpalette([value for colour in PALETTE for value in colour] + [0, 0, 0] * (256 - len(PALETTE)))
+    return image
+
+
+class EPD:
+    def __init__(self):
+        self.reset_pin = epdconfig.RST_PIN
+        self.dc_pin = epdconfig.DC_PIN
+        self.busy_pin = epdconfig.BUSY_PIN
+        self.cs_pin = epdconfig.CS_PIN
+        self.width = EPD_WIDTH
+        self.height = EPD_HEIGHT
+        self.BLACK = 0x000000  # 0000  BGR
+        self.WHITE = 0xffffff  # 0001
+        self.GREEN = 0x00ff00  # 0010
+        self.BLUE = 0xff0000  # 0011
+        self.RED = 0x0000ff  # 0100
+        self.YELLOW = 0x00ffff  # 0101
+        self.ORANGE = 0x0080ff  # 0110
+        # Seconds spent per stage ('spi', 'busy') during the last display()/Clear()
+        self.timings = {}
+        # Every busy wait of the last display()/Clear(), in seconds
+        self.busy_durations = []
+        # Give up on a busy pin that never releases instead of hanging
+        self.busy_timeout_ms = 60000
+
+    def _add_timing(self, stage, start):
+        self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    # Hardware reset
+    def reset(self):
+        epdconfig.digital_write(self.reset_pin, 1)
+        epdconfig.delay_ms(20)
+        epdconfig.digital_write(self.reset_pin, 0)
+        epdconfig.delay_ms(2)
+        epdconfig.digital_write(self.reset_pin, 1)
+        epdconfig.delay_ms(20)
+
+    def send_command(self, command):
+        epdconfig.digital_write(self.dc_pin, 0)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte([command])
+        epdconfig.digital_write(self.cs_pin, 1)
+
+    def send_data(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte([data])
+        epdconfig.digital_write(self.cs_pin, 1)
+
+    # send a lot of data
+    def send_data2(self, data):
+        start = time.perf_counter()
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
+        self._add_timing('spi', start)
+
+    def _wait_busy(self, level):
+        logger.debug("e-Paper busy")
+        start = time.perf_counter()
+        if hasattr(epdconfig, 'wait_for_level'):
+            released = epdconfig.wait_for_level(self.busy_pin, level, self.busy_timeout_ms)
+        else:
+            while (epdconfig.digital_read(self.busy_pin) != level):
+                if time.perf_counter() - start > self.busy_timeout_ms / 1000.0:
+                    break
+                epdconfig.delay_ms(10)
+            released = epdconfig.digital_read(self.busy_pin) == level
+        self._add_timing('busy', start)
+        self.busy_durations.append(time.perf_counter() - start)
+        if not released:
+            raise TimeoutError(f"e-Paper busy pin did not release within {self.busy_timeout_ms} ms")
+        logger.debug(f"e-Paper busy release after {self.busy_durations[-1]:.2f}s")
+
+    def ReadBusyH(self):
+        self._wait_busy(1)      # 0: busy, 1: idle
+
+    def TurnOnDisplay(self):
+        self.send_command(0x04)  # POWER_ON
+        self.ReadBusyH()
+        self.send_command(0x12)  # DISPLAY_REFRESH
+        self.send_data(0x00)
+        self.ReadBusyH()
+        self.send_command(0x02)  # POWER_OFF
+        self.send_data(0x00)
+        self.ReadBusyH()
+
+    def init(self):
+        if (epdconfig.module_init() != 0):
+            return -1
+        # EPD hardware init start
+        self.reset()
+        self.ReadBusyH()
+        epdconfig.delay_ms(30)
+        self.send_command(0xAA)  # CMDH
+        for data in (0x49, 0x55, 0x20, 0x08, 0x09, 0x18):
+            self.send_data(data)
+        self.send_command(0x01)
+        for data in (0x3F, 0x00, 0x32, 0x2A, 0x0E, 0x2A):
+            self.send_data(data)
+        self.send_command(0x00)
+        self.send_data(0x5F)
+        self.send_data(0x69)
+        self.send_command(0x03)
+        for data in (0x00, 0x54, 0x00, 0x44):
+            self.send_data(data)
+        self.send_command(0x05)
+        for data in (0x40, 0x1F, 0x1F, 0x2C):
+            self.send_data(data)
+        self.send_command(0x06)
+        for data in (0x6F, 0x1F, 0x1F, 0x22):
+            self.send_data(data)
+        self.send_command(0x08)
+        for data in (0x6F, 0x1F, 0x1F, 0x22):
+            self.send_data(data)
+        self.send_command(0x13)  # IPC
+        self.send_data(0x00)
+        self.send_data(0x04)
+        self.send_command(0x30)
+        self.send_data(0x3C)
+        self.send_command(0x41)  # TSE
+        self.send_data(0x00)
+        self.send_command(0x50)
+        self.send_data(0x3F)
+        self.send_command(0x60)
+        self.send_data(0x02)
+        self.send_data(0x00)
+        self.send_command(0x61)  # 800x480
+        for data in (0x03, 0x20, 0x01, 0xE0):
+            self.send_data(data)
+        self.send_command(0x82)
+        self.send_data(0x1E)
+        self.send_command(0x84)
+        self.send_data(0x00)
+        self.send_command(0x86)  # AGID
+        self.send_data(0x00)
+        self.send_command(0xE3)
+        self.send_data(0x2F)
+        self.send_command(0xE0)  # CCSET
+        self.send_data(0x00)
+        self.send_command(0xE6)  # TSSET
+        self.send_data(0x00)
+        # EPD hardware init end
+        return 0
+
+    def getbuffer(self, image):
+        # Portrait pictures are turned to the panel's landscape orientation
+        if image.size == (self.height, self.width):
+            image = image.transpose(Image.Transpose.ROTATE_90)
+        elif image.size != (self.width, self.height):
+            raise ValueError(f"Image must be {self.width}x{self.height} or {self.height}x{self.width}, "
+                             f"not {image.size[0]}x{image.size[1]}")
+        # 'P' pictures in the panel's palette are sent as they are, anything
+        # else is matched to it first
+        if image.mode != 'P' or image.getpalette()[:3 * len(PALETTE)] != [v for c in PALETTE for v in c]:
+            image = image.convert('RGB').quantize(palette=palette_image())
+        return pack_nibbles(image.tobytes())
+
+    def display(self, image):
+        self.timings = {}
+        self.busy_durations = []
+        self.send_command(0x10)
+        self.send_data2(image)
+        self.TurnOnDisplay()
+
+    def Clear(self, color=0x11):
+        self.timings = {}
+        self.busy_durations = []
+        self.send_command(0x10)
+        self.send_data2(bytes([color]) * (EPD_HEIGHT * EPD_WIDTH // 2))
+        self.TurnOnDisplay()
+
+    def sleep(self):
+        self.send_command(0x07)  # DEEP_SLEEP
+        self.send_data(0XA5)
+        epdconfig.delay_ms(2000)
+        epdconfig.module_exit()
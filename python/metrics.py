@@ -0,0 +1,233 @@
+"""
+Lightweight in-process metrics for the display service.
+
+Stage timings are recorded with `registry.span('stage')` and kept as
+cumulative histograms plus a rolling window of recent samples for quantiles.
+Counters are plain integers, gauges hold the last value set. Everything can be served as Prometheus text on
+a local HTTP port and written as a JSON snapshot file.
+
+Recording a span costs two perf_counter() calls and a short locked update,
+so it is safe to leave enabled on the hot path.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, chosen to cover a 1ms decode up to a 60s panel refresh
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.9, 0.99)
+
+logger = logging.getLogger('spotipy_logger')
+
+
+class Histogram:
+    """Cumulative bucket counts plus a rolling window of recent samples."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window: int = 256):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float):
+        """The q quantile of the recent samples, None before the first one."""
+        samples = sorted(self.recent)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def quantiles(self) -> dict:
+        if not self.recent:
+            return {}
+        return {q: self.quantile(q) for q in QUANTILES}
+
+
+class Metrics:
+    """Thread-safe registry of stage histograms and counters."""
+
+    def __init__(self, prefix: str = 'spotipi'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = Histogram()
+            hist.observe(seconds)
+
+    def quantile(self, stage: str, q: float):
+        """The q quantile of the recent samples of 'stage', None before the first one."""
+        with self._lock:
+            hist = self.histograms.get(stage)
+            return hist.quantile(q) if hist is not None else None
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {}
+            for stage, hist in self.histograms.items():
+                stages[stage] = {
+                    'count': hist.count,
+                    'sum': round(hist.sum, 6),
+                    'last': round(hist.recent[-1], 6) if hist.recent else None,
+                    'quantiles': {str(q): round(v, 6) for q, v in hist.quantiles().items()},
+                }
+            return {
+                'timestamp': time.time(),
+                'uptime': time.time() - self.started_at,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'stages': stages,
+            }
+
+    def render_prometheus(self) -> str:
+        p = self.prefix
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {p}_{name}_total counter')
+                lines.append(f'{p}_{name}_total {value}')
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f'# TYPE {p}_{name} gauge')
+                lines.append(f'{p}_{name} {value}')
+            if self.histograms:
+                lines.append(f'# TYPE {p}_stage_seconds histogram')
+            for stage, hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {hist.sum:.6f}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+            if self.histograms:
+                lines.append(f'# TYPE {p}_stage_recent_seconds gauge')
+            for stage, hist in sorted(self.histograms.items()):
+                for q, value in hist.quantiles().items():
+                    lines.append(f'{p}_stage_recent_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+        lines.append(f'# TYPE {p}_uptime_seconds gauge')
+        lines.append(f'{p}_uptime_seconds {time.time() - self.started_at:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_snapshot(self, path: str):
+        """Atomically replace 'path' with the current snapshot."""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp_path, path)
+
+
+class MetricsServer:
+    """
+    Serves /metrics (Prometheus text) and /metrics.json on 127.0.0.1 and,
+    optionally, rewrites a JSON snapshot file every 'snapshot_interval' seconds.
+    Further diagnostic pages can be added with add_route().
+    """
+
+    def __init__(self, metrics: Metrics, port: int = 0, snapshot_path: str = None,
+                 snapshot_interval: float = 60.0, host: str = '127.0.0.1'):
+        self.metrics = metrics
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._httpd = None
+        self._stop_event = threading.Event()
+        self.routes = {}
+        if port:
+            self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+            self._httpd.daemon_threads = True
+
+    def add_route(self, path: str, handler):
+        """Serves 'path' with handler(), which returns (content_type, body text)."""
+        self.routes[path] = handler
+
+    def start(self):
+        if self._httpd is not None:
+            threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        if self.snapshot_path:
+            threading.Thread(target=self._snapshot_loop, daemon=True).start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+        if self.snapshot_path:
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        try:
+            self.metrics.write_snapshot(self.snapshot_path)
+        except OSError as e:
+            logger.error(f"Could not write metrics snapshot {self.snapshot_path}: {e}")
+
+    def _snapshot_loop(self):
+        while not self._stop_event.wait(self.snapshot_interval):
+            self._write_snapshot()
+
+    def _make_handler(self):
+        metrics = self.metrics
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.render_prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(metrics.snapshot()).encode()
+                    content_type = 'application/json'
+                elif self.path in routes:
+                    content_type, text = routes[self.path]()
+                    body = text.encode()
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+# Process-wide registry shared by the service and its helpers
+registry = Metrics()
@@ -0,0 +1,323 @@
+"""
+Local stand-in for the Spotify Web API and the image CDN.
+
+Replays a playback trace so the display service can be measured against
+reproducible sequences (skips, ads, episodes, 'unknown' types, 429s and
+outages) without a Spotify account or network access.
+
+A trace is a JSON document:
+
+    {
+      "name": "skips",
+      "duration": 20,
+      "events": [
+        {"at": 0,  "type": "track", "id": "t1", "title": "One", "artist": "A"},
+        {"at": 4,  "type": "ad"},
+        {"at": 6,  "type": "episode", "id": "e1", "title": "Talk", "show": "Pod"},
+        {"at": 9,  "type": "unknown"},
+        {"at": 10, "type": "none"},
+        {"at": 12, "type": "error", "status": 429, "retry_after": 1},
+        {"at": 14, "type": "error", "status": 503},
+        {"at": 16, "type": "raw", "payload": {...}}
+      ]
+    }
+
+Each event becomes the player state at 'at' seconds after the server starts
+and stays until the next event. With --stagger every access token sees the
+trace shifted by its own stable offset, so several accounts polling one
+server are not all playing the same track at the same time. 'raw' events serve a recorded
+currently-playing payload verbatim, except that album, show and episode
+image URLs point to this server's covers so a replay stays offline; use the
+'record' command to capture one from the real API. It authenticates with the
+service's token file (token_file in eink_options.ini, see tokenStore.py).
+
+Usage:
+    python mockSpotify.py serve trace.json [--port 8899] [--stagger 0]
+    python mockSpotify.py record trace.json [--config FILE] [--token-file FILE] [--duration 600]
+"""
+import argparse
+import bisect
+import colorsys
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from PIL import Image
+
+
+def _cover_color(cover_id: str) -> tuple:
+    """Derive a stable, saturated colour from a cover id."""
+    hue = int(hashlib.md5(cover_id.encode()).hexdigest()[:4], 16) / 0xffff
+    r, g, b = colorsys.hsv_to_rgb(hue, 0.8, 0.9)
+    return int(r * 255), int(g * 255), int(b * 255)
+
+
+class Trace:
+    """A sorted list of timed player states."""
+
+    def __init__(self, name: str, events: list, duration: float = None):
+        self.name = name
+        self.events = sorted(events, key=lambda e: e['at'])
+        self._times = [event['at'] for event in self.events]
+        last = self.events[-1]['at'] if self.events else 0
+        self.duration = duration if duration is not None else last + 10
+
+    @classmethod
+    def load(cls, path: str) -> 'Trace':
+        with open(path) as f:
+            data = json.load(f)
+        name = data.get('name', os.path.splitext(os.path.basename(path))[0])
+        return cls(name, data['events'], data.get('duration'))
+
+    def event_at(self, elapsed: float):
+        i = bisect.bisect_right(self._times, elapsed)
+        return self.events[i - 1] if i else None
+
+
+class MockSpotifyServer:
+    """
+    Serves a Trace on 127.0.0.1 and counts every request it answers.
+    """
+
+    def __init__(self, trace: Trace, port: int = 0, cover_size: int = 640, stagger: float = 0.0):
+        self.trace = trace
+        self.cover_size = cover_size
+        self.stagger = stagger
+        self.api_calls = 0
+        self.cover_calls = 0
+        self.started_at = None
+        self._covers = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    @property
+    def api_prefix(self) -> str:
+        return f'http://127.0.0.1:{self.port}/v1/'
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def elapsed(self, token: str = None) -> float:
+        """Seconds into the trace, shifted by a per-token offset when 'stagger' is set."""
+        elapsed = time.monotonic() - self.started_at
+        if self.stagger and token:
+            offset = int(hashlib.md5(token.encode()).hexdigest()[:8], 16) / 0xffffffff
+            elapsed += offset * self.stagger
+        return elapsed
+
+    def _cover_url(self, cover_id: str) -> str:
+        return f'http://127.0.0.1:{self.port}/covers/{cover_id}.jpg'
+
+    def _cover_bytes(self, cover_id: str) -> bytes:
+        with self._lock:
+            if cover_id not in self._covers:
+                img = Image.new('RGB', (self.cover_size, self.cover_size), _cover_color(cover_id))
+                buf = io.BytesIO()
+                img.save(buf, format='JPEG', quality=90)
+                self._covers[cover_id] = buf.getvalue()
+            return self._covers[cover_id]
+
+    def _offline(self, value):
+        """A copy of a recorded payload with every image URL replaced by one of this server's covers."""
+        if isinstance(value, list):
+            return [self._offline(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        copy = {k: self._offline(v) for k, v in value.items()}
+        if isinstance(copy.get('images'), list):
+            for image in copy['images']:
+                if isinstance(image, dict) and image.get('url'):
+                    # i.scdn.co/image/<id> keeps its id, so every cover gets its own colour
+                    cover_id = re.sub(r'[^A-Za-z0-9_-]', '', image['url'].rstrip('/').rsplit('/', 1)[-1])
+                    image['url'] = self._cover_url(cover_id or 'cover')
+        return copy
+
+    def payload_for(self, event: dict, elapsed: float = None) -> tuple:
+        """
+        Returns (status, body, headers) for the currently-playing endpoint.
+        """
+        if event is None or event['type'] == 'none':
+            return 204, None, {}
+        etype = event['type']
+        if etype == 'error':
+            headers = {}
+            if 'retry_after' in event:
+                headers['Retry-After'] = str(event['retry_after'])
+            return event.get('status', 503), {'error': {'status': event.get('status', 503)}}, headers
+        if etype == 'raw':
+            return 200, self._offline(event['payload']), {}
+
+        elapsed = self.elapsed() if elapsed is None else elapsed
+        progress_ms = int((elapsed - event['at']) * 1000)
+        body = {
+            'is_playing': True,
+            'progress_ms': progress_ms,
+            'currently_playing_type': etype,
+            'item': None,
+        }
+        if etype == 'track':
+            cover_id = event.get('cover', event['id'])
+            body['item'] = {
+                'id': event['id'],
+                'name': event.get('title', event['id']),
+                'duration_ms': event.get('duration_ms', 180000),
+                'artists': [{'name': a} for a in event.get('artist', 'Unknown').split(', ')],
+                'album': {'images': [{'url': self._cover_url(cover_id)}]},
+            }
+        elif etype == 'episode':
+            cover_id = event.get('cover', event['id'])
+            body['item'] = {
+                'id': event['id'],
+                'name': event.get('title', event['id']),
+                'duration_ms': event.get('duration_ms', 1800000),
+                'show': {'name': event.get('show', 'Unknown show')},
+                'images': [{'url': self._cover_url(cover_id)}],
+            }
+        return 200, body, {}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=None, headers=None, content_type='application/json'):
+                data = b''
+                if body is not None:
+                    data = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                if data:
+                    self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if data:
+                    self.wfile.write(data)
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path.startswith('/covers/'):
+                    with server._lock:
+                        server.cover_calls += 1
+                    cover_id = os.path.splitext(os.path.basename(path))[0]
+                    self._send(200, server._cover_bytes(cover_id), content_type='image/jpeg')
+                    return
+                if path in ('/v1/me/player/currently-playing', '/v1/me/player'):
+                    with server._lock:
+                        server.api_calls += 1
+                    token = self.headers.get('Authorization', '').replace('Bearer ', '', 1)
+                    elapsed = server.elapsed(token)
+                    self._send(*server.payload_for(server.trace.event_at(elapsed), elapsed))
+                    return
+                self._send(404, {'error': {'status': 404, 'message': 'not mocked'}})
+
+            def _control(self):
+                with server._lock:
+                    server.api_calls += 1
+                self._send(204)
+
+            do_PUT = _control
+            do_POST = _control
+
+        return Handler
+
+
+def record(path: str, token_file: str, duration: float, interval: float = 1.0, refresh_margin: float = 600.0):
+    """
+    Polls the real API and writes every change of the currently-playing
+    payload as a 'raw' event.
+    """
+    import spotipy
+    from tokenStore import TokenStore
+
+    # The same file-locked token the services use, refreshed the same way
+    token_store = TokenStore(token_file, refresh_margin=refresh_margin)
+    events = []
+    last = None
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        token = token_store.access_token()
+        if token is None:
+            sys.exit(f'No usable token in {token_file}, run generateToken.py once to authorize')
+        at = round(time.monotonic() - start, 3)
+        try:
+            result = spotipy.Spotify(auth=token).currently_playing(additional_types='episode')
+        except spotipy.exceptions.SpotifyException as e:
+            event = {'type': 'error', 'status': e.http_status}
+        else:
+            event = {'type': 'raw', 'payload': result} if result else {'type': 'none'}
+        # progress_ms changes on every poll, so only item/type changes are kept
+        payload = event.get('payload') or {}
+        key = (event['type'], event.get('status'), payload.get('currently_playing_type'),
+               (payload.get('item') or {}).get('id'))
+        if key != last:
+            events.append(dict(event, at=at))
+            last = key
+            print(f'{at:8.2f}s {event["type"]}')
+        time.sleep(interval)
+    with open(path, 'w') as f:
+        json.dump({'name': os.path.splitext(os.path.basename(path))[0],
+                   'duration': duration, 'events': events}, f, indent=1, default=str)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Spotify Web API / CDN stand-in')
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve_p = sub.add_parser('serve', help='replay a trace')
+    serve_p.add_argument('trace')
+    serve_p.add_argument('--port', type=int, default=8899)
+    serve_p.add_argument('--stagger', type=float, default=0.0,
+                         help='shift the trace by up to this many seconds per access token')
+    rec_p = sub.add_parser('record', help='record a trace from the real API')
+    rec_p.add_argument('trace')
+    rec_p.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                                        'config', 'eink_options.ini'))
+    rec_p.add_argument('--token-file', help="default: the config's token_file")
+    rec_p.add_argument('--duration', type=float, default=600)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        import configparser
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        token_file = args.token_file or config.get('DEFAULT', 'token_file', fallback=None)
+        if not token_file:
+            parser.error(f'No token_file in {args.config}, pass --token-file')
+        record(args.trace, token_file, args.duration,
+               refresh_margin=config.getfloat('DEFAULT', 'token_refresh_margin', fallback=600.0))
+        return
+
+    server = MockSpotifyServer(Trace.load(args.trace), port=args.port, stagger=args.stagger)
+    server.start()
+    print(f'Serving {server.trace.name} at {server.api_prefix}', flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
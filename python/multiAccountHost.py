@@ -0,0 +1,344 @@
+"""
+Runs the displays of several Spotify accounts from one process.
+
+Every [account:<name>] section of eink_options.ini is one user session with
+its own token and polling schedule driving its own panel. The section needs
+'username' and 'token_file' and can override any [DEFAULT] option for that
+display (model, width, fonts, ...) plus:
+    poll_interval = 1        ; seconds between polls while a song is playing
+    idle_poll_interval = 5   ; seconds between polls while idle
+
+The sessions are asyncio tasks. Spotify calls and cover downloads run on a
+small shared thread pool over one pooled requests.Session, covers are kept in
+one shared cache (an album is downloaded once however many accounts play it)
+and frames are rendered by one shared render executor, a process pool when
+render_workers > 1.
+
+Usage:
+    python multiAccountHost.py [--config eink_options.ini]
+"""
+import argparse
+import asyncio
+import configparser
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+
+from admissionPolicy import AdmissionPolicy
+from metrics import registry as metrics, MetricsServer
+from panel import Panel
+from panelRenderer import pyramid_cache, render_frame, frame_from_payload
+from resourceManager import BoundedCache, ResourceManager
+from serviceLogging import setup_logging
+from spotipiEinkDisplay import song_from_playback
+from tokenStore import TokenStore
+
+SCOPE = 'user-read-currently-playing,user-modify-playback-state'
+
+
+class CoverCache:
+    """
+    LRU cache of encoded cover images shared by all sessions. Concurrent
+    requests for the same URL wait for one download.
+    """
+
+    def __init__(self, host, capacity: int = 64, max_bytes: int = 0):
+        self.host = host
+        self.covers = BoundedCache(max_items=capacity, max_bytes=max_bytes)
+        self._pending = {}
+
+    async def get(self, url: str) -> bytes:
+        cover = self.covers.get(url)
+        if cover is not None:
+            metrics.inc('cover_cache_hits')
+            return cover
+        pending = self._pending.get(url)
+        if pending is None:
+            pending = self._pending[url] = asyncio.ensure_future(self._fetch(url))
+        try:
+            return await asyncio.shield(pending)
+        finally:
+            self._pending.pop(url, None)
+
+    async def _fetch(self, url: str) -> bytes:
+        with metrics.span('fetch'):
+            resp = await self.host.run_io(self.host.http.get, url, timeout=10)
+            resp.raise_for_status()
+        metrics.inc('cover_fetches')
+        self.covers.put(url, resp.content)
+        return resp.content
+
+
+class AccountSession:
+    """One Spotify account and the panel it drives."""
+
+    def __init__(self, host, name: str, settings):
+        self.host = host
+        self.name = name
+        self.settings = settings
+        self.logger = host.logger
+        self.username = settings.get('username')
+        self.token_file = settings.get('token_file')
+        self.token_store = TokenStore(self.token_file, scope=SCOPE,
+                                      refresh_margin=settings.getfloat('token_refresh_margin', fallback=600.0))
+        self.poll_interval = settings.getfloat('poll_interval', fallback=1.0)
+        self.idle_poll_interval = settings.getfloat('idle_poll_interval', fallback=5.0)
+        self.idle_display_time = settings.getint('idle_display_time', fallback=300)
+        self.idle_shuffle = settings.getboolean('idle_shuffle', fallback=False)
+        self.idle_index = 0
+        self.panel = Panel(name, settings, host.logger, metrics)
+        self.song_prev = ''
+        self.idle_shown_at = None
+        self.admission = AdmissionPolicy.from_settings(settings, metrics)
+        self.playback = None
+
+    async def run(self):
+        # Spread the first polls so the sessions do not hit the API in lockstep
+        await self.host.wait_stopped(random.uniform(0, self.poll_interval))
+        self.panel.clean()
+        while not self.host.stopping:
+            wait = self.poll_interval
+            try:
+                song_request = await self._get_song_info()
+                if song_request:
+                    self.admission.playing()
+                    new_song_key = song_request[0] + song_request[1]
+                    if self.song_prev != new_song_key and self._admit(song_request, new_song_key):
+                        self.logger.info(f"[{self.name}] New song detected: {song_request[0]} by {song_request[2]}")
+                        self.song_prev = new_song_key
+                        await self._display_update_process(song_request)
+                elif self.admission.admit_idle():
+                    now = asyncio.get_running_loop().time()
+                    if self.song_prev != 'NO_SONG' or now - self.idle_shown_at >= self.idle_display_time:
+                        self.logger.info(f"[{self.name}] No track detected - switching to idle image.")
+                        self.song_prev = 'NO_SONG'
+                        self.idle_shown_at = now
+                        await self._display_update_process([])
+                    wait = self.idle_poll_interval
+            except Exception as e:
+                self.logger.error(f"[{self.name}] Error in session loop: {e}")
+                self.logger.error(traceback.format_exc())
+            await self.host.wait_stopped(wait)
+
+    def _admit(self, song_request: list, song_key: str) -> bool:
+        playback = self.playback or {}
+        item = playback.get('item') or {}
+        decision = self.admission.decide(song_key, playback.get('progress_ms'), item.get('duration_ms'),
+                                         label=f'[{self.name}] {song_request[0]} by {song_request[2]}')
+        return decision == 'show'
+
+    async def _get_song_info(self) -> list:
+        """
+        Returns [song_title, cover_url, artist] or [] if no track.
+        """
+        token = await self.host.run_io(self.token_store.access_token)
+        if not token:
+            self.logger.error(f"[{self.name}] Error: Can't get token for {self.username}")
+            return []
+        sp = spotipy.Spotify(auth=token, requests_session=self.host.http)
+        api_prefix = self.settings.get('spotify_api_prefix', fallback=None)
+        if api_prefix:
+            sp.prefix = api_prefix
+        for _ in range(10):
+            metrics.inc('api_calls')
+            try:
+                with metrics.span('poll'):
+                    result = await self.host.run_io(sp.currently_playing, additional_types='episode')
+            except Exception:
+                metrics.inc('api_errors')
+                raise
+            self.playback = result
+            if not result:
+                # None -> no track playing
+                return []
+            try:
+                song_request = song_from_playback(result, self.logger)
+            except TypeError:
+                self.logger.error(f"[{self.name}] TypeError from Spotipy, retrying...")
+                song_request = None
+            if song_request is not None:
+                return song_request
+            await asyncio.sleep(0.01)
+        return []
+
+    def _get_idle_image_path(self) -> str:
+        images = self.host.idle_images
+        if not images:
+            return self.host.default_idle_image
+        if self.idle_shuffle:
+            return random.choice(images)
+        img_path = images[self.idle_index % len(images)]
+        self.idle_index = (self.idle_index + 1) % len(images)
+        return img_path
+
+    async def _display_update_process(self, song_request: list):
+        if song_request:
+            title, artist, show_small_cover = song_request[0], song_request[2], True
+            try:
+                source = await self.host.covers.get(song_request[1])
+            except Exception as e:
+                self.logger.error(f"[{self.name}] Failed to fetch album cover: {e}")
+                source = self.host.read_image(self.host.default_idle_image)
+            expected_idle = None
+        else:
+            title, artist, show_small_cover = "", "", False
+            source = self.host.read_image(self._get_idle_image_path())
+            expected_idle = self.idle_display_time
+
+        with metrics.span('render'):
+            payload = await self.host.run_render(render_frame, self.host.config_file, self.panel.section, source,
+                                                 artist, title, show_small_cover, self.host.default_idle_image)
+        for stage, seconds in payload['timings'].items():
+            metrics.observe(stage, seconds)
+        # Hashing the frame and its transition cost take a few milliseconds, off the event loop
+        await self.host.run_io(lambda: self.panel.update(frame_from_payload(payload), expected_idle))
+
+
+class MultiAccountHost:
+    def __init__(self, config_file: str = None):
+        self.config = configparser.ConfigParser()
+        if config_file is None:
+            config_file = os.path.join(os.path.dirname(__file__), '..', 'config', 'eink_options.ini')
+        self.config.read(config_file)
+        self.config_file = os.path.abspath(config_file)
+        self.logger = setup_logging(self.config)
+        defaults = self.config['DEFAULT']
+
+        self.default_idle_image = defaults.get('no_song_cover')
+        self.idle_images = self._load_idle_images()
+        self._images = {}
+
+        accounts = [name for name in self.config.sections() if name.startswith('account:')]
+        if not accounts:
+            raise ValueError(f'No [account:<name>] sections in {config_file}')
+
+        # Shared HTTP: one connection pool and a few threads for the blocking calls
+        io_workers = defaults.getint('io_workers', fallback=min(32, 4 + len(accounts)))
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=io_workers)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        self._io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='host-io')
+
+        # Shared render engine: one worker process per core, or one thread
+        render_workers = defaults.getint('render_workers', fallback=os.cpu_count() or 1)
+        if render_workers > 1:
+            self._render_pool = ProcessPoolExecutor(max_workers=render_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='host-render')
+
+        cover_cache_bytes = defaults.getint('cover_cache_mb', fallback=32) * 2 ** 20
+        self.covers = CoverCache(self, capacity=defaults.getint('cover_cache_size', fallback=64),
+                                 max_bytes=cover_cache_bytes)
+        pyramid_cache.max_bytes = cover_cache_bytes
+        self.sessions = [AccountSession(self, name.split(':', 1)[1], self.config[name]) for name in accounts]
+        self.metrics_server = MetricsServer(
+            metrics,
+            port=defaults.getint('metrics_port', fallback=0),
+            snapshot_path=defaults.get('metrics_snapshot', fallback=None) or None,
+            snapshot_interval=defaults.getfloat('metrics_snapshot_interval', fallback=60.0)
+        )
+        self.resources = ResourceManager(
+            metrics,
+            interval=defaults.getfloat('resource_interval', fallback=60.0),
+            rss_budget=defaults.getint('memory_budget_mb', fallback=0) * 2 ** 20
+        )
+        self.resources.register_cache('encoded_covers', self.covers.covers)
+        self.resources.register_cache('covers', pyramid_cache)
+        self.metrics_server.add_route('/debug/tracemalloc',
+                                      lambda: ('text/plain', self.resources.tracemalloc_report()))
+        self.stopping = False
+        self._stop_event = None
+        self._loop = None
+        self.logger.info(f'Host created for {len(self.sessions)} accounts, '
+                         f'{io_workers} I/O threads, {render_workers} render workers')
+
+    def _load_idle_images(self) -> list:
+        idle_folder = os.path.join(os.path.dirname(__file__), '..', 'config', 'idle_images')
+        if not os.path.isdir(idle_folder):
+            return []
+        return sorted(os.path.join(idle_folder, f) for f in os.listdir(idle_folder)
+                      if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+
+    def read_image(self, path: str) -> bytes:
+        """Encoded bytes of a local image, read once."""
+        if path not in self._images:
+            with open(path, 'rb') as f:
+                self._images[path] = f.read()
+        return self._images[path]
+
+    async def run_io(self, func, *args, **kwargs):
+        return await self._loop.run_in_executor(self._io_pool, lambda: func(*args, **kwargs))
+
+    async def run_render(self, func, *args):
+        return await self._loop.run_in_executor(self._render_pool, func, *args)
+
+    async def wait_stopped(self, timeout: float) -> bool:
+        """Sleeps up to 'timeout' seconds, returning early (True) once the host is stopping."""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping
+
+    async def run(self, duration: float = None):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        if self.stopping:
+            self._stop_event.set()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(sig, self.stop)
+            except (ValueError, RuntimeError):
+                # Not the main thread (e.g. when driven by a benchmark)
+                pass
+        self.metrics_server.start()
+        self.resources.start()
+        self.logger.info('Host started')
+        tasks = [asyncio.ensure_future(session.run()) for session in self.sessions]
+        try:
+            if duration is not None:
+                await self.wait_stopped(duration)
+                self.stop()
+            await asyncio.gather(*tasks)
+        finally:
+            for session in self.sessions:
+                session.panel.display_driver.close()
+            self._render_pool.shutdown(cancel_futures=True)
+            self._io_pool.shutdown(cancel_futures=True)
+            self.http.close()
+            self.resources.stop()
+            self.metrics_server.stop()
+
+    def start(self, duration: float = None):
+        asyncio.run(self.run(duration))
+
+    def stop(self):
+        """Asks every session to return; safe to call from any thread."""
+        self.stopping = True
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the displays of several Spotify accounts')
+    parser.add_argument('--config', default=None, help='path of eink_options.ini')
+    args = parser.parse_args()
+    try:
+        MultiAccountHost(args.config).start()
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
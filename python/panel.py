@@ -0,0 +1,191 @@
+"""
+One physical (or virtual) display driven by the service.
+
+A Panel owns the backend of its model (see displayBackends.py), its
+DisplayDriver hardware thread and its own clean counter. Rendering is inherited from PanelRenderer
+and reads the panel's own configparser section, so every option in
+[DEFAULT] can be overridden per panel in a [panel:<name>] section.
+
+The panel library is imported on the first refresh rather than at start-up,
+and a frame identical to the one already on (or queued for) the panel is not
+sent again.
+"""
+import hashlib
+import traceback
+from concurrent.futures import Future
+from PIL import Image
+
+from cleanScheduler import CleanScheduler
+from displayBackends import backend_class
+from displayDriver import DisplayDriver, PowerManager
+from panelRenderer import PanelRenderer
+
+
+class Panel(PanelRenderer):
+    def __init__(self, name: str, settings, logger, metrics):
+        super().__init__(settings)
+        self.name = name
+        self.section = settings.name
+        self.logger = logger
+        self.metrics = metrics
+        self.model = self.settings.get('model', fallback='inky')
+
+        # ---------------------------------------------------------------------
+        # Display backend, it loads its library on the first refresh
+        # ---------------------------------------------------------------------
+        self.backend = backend_class(self.model)(self)
+        caps = self.capabilities()
+        width, height = self.settings.getint('width', fallback=640), self.settings.getint('height', fallback=400)
+        if caps.rotation in (90, 270):
+            width, height = height, width
+        if (width, height) != caps.size:
+            self.logger.warning(f'[{self.name}] {width}x{height} frames for a {caps.size[0]}x{caps.size[1]} '
+                                f'{self.model} panel, check width, height and rotation')
+
+        # Ghosting budget: cleans run in idle gaps, or before a frame once it is exhausted.
+        # A clean waits for an idle gap long enough for the clean and the redraw.
+        refresh_limit = self.settings.getfloat('display_refresh_counter', fallback=20)
+        self.clean_scheduler = CleanScheduler(
+            budget=refresh_limit,
+            hard_budget=self.settings.getfloat('clean_budget_max', fallback=refresh_limit * 2),
+            idle_after=self.settings.getfloat('clean_idle_after', fallback=caps.clean_s + caps.refresh_s),
+            quiet_hours=self.settings.get('clean_quiet_hours', fallback=''),
+            transition_stats=self.settings.getboolean('clean_transition_stats', fallback=False)
+        )
+        # Last frame queued (for the transition cost) and last frame shown (redrawn after an idle clean)
+        self._queued_frame = None
+        self._shown_frame = None
+
+        # Digest of the frame on the panel (None if unknown) and of the last one queued
+        self.frame_hash = None
+        self._queued_hash = None
+        # Called on the hardware thread whenever frame_hash changes
+        self.on_change = None
+
+        # ---------------------------------------------------------------------
+        # Panel refreshes run on a hardware thread, deep sleep is deferred
+        # ---------------------------------------------------------------------
+        self.display_driver = DisplayDriver(
+            show=self._display_frame,
+            clean=self._display_clean,
+            sleep=self._display_sleep,
+            power_manager=PowerManager(
+                sleep_after=self.settings.getfloat('display_sleep_after', fallback=120.0),
+                min_idle=self.settings.getfloat('display_sleep_min_idle', fallback=60.0)
+            ),
+            asynchronous=self.settings.getboolean('display_async', fallback=True),
+            idle_job=self._idle_clean,
+            idle_delay=self.clean_scheduler.idle_delay
+        )
+
+    def state(self) -> dict:
+        """What is needed to resume this panel after a restart."""
+        return {'model': self.model, 'frame_hash': self.frame_hash, 'ghosting': round(self.clean_scheduler.used, 3)}
+
+    def restore(self, state: dict):
+        if state.get('model') != self.model:
+            return
+        self.frame_hash = self._queued_hash = state.get('frame_hash')
+        self.clean_scheduler.used = state.get('ghosting', 0.0)
+
+    def clean(self) -> Future:
+        self._queued_hash = None
+        self._queued_frame = None
+        self.clean_scheduler.reset()
+        return self.display_driver.clean()
+
+    def update(self, frame: Image, expected_idle: float = None) -> Future:
+        """
+        Queues a rendered frame, cleaning the panel first every 'display_refresh_counter' pictures.
+        """
+        digest = frame_digest(frame)
+        if digest == self._queued_hash:
+            # The panel already shows (or is about to show) exactly this frame
+            future = Future()
+            future.set_result('unchanged')
+            return future
+
+        # Without the hardware thread there are no idle gaps to clean in
+        if self.clean_scheduler.exhausted or (self.clean_scheduler.due and not self.display_driver.asynchronous):
+            # No idle gap came along in time, clean in front of this frame
+            self.metrics.inc('forced_cleans')
+            self.clean()
+
+        self.clean_scheduler.record(self.clean_scheduler.frame_cost(self._queued_frame, frame))
+        self._queued_frame = frame
+        # Returns immediately, the refresh runs on the hardware thread
+        self._queued_hash = digest
+        return self.display_driver.show(frame, expected_idle=expected_idle)
+
+    def _idle_clean(self):
+        """
+        Runs on the hardware thread once the panel has been idle for a while
+        with a clean due: cleans and redraws the frame that was on screen,
+        unless a new frame was queued meanwhile, which is then shown instead.
+        """
+        self.logger.info(f'[{self.name}] Ghosting budget spent, cleaning while idle')
+        self.metrics.inc('idle_cleans')
+        frame = self._shown_frame
+        self.clean_scheduler.reset()
+        self._display_clean()
+        if self.display_driver.pending('show'):
+            # The queued frame is the refresh after the clean, redrawing the old one would only delay it
+            self.clean_scheduler.record(1.0)
+        elif frame is not None:
+            self.clean_scheduler.record(1.0)
+            self._display_frame(frame)
+
+    def _set_frame_hash(self, digest):
+        self.frame_hash = digest
+        if self.on_change is not None:
+            self.on_change()
+
+    def _display_clean(self):
+        """
+        Clears the display.
+        """
+        self.metrics.inc('cleans')
+        try:
+            self.backend.clean()
+        except Exception as e:
+            self.backend.reset()
+            self.logger.error(f'Display clean error: {e}')
+            self.logger.error(traceback.format_exc())
+        self._set_frame_hash(None)
+
+    def _display_sleep(self):
+        """
+        Puts the panel into deep sleep. Called by the DisplayDriver once the panel is expected to stay idle.
+        """
+        self.backend.sleep()
+
+    def _display_image(self, image: Image) -> bool:
+        """
+        Shows the Image on the panel. Returns False if that failed.
+        """
+        self.metrics.inc('refreshes')
+        try:
+            self.backend.show(image)
+        except Exception as e:
+            self.backend.reset()
+            self.logger.error(f'Display image error: {e}')
+            self.logger.error(traceback.format_exc())
+            return False
+        return True
+
+    def _display_frame(self, image: Image):
+        """
+        Runs on the display hardware thread for every frame handed to the DisplayDriver.
+        """
+        with self.metrics.span('display'):
+            shown = self._display_image(image)
+        # After a failed refresh the panel content is unknown
+        self._shown_frame = image if shown else None
+        self._set_frame_hash(frame_digest(image) if shown else None)
+        if not shown:
+            self._queued_hash = None
+
+
+def frame_digest(frame: Image) -> str:
+    return hashlib.blake2b(frame.tobytes(), digest_size=16,
+                           person=f'{frame.mode}{frame.size}'.encode()[:16]).hexdigest()
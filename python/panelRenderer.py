@@ -0,0 +1,248 @@
+"""
+Composition of the final panel image, independent of any display hardware.
+
+A PanelRenderer only needs the settings of one panel (a configparser section),
+so it can be created in a worker process: render_frame() is the entry point
+used by the service's process pool to render several panels in parallel.
+
+Covers are wrapped in a CoverPyramid, which keeps the resized and blurred
+intermediates of one cover so that every panel (and a repeated render of the
+same cover) starts from the nearest cached size instead of the full image.
+The layout itself is compiled from the settings into a RenderPlan, see
+renderPlan.py. Frames are turned and quantized to what the panel's backend
+declares (see displayBackends.py), so they leave the renderer ready to send.
+"""
+import configparser
+import hashlib
+import io
+import time
+from PIL import Image, ImageEnhance, ImageFilter
+
+from displayBackends import Capabilities, capabilities
+from renderPlan import RenderPlan, compile_plan
+from resourceManager import BoundedCache
+
+# Worker-process cache of renderers, keyed by (config_file, section)
+_worker_renderers = {}
+
+# Recently decoded covers, keyed by a digest of the encoded bytes; the byte
+# limit is set from cover_cache_mb by the service
+pyramid_cache = BoundedCache(max_items=4, max_bytes=32 * 2 ** 20, sizeof=lambda pyramid: pyramid.nbytes())
+
+
+class CoverPyramid:
+    """
+    A decoded cover, its 2x box-filter reductions and the fitted, resized and
+    blurred versions derived from it. Everything is computed on first use.
+    """
+
+    def __init__(self, image: Image):
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGB')
+        self.image = image
+        self.levels = [image]
+        self._cache = {}
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the decoded levels and cached results."""
+        images = self.levels + list(self._cache.values())
+        return sum(image.width * image.height * len(image.getbands()) for image in images)
+
+    def _level_for(self, width: float, height: float) -> Image:
+        """
+        Smallest reduction that is still at least twice 'width' x 'height',
+        so the final resample keeps the quality of one from the full image.
+        """
+        i = 0
+        while self.levels[i].width >= width * 4 and self.levels[i].height >= height * 4:
+            if i + 1 == len(self.levels):
+                self.levels.append(self.levels[i].reduce(2))
+            i += 1
+        return self.levels[i]
+
+    def fit(self, size: tuple) -> Image:
+        """Same crop as ImageOps.fit(image, size, centering=(0.0, 0.0))."""
+        key = ('fit', size)
+        if key not in self._cache:
+            src_w, src_h = self.image.size
+            if src_w / src_h >= size[0] / size[1]:
+                crop_w, crop_h = size[0] / size[1] * src_h, src_h
+            else:
+                crop_w, crop_h = src_w, src_w * size[1] / size[0]
+            level = self._level_for(size[0] * src_w / crop_w, size[1] * src_h / crop_h)
+            box = (0, 0, crop_w * level.width / src_w, crop_h * level.height / src_h)
+            self._cache[key] = level.resize(size, Image.BICUBIC, box=box)
+        return self._cache[key]
+
+    def resized(self, size: tuple) -> Image:
+        key = ('resize', size)
+        if key not in self._cache:
+            self._cache[key] = self._level_for(*size).resize(size, Image.LANCZOS)
+        return self._cache[key]
+
+    def blurred_fit(self, size: tuple, radius: float) -> Image:
+        """
+        fit(size) with a Gaussian blur. Large radii are blurred at a reduced
+        resolution and upsampled, which looks the same at a fraction of the cost.
+        """
+        key = ('blur', size, radius)
+        if key not in self._cache:
+            factor = 1
+            while factor < 8 and radius / (factor * 2) >= 2:
+                factor *= 2
+            if factor == 1:
+                blurred = self.fit(size).filter(ImageFilter.GaussianBlur(radius))
+            else:
+                small = self.fit((max(1, size[0] // factor), max(1, size[1] // factor)))
+                blurred = small.filter(ImageFilter.GaussianBlur(radius / factor)).resize(size, Image.BILINEAR)
+            self._cache[key] = blurred
+        return self._cache[key]
+
+    def tiled(self, size: tuple, radius: float = 0) -> Image:
+        """The cover repeated from the top left corner to fill 'size', optionally blurred."""
+        key = ('tile', size, radius)
+        if key not in self._cache:
+            tile_w, tile_h = self.image.size
+            # One row of tiles, then that row repeated downwards
+            row = Image.new('RGB', (size[0], tile_h))
+            for x in range(0, size[0], tile_w):
+                row.paste(self.image, (x, 0))
+            tiled = Image.new('RGB', size)
+            for y in range(0, size[1], tile_h):
+                tiled.paste(row, (0, y))
+            if radius:
+                tiled = tiled.filter(ImageFilter.GaussianBlur(radius))
+            self._cache[key] = tiled
+        return self._cache[key]
+
+
+def cover_pyramid(source: bytes, fallback_path: str = None) -> CoverPyramid:
+    """
+    Decodes encoded image bytes into a CoverPyramid, reusing the last few
+    covers. Falls back to the image at 'fallback_path' if decoding fails.
+    """
+    key = hashlib.blake2b(source, digest_size=16).digest()
+    pyramid = pyramid_cache.get(key)
+    if pyramid is not None:
+        return pyramid
+    try:
+        with Image.open(io.BytesIO(source)) as image:
+            image.load()
+    except Exception:
+        if not fallback_path:
+            raise
+        with Image.open(fallback_path) as image:
+            image.load()
+    pyramid = CoverPyramid(image)
+    pyramid_cache.put(key, pyramid)
+    return pyramid
+
+
+class PanelRenderer:
+    def __init__(self, settings):
+        # settings: configparser section of this panel ([DEFAULT] or [panel:<name>])
+        self.settings = settings
+        self._plan = None
+        self._capabilities = None
+        self._plan_snapshot = None
+
+    def render(self, cover, artist: str, title: str, show_small_cover: bool, timings: dict = None) -> Image:
+        """
+        Composes the frame from a CoverPyramid (or an Image), turns it into
+        the panel's orientation and quantizes it to the panel's palette.
+        Stage durations are added to 'timings' when given.
+        """
+        if not isinstance(cover, CoverPyramid):
+            cover = CoverPyramid(cover)
+        start = time.perf_counter()
+        frame = self._gen_pic(cover, artist=artist, title=title, show_small_cover=show_small_cover)
+        if timings is not None:
+            timings['gen_pic'] = time.perf_counter() - start
+        caps = self.capabilities()
+        frame = caps.orient(frame)
+        if caps.palette:
+            start = time.perf_counter()
+            frame = self.quantize(frame)
+            if timings is not None:
+                timings['quantize'] = time.perf_counter() - start
+        return frame
+
+    def quantize(self, img: Image) -> Image:
+        """
+        Converts an Image to the panel's palette ('P' mode, index = value sent to the panel).
+        """
+        caps = self.capabilities()
+        palette = caps.palette
+        if caps.boost != 1.0:
+            img = ImageEnhance.Color(img).enhance(caps.boost)
+        dither_mode = self.settings.get('dither_mode', fallback='pillow')
+        if dither_mode != 'pillow':
+            # NumPy engine with Lab colour matching, see dither.py
+            import dither
+            return dither.to_image(dither.dither(img, palette, dither_mode), palette)
+        palette_image = Image.new('P', (1, 1))
+        palette_image.putpalette([v for colour in palette for v in colour] + [0, 0, 0] * 248)
+        img.load()
+        palette_image.load()
+        im = img.im.convert('P', True, palette_image.im)
+        return img._new(im)
+
+    def _gen_pic(self, cover: CoverPyramid, artist: str, title: str, show_small_cover: bool) -> Image:
+        """
+        Generates the final composite image with the album artwork (or idle image),
+        background blur (if configured), and optional text (title/artist).
+        'show_small_cover' controls whether we paste a small overlay of the cover.
+        """
+        return self.plan().execute(cover, artist, title, show_small_cover)
+
+    def plan(self) -> RenderPlan:
+        """The compiled layout, rebuilt only when the settings change."""
+        self._compile()
+        return self._plan
+
+    def capabilities(self) -> Capabilities:
+        """What the panel's backend declares, looked up again only when the settings change."""
+        self._compile()
+        return self._capabilities
+
+    def _compile(self):
+        snapshot = tuple(self.settings.items())
+        if snapshot != self._plan_snapshot:
+            self._plan = compile_plan(self.settings)
+            self._capabilities = capabilities(self.settings)
+            self._plan_snapshot = snapshot
+
+
+def render_frame(config_file: str, section: str, source: bytes, artist: str, title: str,
+                 show_small_cover: bool, fallback_path: str = None) -> dict:
+    """
+    Process-pool entry point: renders one panel from the encoded cover bytes
+    and returns a picklable frame payload (see frame_from_payload).
+    """
+    key = (config_file, section)
+    renderer = _worker_renderers.get(key)
+    if renderer is None:
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        renderer = _worker_renderers[key] = PanelRenderer(config[section])
+
+    timings = {}
+    start = time.perf_counter()
+    cover = cover_pyramid(source, fallback_path)
+    timings['decode'] = time.perf_counter() - start
+
+    frame = renderer.render(cover, artist, title, show_small_cover, timings)
+    return {
+        'mode': frame.mode,
+        'size': frame.size,
+        'data': frame.tobytes(),
+        'palette': frame.getpalette() if frame.mode == 'P' else None,
+        'timings': timings,
+    }
+
+
+def frame_from_payload(payload: dict) -> Image:
+    frame = Image.frombytes(payload['mode'], payload['size'], payload['data'])
+    if payload['palette']:
+        frame.putpalette(payload['palette'])
+    return frame
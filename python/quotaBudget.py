@@ -0,0 +1,238 @@
+"""
+Spotify Web API request budget shared by the display, button and token
+refresher services.
+
+All requests of the device draw from one token bucket: 'rate' requests per
+second with bursts of up to 'burst'. Each request has a priority class, and
+the lower classes have to leave part of the bucket untouched, so when the
+budget runs low the background requests wait first, then polling slows
+down, and a button press still goes through:
+
+    button      may empty the bucket
+    poll        leaves a quarter of 'burst'
+    background  (keep-alive, prefetch) leaves half of 'burst'
+
+When Spotify answers 429 the Retry-After time blocks every class in every
+process, instead of each service finding out with its own next request.
+
+The bucket lives in Redis when 'api_budget_redis' is set (shared by
+anything that can reach that server), otherwise in a small memory-mapped
+file in /dev/shm guarded by flock().
+
+Settings (in the [DEFAULT] section of eink_options.ini):
+    api_rate = 2               ; requests per second, 0 = no budget
+    api_burst = 10             ; requests that may be made at once
+    api_budget_redis =         ; e.g. redis://localhost:6379/0
+    api_budget_name = spotipi-api-budget
+"""
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+
+import fcntl
+
+logger = logging.getLogger('spotipy_logger')
+
+# Share of 'burst' that requests of each class must leave in the bucket
+PRIORITIES = {
+    'button': 0.0,
+    'poll': 0.25,
+    'background': 0.5,
+}
+
+_STATE = struct.Struct('ddd')  # tokens, updated at, blocked until
+
+# spotipy's reason when urllib3 gave up retrying, e.g. 'too many 503 error responses'
+_RETRIED_STATUS = re.compile(r'too many (\d{3}) error responses')
+
+_TAKE_SCRIPT = """
+local rate, burst, now, reserve = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'blocked')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+local blocked = tonumber(state[3]) or 0
+if now < blocked then
+    return {0, tostring(blocked - now)}
+end
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local ok, wait = 0, 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+    ok = 1
+else
+    wait = (1 + reserve - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+return {ok, tostring(wait)}
+"""
+
+_BLOCK_SCRIPT = """
+local blocked = tonumber(redis.call('HGET', KEYS[1], 'blocked')) or 0
+if tonumber(ARGV[1]) > blocked then
+    redis.call('HSET', KEYS[1], 'blocked', ARGV[1])
+    redis.call('EXPIRE', KEYS[1], 3600)
+end
+return 1
+"""
+
+
+def _take(state: tuple, rate: float, burst: float, now: float, reserve: float) -> tuple:
+    """Token bucket step: returns (new state, taken, seconds to wait)."""
+    tokens, updated, blocked = state
+    if updated == 0:
+        tokens, updated = burst, now
+    if now < blocked:
+        return (tokens, updated, blocked), False, blocked - now
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens - 1 >= reserve:
+        return (tokens - 1, now, blocked), True, 0.0
+    return (tokens, now, blocked), False, (1 + reserve - tokens) / rate
+
+
+class _SharedMemoryBucket:
+    def __init__(self, name: str):
+        folder = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = os.path.join(folder, name)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < _STATE.size:
+            os.ftruncate(self._fd, _STATE.size)
+        self._map = mmap.mmap(self._fd, _STATE.size)
+        self._lock = threading.Lock()
+
+    def _update(self, func):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state, *result = func(_STATE.unpack_from(self._map))
+                _STATE.pack_into(self._map, 0, *state)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return result
+
+    def take(self, rate: float, burst: float, now: float, reserve: float) -> tuple:
+        return tuple(self._update(lambda state: _take(state, rate, burst, now, reserve)))
+
+    def block(self, until: float):
+        self._update(lambda state: ((state[0], state[1], max(state[2], until)),))
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class _RedisBucket:
+    def __init__(self, url: str, name: str):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=1.0)
+        self.client.ping()
+        self.key = name
+        self._take = self.client.register_script(_TAKE_SCRIPT)
+        self._block = self.client.register_script(_BLOCK_SCRIPT)
+
+    def take(self, rate: float, burst: float, now: float, reserve: float) -> tuple:
+        ok, wait = self._take(keys=[self.key], args=[rate, burst, now, reserve])
+        return bool(int(ok)), float(wait)
+
+    def block(self, until: float):
+        self._block(keys=[self.key], args=[until])
+
+    def close(self):
+        self.client.close()
+
+
+class QuotaBudget:
+    def __init__(self, rate: float = 2.0, burst: float = 10.0, redis_url: str = None,
+                 name: str = 'spotipi-api-budget', metrics=None):
+        self.rate = rate
+        self.burst = burst
+        self.metrics = metrics
+        self._bucket = None
+        if not rate:
+            return
+        if redis_url:
+            try:
+                self._bucket = _RedisBucket(redis_url, name)
+            except Exception as e:
+                logger.warning(f'Redis at {redis_url} not available ({e}), using a shared memory budget')
+        if self._bucket is None:
+            self._bucket = _SharedMemoryBucket(name)
+
+    @classmethod
+    def from_config(cls, config, metrics=None) -> 'QuotaBudget':
+        return cls(rate=config.getfloat('DEFAULT', 'api_rate', fallback=2.0),
+                   burst=config.getfloat('DEFAULT', 'api_burst', fallback=10.0),
+                   redis_url=config.get('DEFAULT', 'api_budget_redis', fallback=None) or None,
+                   name=config.get('DEFAULT', 'api_budget_name', fallback='spotipi-api-budget'),
+                   metrics=metrics)
+
+    def acquire(self, priority: str = 'poll', timeout: float = None) -> bool:
+        """
+        Waits until a request of this priority class may be made. Returns
+        False if that takes longer than 'timeout'.
+        """
+        if self._bucket is None:
+            return True
+        reserve = PRIORITIES[priority] * self.burst
+        start = time.monotonic()
+        throttled = False
+        while True:
+            try:
+                ok, wait = self._bucket.take(self.rate, self.burst, time.time(), reserve)
+            except Exception as e:
+                # A broken budget backend must not stop the service
+                logger.error(f'API budget error: {e}')
+                return True
+            if ok:
+                waited = time.monotonic() - start
+                if self.metrics is not None and throttled:
+                    self.metrics.inc(f'budget_waits_{priority}')
+                    self.metrics.observe(f'budget_wait_{priority}', waited)
+                return True
+            if timeout is not None:
+                left = timeout - (time.monotonic() - start)
+                if left <= 0:
+                    if self.metrics is not None:
+                        self.metrics.inc(f'budget_denied_{priority}')
+                    return False
+                wait = min(wait, left)
+            # Short naps, so a higher class or a refill elsewhere is noticed
+            throttled = True
+            time.sleep(min(max(wait, 0.01), 1.0))
+
+    def penalize(self, retry_after: float):
+        """Blocks every request in every process for 'retry_after' seconds (after a 429)."""
+        if self._bucket is None:
+            return
+        logger.warning(f'Spotify rate limit hit, pausing API requests for {retry_after:.0f}s')
+        if self.metrics is not None:
+            self.metrics.inc('rate_limited')
+        try:
+            self._bucket.block(time.time() + retry_after)
+        except Exception as e:
+            logger.error(f'API budget error: {e}')
+
+    def note_error(self, error: Exception):
+        """Calls penalize() if 'error' is a spotipy 429 error."""
+        if getattr(error, 'http_status', None) != 429:
+            return
+        headers = getattr(error, 'headers', None) or {}
+        # spotipy also reports giving up on retries as a 429 without headers,
+        # with the status it retried in the reason: a 5xx outage is a plain error
+        retried = _RETRIED_STATUS.search(str(getattr(error, 'reason', None) or ''))
+        if 'Retry-After' not in headers and retried and retried.group(1) != '429':
+            return
+        try:
+            retry_after = float(headers.get('Retry-After', 5))
+        except (TypeError, ValueError):
+            retry_after = 5.0
+        self.penalize(retry_after)
+
+    def close(self):
+        if self._bucket is not None:
+            self._bucket.close()
@@ -0,0 +1,184 @@
+"""
+Layout of a panel frame, compiled once from the panel settings.
+
+compile_plan() turns a settings section into a RenderPlan: the background
+operation with its target size and blur radius, the rectangle of the small
+cover and the text blocks with their fonts, wrap width and anchor. Rendering
+a track only executes the plan; the settings are not parsed again and the
+fonts are not reloaded until the settings change.
+
+Layouts are declared in the two tables below, so a new background mode or
+text arrangement is an entry there rather than another branch in the render
+path:
+    BACKGROUNDS   background_mode -> CoverPyramid method producing the background
+    TEXT_LAYOUTS  text_direction  -> (anchor, order of the text blocks)
+"""
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+from resourceManager import BoundedCache
+
+
+def _fit_background(cover, size: tuple, radius: int) -> Image:
+    if cover.image.size == size:
+        return _crop_background(cover, size, radius)
+    # Cached per cover, copied because the text is drawn onto it
+    if radius:
+        return cover.blurred_fit(size, radius).copy()
+    return cover.fit(size).copy()
+
+
+def _repeat_background(cover, size: tuple, radius: int) -> Image:
+    return cover.tiled(size, radius).copy()
+
+
+def _crop_background(cover, size: tuple, radius: int) -> Image:
+    image = cover.image.crop((0, 0, size[0], size[1]))
+    if radius:
+        image = image.filter(ImageFilter.GaussianBlur(radius))
+    return image
+
+
+BACKGROUNDS = {
+    'fit': _fit_background,
+    'repeat': _repeat_background,
+}
+
+# 'top' blocks are stacked downwards from below the small cover, 'bottom'
+# blocks upwards from the bottom margin, each in the listed order
+TEXT_LAYOUTS = {
+    'top-down': ('top', ('title', 'artist')),
+    'bottom-up': ('bottom', ('artist', 'title')),
+}
+
+
+def break_lines(text, width: int, font: ImageFont, draw: ImageDraw):
+    """
+    Break a string into lines so that each line does not exceed 'width'.
+    A single word wider than 'width' gets a line of its own.
+    """
+    if not text:
+        return
+    if isinstance(text, str):
+        text = text.split()
+    lo = 0
+    hi = len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        t = ' '.join(text[:mid])
+        w = int(draw.textlength(text=t, font=font))
+        if w <= width:
+            lo = mid
+        else:
+            hi = mid - 1
+    lo = max(lo, 1)
+    t = ' '.join(text[:lo])
+    w = int(draw.textlength(text=t, font=font))
+    yield t, w
+    yield from break_lines(text[lo:], width, font, draw)
+
+
+class TextBlock:
+    def __init__(self, field: str, font: ImageFont, line_height: int):
+        self.field = field
+        self.font = font
+        self.line_height = line_height
+
+
+class RenderPlan:
+    def __init__(self, size: tuple, background, blur: int, small_cover: tuple, anchor: str,
+                 text_origin: int, text_x: int, text_width: int, shadow: int, blocks: list,
+                 text_color: str = 'white', shadow_color: str = 'black'):
+        self.size = size
+        self.background = background
+        self.blur = blur
+        # (x, y, side) of the small cover, None if it is disabled
+        self.small_cover = small_cover
+        self.anchor = anchor
+        self.text_origin = text_origin
+        self.text_x = text_x
+        self.text_width = text_width
+        self.shadow = shadow
+        self.blocks = blocks
+        self.text_color = text_color
+        self.shadow_color = shadow_color
+        # Wrapped lines of recent titles and artists, keyed by (field, text)
+        self._lines = BoundedCache(max_items=64)
+
+    def execute(self, cover, artist: str, title: str, show_small_cover: bool) -> Image:
+        image = self.background(cover, self.size, self.blur)
+        if show_small_cover and self.small_cover:
+            x, y, side = self.small_cover
+            image.paste(cover.resized((side, side)), (x, y))
+        if self.blocks:
+            self._draw_text(image, {'artist': artist, 'title': title})
+        return image
+
+    def _wrap(self, block: TextBlock, text: str, draw: ImageDraw) -> list:
+        key = (block.field, text)
+        lines = self._lines.get(key)
+        if lines is None:
+            lines = [t for t, _ in break_lines(text, self.text_width, block.font, draw)]
+            self._lines.put(key, lines)
+        return lines
+
+    def _draw_text(self, image: Image, texts: dict):
+        draw = ImageDraw.Draw(image)
+        y = self.text_origin
+        for block in self.blocks:
+            lines = self._wrap(block, texts[block.field], draw)
+            if self.anchor == 'bottom':
+                y -= len(lines) * block.line_height
+            line_y = y
+            for line in lines:
+                if self.shadow > 0:
+                    draw.text((self.text_x + self.shadow, line_y + self.shadow),
+                              line, font=block.font, fill=self.shadow_color)
+                draw.text((self.text_x, line_y), line, font=block.font, fill=self.text_color)
+                line_y += block.line_height
+            if self.anchor == 'top':
+                y = line_y
+
+
+def compile_plan(settings) -> RenderPlan:
+    """Builds the RenderPlan of a panel from its settings section."""
+    width = settings.getint('width')
+    height = settings.getint('height')
+    album_cover_small = settings.getboolean('album_cover_small')
+    album_cover_small_px = settings.getint('album_cover_small_px')
+    offset_px_left = settings.getint('offset_px_left')
+    offset_px_right = settings.getint('offset_px_right')
+    offset_px_top = settings.getint('offset_px_top')
+    offset_px_bottom = settings.getint('offset_px_bottom')
+    offset_text_px_shadow = settings.getint('offset_text_px_shadow', fallback=0)
+    background_blur = settings.getint('background_blur', fallback=0)
+
+    # Blur only if small artwork is enabled
+    blur = background_blur if album_cover_small and background_blur > 0 else 0
+    background = BACKGROUNDS.get(settings.get('background_mode', fallback='fit'), _crop_background)
+    small_cover = None
+    if album_cover_small:
+        small_cover = ((width - album_cover_small_px) // 2, offset_px_top, album_cover_small_px)
+
+    anchor, fields = TEXT_LAYOUTS.get(settings.get('text_direction', fallback='top-down'), (None, ()))
+    font_path = settings.get('font_path')
+    blocks = []
+    for field in fields:
+        font_size = settings.getint(f'font_size_{field}')
+        blocks.append(TextBlock(field, ImageFont.truetype(font_path, font_size), font_size))
+    if anchor == 'top':
+        text_origin = album_cover_small_px + offset_px_top + 10
+    else:
+        text_origin = height - offset_px_bottom
+
+    return RenderPlan(
+        size=(width, height),
+        background=background,
+        blur=blur,
+        small_cover=small_cover,
+        anchor=anchor,
+        text_origin=text_origin,
+        text_x=offset_px_left,
+        text_width=width - offset_px_left - offset_px_right - offset_text_px_shadow,
+        shadow=offset_text_px_shadow,
+        blocks=blocks,
+    )
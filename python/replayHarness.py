@@ -0,0 +1,280 @@
+"""
+Replays playback traces against SpotipiEinkDisplay.start() and reports
+track-change-to-pixels latency.
+
+Every scenario starts a fresh mockSpotify.MockSpotifyServer, points a
+SpotipiEinkDisplay (model = virtual) at it and lets the main loop run for the
+length of the trace. For each change of what should be on screen it reports:
+  - detection latency: trace change -> service starts the display update
+  - render latency:    update start  -> frame written to the panel
+plus the number of API calls and panel refreshes. Updates replaced by a newer
+frame before the panel got to them are counted as superseded; --refresh-s
+simulates the panel's refresh time so that effect becomes visible, and
+--panels drives several virtual panels from the one poller.
+
+Usage:
+    python replayHarness.py                     # all built-in scenarios
+    python replayHarness.py skips ads           # selected built-in scenarios
+    python replayHarness.py --trace my.json     # recorded or scripted trace
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from mockSpotify import MockSpotifyServer, Trace
+from spotipiEinkDisplay import SpotipiEinkDisplay
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SCENARIOS = {
+    'skips': [
+        {'at': 0, 'type': 'track', 'id': 's1', 'title': 'Opening', 'artist': 'Band'},
+        {'at': 3, 'type': 'track', 'id': 's2', 'title': 'Skipped', 'artist': 'Band'},
+        {'at': 4, 'type': 'track', 'id': 's3', 'title': 'Skipped Again', 'artist': 'Band'},
+        {'at': 5, 'type': 'track', 'id': 's4', 'title': 'Keeper', 'artist': 'Band'},
+        {'at': 12, 'type': 'track', 'id': 's5', 'title': 'Closer', 'artist': 'Band'},
+    ],
+    'ads': [
+        {'at': 0, 'type': 'track', 'id': 'a1', 'title': 'Before Ad', 'artist': 'Band'},
+        {'at': 4, 'type': 'ad'},
+        {'at': 8, 'type': 'track', 'id': 'a2', 'title': 'After Ad', 'artist': 'Band'},
+    ],
+    'episodes': [
+        {'at': 0, 'type': 'episode', 'id': 'e1', 'title': 'Episode One', 'show': 'Podcast'},
+        {'at': 5, 'type': 'track', 'id': 'e2', 'title': 'Intermission', 'artist': 'Band'},
+        {'at': 9, 'type': 'episode', 'id': 'e3', 'title': 'Episode Two', 'show': 'Podcast'},
+    ],
+    'unknown': [
+        {'at': 0, 'type': 'track', 'id': 'u1', 'title': 'Known', 'artist': 'Band'},
+        {'at': 4, 'type': 'unknown'},
+        {'at': 6, 'type': 'track', 'id': 'u2', 'title': 'Known Again', 'artist': 'Band'},
+    ],
+    'rate_limit': [
+        {'at': 0, 'type': 'track', 'id': 'r1', 'title': 'Before 429', 'artist': 'Band'},
+        {'at': 3, 'type': 'error', 'status': 429, 'retry_after': 2},
+        {'at': 6, 'type': 'track', 'id': 'r2', 'title': 'After 429', 'artist': 'Band'},
+    ],
+    'outage': [
+        {'at': 0, 'type': 'track', 'id': 'o1', 'title': 'Before Outage', 'artist': 'Band'},
+        {'at': 3, 'type': 'error', 'status': 503},
+        {'at': 9, 'type': 'track', 'id': 'o2', 'title': 'After Outage', 'artist': 'Band'},
+    ],
+}
+
+
+def _expected_screen(event: dict):
+    """
+    What the service should show for a trace event: ('song', id), 'idle',
+    or None when the event should not change the screen (API errors).
+    """
+    etype = event['type']
+    if etype == 'raw':
+        payload = event['payload'] or {}
+        etype = payload.get('currently_playing_type', 'unknown')
+        item = payload.get('item') or {}
+        if etype in ('track', 'episode'):
+            return ('song', item.get('id'))
+        return 'idle'
+    if etype in ('track', 'episode'):
+        return ('song', event['id'])
+    if etype == 'error':
+        return None
+    return 'idle'
+
+
+class HarnessDisplay(SpotipiEinkDisplay):
+    """SpotipiEinkDisplay that timestamps display updates and refreshes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.updates = []
+        self.refreshes = 0
+        self._cleans_at_start = self.metrics.counters.get('cleans', 0)
+
+    @property
+    def cleans(self) -> int:
+        return self.metrics.counters.get('cleans', 0) - self._cleans_at_start
+
+    def _display_update_process(self, song_request: list) -> list:
+        record = {'detected': time.monotonic(), 'song': bool(song_request), 'rendered': None}
+        self.updates.append(record)
+        futures = super()._display_update_process(song_request)
+        for future in futures:
+            future.add_done_callback(lambda f, record=record: self._on_refreshed(f, record))
+        return futures
+
+    def _on_refreshed(self, future, record: dict):
+        # Cancelled futures were replaced by a newer frame before the panel got to them
+        if future.cancelled():
+            return
+        if future.exception() is not None or future.result() != 'unchanged':
+            self.refreshes += 1
+        # With several panels the update counts as rendered once the last one is done
+        record['rendered'] = time.monotonic()
+
+
+def _write_config(workdir: str, server: MockSpotifyServer, idle_display_time: int, refresh_s: float,
+                  panels: int = 1) -> str:
+    token_file = os.path.join(workdir, '.cache')
+    with open(token_file, 'w') as f:
+        json.dump({
+            'access_token': 'mock-access-token',
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'expires_at': int(time.time()) + 24 * 3600,
+            'refresh_token': 'mock-refresh-token',
+            'scope': 'user-modify-playback-state user-read-currently-playing',
+        }, f)
+    config_file = os.path.join(workdir, 'eink_options.ini')
+    with open(config_file, 'w') as f:
+        f.write(f"""[DEFAULT]
+model = virtual
+virtual_output_dir = {os.path.join(workdir, 'frames')}
+virtual_refresh_s = {refresh_s}
+width = 640
+height = 400
+album_cover_small = False
+album_cover_small_px = 200
+display_refresh_counter = 20
+idle_mode = static
+idle_display_time = {idle_display_time}
+idle_shuffle = false
+username = harness
+token_file = {token_file}
+spotify_api_prefix = {server.api_prefix}
+spotipy_log =
+state_file = {os.path.join(workdir, 'state.json')}
+frame_cache_dir = {os.path.join(workdir, 'frame_cache')}
+frame_cache_mb = 64
+no_song_cover = {os.path.join(BASE_DIR, 'resources', 'default.jpg')}
+font_path = {os.path.join(BASE_DIR, 'resources', 'CircularStd-Bold.otf')}
+font_size_title = 45
+font_size_artist = 35
+offset_px_left = 20
+offset_px_right = 20
+offset_px_top = 0
+offset_px_bottom = 20
+offset_text_px_shadow = 4
+text_direction = bottom-up
+background_mode = fit
+admission = false
+idle_grace_polls = 1
+idle_grace_s = 0
+""")
+        if panels > 1:
+            # Virtual panels of two sizes, rendered in the process pool
+            for i in range(panels):
+                f.write(f"""
+[panel:virtual{i}]
+width = {640 if i % 2 == 0 else 600}
+height = {400 if i % 2 == 0 else 448}
+""")
+    return config_file
+
+
+def run_scenario(trace: Trace, idle_display_time: int = 10, verbose: bool = False, refresh_s: float = 0.0,
+                 panels: int = 1) -> dict:
+    for key, value in (('SPOTIPY_CLIENT_ID', 'mock-client'),
+                       ('SPOTIPY_CLIENT_SECRET', 'mock-secret'),
+                       ('SPOTIPY_REDIRECT_URI', 'http://127.0.0.1:8888/callback/spotify')):
+        os.environ.setdefault(key, value)
+
+    server = MockSpotifyServer(trace)
+    with tempfile.TemporaryDirectory(prefix='spotipi-replay-') as workdir:
+        config_file = _write_config(workdir, server, idle_display_time, refresh_s, panels)
+        service = HarnessDisplay(config_file=config_file)
+        if not verbose:
+            service.logger.setLevel(logging.WARNING)
+        server.start()
+        runner = threading.Thread(target=service.start, daemon=True)
+        runner.start()
+        time.sleep(trace.duration)
+        service.stop()
+        runner.join(timeout=idle_display_time + 2 * refresh_s + 10)
+        server.stop()
+
+    changes = []
+    previous = None
+    for event in trace.events:
+        screen = _expected_screen(event)
+        if screen is None or screen == previous:
+            continue
+        changes.append(server.started_at + event['at'])
+        previous = screen
+
+    detection, render, missed = [], [], 0
+    for i, changed_at in enumerate(changes):
+        next_change = changes[i + 1] if i + 1 < len(changes) else float('inf')
+        match = next((u for u in service.updates if changed_at <= u['detected'] < next_change), None)
+        if match is None:
+            missed += 1
+            continue
+        detection.append(match['detected'] - changed_at)
+        if match['rendered'] is not None:
+            render.append(match['rendered'] - match['detected'])
+
+    return {
+        'scenario': trace.name,
+        'changes': len(changes),
+        'missed': missed,
+        'superseded': sum(1 for u in service.updates if u['rendered'] is None),
+        'detect_mean': statistics.mean(detection) if detection else None,
+        'detect_max': max(detection) if detection else None,
+        'render_mean': statistics.mean(render) if render else None,
+        'render_max': max(render) if render else None,
+        'api_calls': server.api_calls,
+        'cover_fetches': server.cover_calls,
+        'refreshes': service.refreshes,
+        'cleans': service.cleans,
+    }
+
+
+def _fmt(value) -> str:
+    return '-' if value is None else f'{value:.2f}s'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay playback traces against the display service')
+    parser.add_argument('scenarios', nargs='*', help=f'built-in scenarios: {", ".join(SCENARIOS)}')
+    parser.add_argument('--trace', action='append', default=[], help='trace JSON file (repeatable)')
+    parser.add_argument('--idle-display-time', type=int, default=10)
+    parser.add_argument('--refresh-s', type=float, default=0.0, help='simulated panel refresh time')
+    parser.add_argument('--panels', type=int, default=1, help='number of virtual panels driven by one poller')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='keep the service log output')
+    args = parser.parse_args()
+
+    traces = [Trace.load(path) for path in args.trace]
+    names = args.scenarios or ([] if traces else list(SCENARIOS))
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+        traces.append(Trace(name, SCENARIOS[name]))
+
+    results = []
+    for trace in traces:
+        print(f'Running {trace.name} ({trace.duration:.0f}s)...', file=sys.stderr)
+        results.append(run_scenario(trace, args.idle_display_time, args.verbose, args.refresh_s, args.panels))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    header = f'{"scenario":<12}{"changes":>8}{"missed":>7}{"supers":>7}{"detect":>9}{"det max":>9}' \
+             f'{"render":>9}{"rnd max":>9}{"api":>6}{"covers":>7}{"refresh":>8}{"clean":>6}'
+    print(header)
+    for r in results:
+        print(f'{r["scenario"]:<12}{r["changes"]:>8}{r["missed"]:>7}{r["superseded"]:>7}'
+              f'{_fmt(r["detect_mean"]):>9}{_fmt(r["detect_max"]):>9}'
+              f'{_fmt(r["render_mean"]):>9}{_fmt(r["render_max"]):>9}'
+              f'{r["api_calls"]:>6}{r["cover_fetches"]:>7}{r["refreshes"]:>8}{r["cleans"]:>6}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Memory and file descriptor telemetry with cache budgets for long-running devices.
+
+The ResourceManager samples the process RSS, the number of open file
+descriptors and the size of every registered cache into gauges (see
+metrics.py) every 'interval' seconds, so a leak or a growing cache shows up
+on /metrics long before the OOM killer steps in. When the RSS goes over
+'rss_budget' the registered caches are shrunk to half their size.
+
+Caches are BoundedCache instances: LRU maps limited by entry count and by
+the bytes their values hold.
+
+The top tracemalloc allocations are served on demand by tracemalloc_report();
+the first call starts tracing, later calls show the largest allocation sites
+and what grew since the previous call.
+
+Settings (in the [DEFAULT] section of eink_options.ini):
+    resource_interval = 60     ; seconds between samples
+    memory_budget_mb = 0       ; RSS above which caches are shrunk, 0 = no limit
+    cover_cache_mb = 32        ; decoded covers kept for re-renders
+"""
+import gc
+import logging
+import os
+import threading
+import tracemalloc
+from collections import OrderedDict
+
+logger = logging.getLogger('spotipy_logger')
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process (the peak where /proc is not available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss is the peak, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds() -> int:
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return 0
+
+
+class BoundedCache:
+    """
+    LRU map limited to 'max_items' entries and 'max_bytes' (0 = unlimited).
+    Sizes are measured with 'sizeof' whenever they are needed, so values
+    that grow after they were stored are accounted for.
+    """
+
+    def __init__(self, max_items: int = 64, max_bytes: int = 0, sizeof=len):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            self._evict(self.max_bytes)
+
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(self._sizeof(value) for value in self._items.values())
+
+    def shrink(self, max_bytes: int) -> int:
+        """Evicts least recently used entries down to 'max_bytes'; returns the bytes freed."""
+        with self._lock:
+            return self._evict(max_bytes)
+
+    def _evict(self, max_bytes: int) -> int:
+        freed = 0
+        while len(self._items) > self.max_items:
+            freed += self._sizeof(self._items.popitem(last=False)[1])
+        if max_bytes:
+            total = sum(self._sizeof(value) for value in self._items.values())
+            # Keeps the newest entry even if it alone is over the limit
+            while total > max_bytes and len(self._items) > 1:
+                size = self._sizeof(self._items.popitem(last=False)[1])
+                total -= size
+                freed += size
+        return freed
+
+
+class ResourceManager:
+    def __init__(self, metrics, interval: float = 60.0, rss_budget: int = 0):
+        self.metrics = metrics
+        self.interval = interval
+        self.rss_budget = rss_budget
+        self.caches = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_snapshot = None
+
+    def register_cache(self, name: str, cache: BoundedCache):
+        self.caches[name] = cache
+
+    def sample(self) -> dict:
+        """Updates the resource gauges and returns them."""
+        sample = {'rss_bytes': rss_bytes(), 'open_fds': open_fds()}
+        for name, cache in self.caches.items():
+            sample[f'cache_{name}_bytes'] = cache.nbytes()
+            sample[f'cache_{name}_entries'] = len(cache)
+        for name, value in sample.items():
+            self.metrics.set_gauge(name, value)
+        return sample
+
+    def enforce(self, sample: dict):
+        """Shrinks every cache to half its size while the RSS is over budget."""
+        if not self.rss_budget or sample['rss_bytes'] <= self.rss_budget:
+            return
+        freed = sum(cache.shrink(cache.nbytes() // 2) for cache in self.caches.values())
+        gc.collect()
+        self.metrics.inc('budget_evictions')
+        logger.warning(f"RSS {sample['rss_bytes'] / 2 ** 20:.0f}MB over the "
+                       f"{self.rss_budget / 2 ** 20:.0f}MB budget, freed {freed / 2 ** 20:.1f}MB of caches")
+
+    def start(self):
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='resources', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.enforce(self.sample())
+            except Exception as e:
+                logger.error(f'Resource sampling error: {e}')
+
+    def tracemalloc_report(self, limit: int = 25) -> str:
+        """Top allocation sites by size, and the growth since the previous report."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._last_snapshot = tracemalloc.take_snapshot()
+            return 'tracemalloc started, request this page again for the top allocations\n'
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'traced {current / 2 ** 20:.1f}MB, peak {peak / 2 ** 20:.1f}MB', '', 'top allocations:']
+        lines += [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+        if self._last_snapshot is not None:
+            lines += ['', 'growth since the previous report:']
+            lines += [str(stat) for stat in snapshot.compare_to(self._last_snapshot, 'lineno')[:limit]]
+        self._last_snapshot = snapshot
+        return '\n'.join(lines) + '\n'
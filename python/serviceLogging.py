@@ -0,0 +1,170 @@
+"""
+SD-card friendly logging for the long-running services.
+
+Records are handed to a QueueHandler on the calling thread and written by a
+QueueListener thread, so the main loop never blocks on console or file I/O.
+The log file is fed through an in-RAM ring buffer that only reaches the SD
+card when an error is logged or the process shuts down, and identical
+messages repeated within a short window are collapsed into one line.
+
+Settings (all optional, in the [DEFAULT] section of eink_options.ini):
+    log_level = INFO                              ; level of the service logger
+    log_levels = root=WARNING, urllib3=WARNING    ; per-logger overrides
+    log_ring_size = 500                           ; records kept in RAM
+    log_max_bytes = 1048576                       ; log file rotation size
+    log_rate_limit = 60                           ; seconds to suppress repeated warnings and info, 0 = off
+"""
+import atexit
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+SERVICE_LOGGER = 'spotipy_logger'
+
+_listener = None
+_ring = None
+_lock = threading.Lock()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops a message identical to one emitted less than 'interval' seconds ago
+    and reports how many were dropped when it is next let through. Errors
+    always pass, so every failure and its traceback reaches the log file.
+    """
+
+    def __init__(self, interval: float = 60.0):
+        super().__init__()
+        self.interval = interval
+        self._seen = {}
+        # Called on every logging thread before the handler lock is taken
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.interval <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._seen.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self._seen[key] = (last, suppressed + 1)
+                return False
+            self._seen[key] = (now, 0)
+            if len(self._seen) > 1024:
+                # Forget keys that have been quiet for a full interval
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.interval}
+        if suppressed:
+            record.msg = f'{record.msg} (repeated {suppressed} more times)'
+        return True
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last 'capacity' records in RAM and writes them to 'target'
+    only when a record at 'flush_level' or above arrives, or on flush()/close().
+    """
+
+    def __init__(self, target: logging.Handler, capacity: int = 500, flush_level: int = logging.ERROR):
+        super().__init__()
+        self.target = target
+        self.flush_level = flush_level
+        self.buffer = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        self.buffer.append(record)
+        if record.levelno >= self.flush_level:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            while self.buffer:
+                self.target.handle(self.buffer.popleft())
+            self.target.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        self.target.close()
+        super().close()
+
+
+def _parse_levels(value: str) -> dict:
+    levels = {}
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        name = name.strip()
+        levels['' if name == 'root' else name] = level.strip().upper()
+    return levels
+
+
+def setup_logging(config, console_prefix: str = 'Spotipi eInk Display') -> logging.Logger:
+    """
+    Routes all logging through one background listener. Safe to call more
+    than once; later calls only re-apply the configured levels.
+    """
+    global _listener, _ring
+    section = config['DEFAULT']
+    with _lock:
+        if _listener is None:
+            console = logging.StreamHandler(sys.stdout)
+            console.setFormatter(logging.Formatter(f'{console_prefix} - %(message)s'))
+            handlers = [console]
+
+            log_file = section.get('spotipy_log', fallback=None)
+            if log_file:
+                file_handler = RotatingFileHandler(
+                    log_file,
+                    maxBytes=section.getint('log_max_bytes', fallback=1024 * 1024),
+                    backupCount=3,
+                    delay=True
+                )
+                file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s',
+                                                            datefmt='%Y-%m-%d %H:%M:%S'))
+                _ring = RingBufferHandler(file_handler, capacity=section.getint('log_ring_size', fallback=500))
+                handlers.append(_ring)
+
+            log_queue = queue.SimpleQueue()
+            queue_handler = QueueHandler(log_queue)
+            queue_handler.addFilter(RateLimitFilter(section.getfloat('log_rate_limit', fallback=60.0)))
+            root = logging.getLogger()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            root.addHandler(queue_handler)
+
+            _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+            _listener.start()
+            atexit.register(shutdown_logging)
+
+        logging.getLogger().setLevel(logging.INFO)
+        service_logger = logging.getLogger(SERVICE_LOGGER)
+        service_logger.setLevel(section.get('log_level', fallback='INFO').upper())
+        for name, level in _parse_levels(section.get('log_levels', fallback='')).items():
+            logging.getLogger(name).setLevel(level)
+    return service_logger
+
+
+def flush_logs():
+    """Writes the RAM ring buffer to the log file now."""
+    if _ring is not None:
+        _ring.flush()
+
+
+def shutdown_logging():
+    """Drains the queue and flushes the ring buffer; registered with atexit."""
+    global _listener, _ring
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+        if _ring is not None:
+            _ring.close()
+            _ring = None
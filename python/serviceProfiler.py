@@ -0,0 +1,203 @@
+"""
+On-demand profiling of the running service, triggered by signals.
+
+    kill -USR1 <pid>   starts a capture; it stops by itself after
+                       'profile_seconds', or on the next SIGUSR1
+    kill -USR2 <pid>   writes the current stack of every thread
+
+Two capture modes ('profile_mode'):
+    sample    every 'profile_interval_ms' the stacks of all threads are
+              sampled, so the DisplayDriver thread's SPI transfers and busy
+              waits show up next to the main loop. Written as collapsed
+              stacks (<thread>;<frame>;<frame> <count>), the input format of
+              flamegraph.pl and speedscope.
+    cprofile  deterministic cProfile of the main loop thread, written as a
+              .prof file (python -m pstats, snakeviz) plus a text summary.
+
+Until a signal arrives nothing runs but the two installed handlers.
+Results go to 'profile_dir' (default ../log) and the file names are logged.
+
+Settings (in the [DEFAULT] section of eink_options.ini):
+    profile_mode = sample
+    profile_seconds = 30
+    profile_interval_ms = 10
+    profile_dir = /home/spotipi/spotipi-eink/log
+"""
+import io
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+logger = logging.getLogger('spotipy_logger')
+
+
+class _Sampler:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = Counter()
+        self.count = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+            self.count += 1
+
+    def write(self, path: str) -> str:
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f'{stack} {count}\n')
+        # Innermost frames that were seen most often, for the log
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        top = ', '.join(f'{leaf} {count * 100 / max(1, self.count):.0f}%' for leaf, count in leaves.most_common(5))
+        return f'{self.count} samples, top frames: {top}'
+
+
+class _CProfile:
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        # Runs in the signal handler, that is in the main thread
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path: str) -> str:
+        import pstats
+        self.profile.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats('cumulative').print_stats(40)
+        with open(f'{os.path.splitext(path)[0]}.txt', 'w') as f:
+            f.write(summary.getvalue())
+        return f'{len(pstats.Stats(self.profile).stats)} functions profiled'
+
+
+class ServiceProfiler:
+    def __init__(self, directory: str, mode: str = 'sample', seconds: float = 30.0, interval: float = 0.01):
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError(f"Unknown profile_mode {mode!r}, expected 'sample' or 'cprofile'")
+        self.directory = directory
+        self.mode = mode
+        self.seconds = seconds
+        self.interval = interval
+        self._capture = None
+        self._timer = None
+        # Re-entrant: the handlers may interrupt the main thread while it holds it
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_config(cls, config) -> 'ServiceProfiler':
+        return cls(directory=config.get('DEFAULT', 'profile_dir',
+                                        fallback=os.path.join(os.path.dirname(__file__), '..', 'log')),
+                   mode=config.get('DEFAULT', 'profile_mode', fallback='sample'),
+                   seconds=config.getfloat('DEFAULT', 'profile_seconds', fallback=30.0),
+                   interval=config.getfloat('DEFAULT', 'profile_interval_ms', fallback=10.0) / 1000)
+
+    def install(self):
+        """Installs the SIGUSR1 and SIGUSR2 handlers; must be called from the main thread."""
+        signal.signal(signal.SIGUSR1, self._on_usr1)
+        signal.signal(signal.SIGUSR2, self._on_usr2)
+
+    def _path(self, prefix: str, suffix: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f'{prefix}-{time.strftime("%Y%m%d-%H%M%S")}{suffix}')
+
+    def _on_usr1(self, signum, frame):
+        if self._capture is None:
+            self.start()
+            return
+        # Stopped here, in the main thread that cProfile profiles; the file
+        # is written off the signal handler
+        capture = self._detach()
+        if capture is not None:
+            threading.Thread(target=self._write, args=(capture,), name='profiler-write', daemon=True).start()
+
+    def _on_usr2(self, signum, frame):
+        threading.Thread(target=self.dump_threads, name='profiler-write', daemon=True).start()
+
+    def start(self):
+        with self._lock:
+            if self._capture is not None:
+                return
+            self._capture = _Sampler(self.interval) if self.mode == 'sample' else _CProfile()
+            self._capture.start()
+            if self.mode == 'cprofile':
+                # cProfile must be disabled by the thread it profiles: the timer
+                # sends the signal again so the main thread's handler stops it
+                self._timer = threading.Timer(self.seconds, os.kill, (os.getpid(), signal.SIGUSR1))
+            else:
+                self._timer = threading.Timer(self.seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+        logger.info(f'Profiling ({self.mode}) for up to {self.seconds:.0f}s, send SIGUSR1 again to stop early')
+
+    def stop(self):
+        """Ends the capture and writes it (a cProfile capture only from the main thread)."""
+        capture = self._detach()
+        if capture is not None:
+            self._write(capture)
+
+    def _detach(self):
+        with self._lock:
+            capture, self._capture = self._capture, None
+            if capture is not None:
+                self._timer.cancel()
+                capture.stop()
+        return capture
+
+    def _write(self, capture):
+        try:
+            path = self._path('profile', '.folded' if isinstance(capture, _Sampler) else '.prof')
+            summary = capture.write(path)
+            logger.info(f'Profile written to {path}: {summary}')
+        except OSError as e:
+            logger.error(f'Could not write profile: {e}')
+
+    def dump_threads(self) -> str:
+        frames = sys._current_frames()
+        lines = []
+        for thread in threading.enumerate():
+            frame = frames.get(thread.ident)
+            if frame is None or thread.ident == threading.get_ident():
+                continue
+            lines.append(f'--- {thread.name} (daemon={thread.daemon})')
+            lines += [line.rstrip() for line in traceback.format_stack(frame)]
+            lines.append('')
+        try:
+            path = self._path('threads', '.txt')
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            logger.info(f'Thread stacks written to {path}')
+        except OSError as e:
+            logger.error(f'Could not write thread stacks: {e}')
+            path = None
+        return path
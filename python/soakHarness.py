@@ -0,0 +1,351 @@
+"""
+Runs the display service for simulated days or weeks under a virtual clock
+and checks that it stays within bounds.
+
+Leaks and drift only show up after days of playback: file descriptors of
+images that are never closed, handlers piling up on the loggers, caches or
+budgets that keep growing. The soak harness drives the unmodified
+SpotipiEinkDisplay.start() loop (model = virtual, display_async = false)
+against mockSpotify.MockSpotifyServer with a generated trace of listening
+sessions (albums with skipped tracks, ads, podcasts), idle nights, 503
+outages and 429s. time.time(), time.monotonic() and time.sleep() are
+replaced by a virtual clock, and every wait of the main loop advances that
+clock instead of sleeping, so a week passes in minutes.
+
+At the end of every simulated day it records the RSS, the open file
+descriptors and the refreshes and API calls of that day, and at the end it
+checks:
+    - RSS and file descriptors grew by no more than --max-rss-growth-mb and
+      --max-fd-growth after the first day
+    - no day had more refreshes than screen changes in the trace (+2)
+    - no day had more API calls than --max-api-calls (default: 20% above
+      one poll per idle poll interval, around the clock), and no day fewer
+      polls than half of one per poll delay (a stalled loop)
+    - the logging handlers are the same as after start-up
+    - no panel's ghosting budget (its clean counter) ran past the hard budget
+
+The exit status is 1 if any check failed.
+
+Usage:
+    python soakHarness.py                 # one simulated week
+    python soakHarness.py --days 28 --seed 7 --poll 5
+"""
+import argparse
+import configparser
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from mockSpotify import MockSpotifyServer, Trace
+from replayHarness import _expected_screen, _write_config
+from resourceManager import open_fds, rss_bytes
+from spotipiEinkDisplay import SpotipiEinkDisplay
+
+DAY = 24 * 3600
+IDLE_POLL_S = 5  # the idle wait of SpotipiEinkDisplay.start() polls every 5 seconds
+
+# (earliest start hour, latest end hour, chance of a listening session per day)
+SESSIONS = [(7, 9, 0.8), (12, 14, 0.4), (18, 23, 0.9)]
+
+
+class VirtualClock:
+    """
+    Replaces time.time, time.monotonic and time.sleep while installed. Both
+    clocks run on from the real ones, shifted by everything that was slept.
+    """
+
+    def __init__(self):
+        self._real = (time.time, time.monotonic, time.sleep)
+        self._offset = 0.0
+        self._lock = threading.Lock()
+
+    def time(self) -> float:
+        return self._real[0]() + self._offset
+
+    def monotonic(self) -> float:
+        return self._real[1]() + self._offset
+
+    def sleep(self, seconds: float):
+        with self._lock:
+            self._offset += max(0.0, seconds)
+
+    def install(self):
+        time.time, time.monotonic, time.sleep = self.time, self.monotonic, self.sleep
+
+    def uninstall(self):
+        time.time, time.monotonic, time.sleep = self._real
+
+
+class VirtualEvent:
+    """Stand-in for the service's stop event: wait() advances the clock and calls 'on_wait'."""
+
+    def __init__(self, clock: VirtualClock, on_wait):
+        self.clock = clock
+        self.on_wait = on_wait
+        self._flag = False
+
+    def is_set(self) -> bool:
+        return self._flag
+
+    def set(self):
+        self._flag = True
+
+    def clear(self):
+        self._flag = False
+
+    def wait(self, timeout: float = None) -> bool:
+        if not self._flag:
+            self.clock.sleep(timeout or 0)
+            self.on_wait()
+        return self._flag
+
+
+def _windows(events: list, windows: list) -> list:
+    """
+    Lays the error windows (start, end, event) over the playback events:
+    the error replaces the player state until 'end', then playback resumes
+    where it would have been.
+    """
+    for start, end, error in sorted(windows, key=lambda w: w[0]):
+        trace = Trace('base', events)
+        resume = trace.event_at(end)
+        events = [e for e in events if not start <= e['at'] < end]
+        events.append(dict(error, at=start))
+        events.append(dict(resume or {'type': 'none'}, at=end))
+    return events
+
+
+def soak_trace(days: int, seed: int) -> Trace:
+    rng = random.Random(seed)
+    albums = []
+    for a in range(60):
+        tracks = [f'Song {a}-{t}' for t in range(rng.randint(8, 14))]
+        albums.append((f'album{a}', f'Artist {a % 25}', tracks))
+
+    events = [{'at': 0, 'type': 'none'}]
+    windows = []
+    for day in range(days):
+        base = day * DAY
+        for first, last, chance in SESSIONS:
+            if rng.random() > chance:
+                continue
+            middle = (first + last) / 2
+            t = base + rng.uniform(first, middle) * 3600
+            end = base + rng.uniform(middle, last) * 3600
+            if rng.random() < 0.15:
+                while t < end:
+                    n = rng.randrange(200)
+                    events.append({'at': t, 'type': 'episode', 'id': f'episode{n}', 'title': f'Episode {n}',
+                                   'show': f'Show {n % 7}', 'cover': f'show{n % 7}'})
+                    t += rng.uniform(20, 50) * 60
+            else:
+                while t < end:
+                    cover, artist, tracks = rng.choice(albums)
+                    for i, title in enumerate(tracks):
+                        if t >= end:
+                            break
+                        if rng.random() < 0.06:
+                            events.append({'at': t, 'type': 'ad'})
+                            t += 30
+                        elif rng.random() < 0.02:
+                            events.append({'at': t, 'type': 'unknown'})
+                            t += 10
+                        length = rng.uniform(120, 330)
+                        if rng.random() < 0.12:
+                            length = rng.uniform(2, 30)  # skipped
+                        events.append({'at': t, 'type': 'track', 'id': f'{cover}-{i}', 'title': title,
+                                       'artist': artist, 'cover': cover, 'duration_ms': int(length * 1000)})
+                        t += length
+            events.append({'at': t, 'type': 'none'})
+        if rng.random() < 0.6:
+            start = base + rng.uniform(0, DAY - 3600)
+            windows.append((start, start + rng.uniform(60, 1800), {'type': 'error', 'status': 503}))
+        if rng.random() < 0.4:
+            start = base + rng.uniform(0, DAY - 3600)
+            retry_after = rng.randint(5, 120)
+            windows.append((start, start + retry_after,
+                            {'type': 'error', 'status': 429, 'retry_after': retry_after}))
+    return Trace(f'soak-{days}d-seed{seed}', _windows(events, windows), duration=days * DAY)
+
+
+def screen_changes(trace: Trace, days: int) -> list:
+    """Changes of what should be on screen, per day of the trace."""
+    changes = [0] * days
+    previous = None
+    for event in trace.events:
+        screen = _expected_screen(event)
+        if screen is None or screen == previous:
+            continue
+        day = int(event['at'] // DAY)
+        if day < days:
+            changes[day] += 1
+        previous = screen
+    return changes
+
+
+def _handlers() -> list:
+    return [id(h) for name in ('', 'spotipy_logger') for h in logging.getLogger(name).handlers]
+
+
+def run_soak(days: int, seed: int, poll: float, verbose: bool = False) -> dict:
+    for key, value in (('SPOTIPY_CLIENT_ID', 'mock-client'),
+                       ('SPOTIPY_CLIENT_SECRET', 'mock-secret'),
+                       ('SPOTIPY_REDIRECT_URI', 'http://127.0.0.1:8888/callback/spotify')):
+        os.environ.setdefault(key, value)
+
+    trace = soak_trace(days, seed)
+    expected = screen_changes(trace, days)
+    server = MockSpotifyServer(trace)
+    clock = VirtualClock()
+    samples = []
+
+    with tempfile.TemporaryDirectory(prefix='spotipi-soak-') as workdir:
+        config_file = _write_config(workdir, server, idle_display_time=600, refresh_s=0.0)
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        config['DEFAULT'].update({
+            'display_async': 'false',
+            # The scenarios of replayHarness.py are seconds long, real weeks are not
+            'admission': 'true',
+            # The budget's clock is virtual too, it must not be shared with a real service
+            'api_budget_name': f'spotipi-soak-{os.getpid()}',
+            'frame_cache_mb': '16',
+            'spotipy_log': os.path.join(workdir, 'soak.log'),
+            'log_level': 'INFO' if verbose else 'CRITICAL',
+            'log_levels': '' if verbose else 'root=CRITICAL, urllib3=CRITICAL',
+        })
+        with open(config_file, 'w') as f:
+            config.write(f)
+        service = SpotipiEinkDisplay(delay=poll, config_file=config_file)
+        metrics = service.metrics
+        handlers = _handlers()
+
+        clock.install()
+        try:
+            # The token must outlast the simulated weeks
+            with open(service.config.get('DEFAULT', 'token_file')) as f:
+                token = json.load(f)
+            token['expires_at'] = int(time.time()) + (days + 30) * DAY
+            with open(service.config.get('DEFAULT', 'token_file'), 'w') as f:
+                json.dump(token, f)
+
+            started = time.perf_counter()
+            last = {'counters': dict(metrics.counters), 'server_api': 0, 'server_covers': 0}
+
+            def on_wait():
+                while server.elapsed() >= (len(samples) + 1) * DAY and len(samples) < days:
+                    gc.collect()
+                    counters = dict(metrics.counters)
+
+                    def delta(name):
+                        return counters.get(name, 0) - last['counters'].get(name, 0)
+
+                    samples.append({
+                        'day': len(samples) + 1,
+                        'changes': expected[len(samples)],
+                        'refreshes': delta('refreshes'),
+                        'cleans': delta('cleans'),
+                        'polls': delta('api_calls'),
+                        'api_errors': delta('api_errors'),
+                        'api_calls': server.api_calls - last['server_api'],
+                        'cover_fetches': server.cover_calls - last['server_covers'],
+                        'rss_mb': rss_bytes() / 2 ** 20,
+                        'fds': open_fds(),
+                        'handlers': _handlers(),
+                    })
+                    last.update(counters=counters, server_api=server.api_calls, server_covers=server.cover_calls)
+                    print(f'day {len(samples)}/{days} done after {time.perf_counter() - started:.0f}s',
+                          file=sys.stderr)
+                if len(samples) >= days:
+                    service.stop()
+
+            service._stop_event = VirtualEvent(clock, on_wait)
+            server.start()
+            service.start()
+            server.stop()
+            ghosting = [(panel.name, panel.clean_scheduler.used, panel.clean_scheduler.hard_budget)
+                        for panel in service.panels]
+        finally:
+            clock.uninstall()
+            bucket_path = getattr(service.api_budget._bucket, 'path', None)
+            if bucket_path and os.path.exists(bucket_path):
+                os.remove(bucket_path)
+
+    return {'trace': trace.name, 'days': samples, 'handlers': handlers, 'ghosting': ghosting,
+            'seconds': time.perf_counter() - started}
+
+
+def check(result: dict, max_rss_growth_mb: float, max_fd_growth: int, max_api_calls: int,
+          min_polls: int) -> list:
+    failures = []
+    days = result['days']
+    baseline = days[0]
+    for day in days:
+        if day['refreshes'] > day['changes'] + 2:
+            failures.append(f'day {day["day"]}: {day["refreshes"]} refreshes for {day["changes"]} screen changes')
+        if day['api_calls'] > max_api_calls:
+            failures.append(f'day {day["day"]}: {day["api_calls"]} API calls, more than {max_api_calls}')
+        if day['polls'] < min_polls:
+            failures.append(f'day {day["day"]}: only {day["polls"]} polls, the loop stalled')
+        if day['handlers'] != result['handlers']:
+            failures.append(f'day {day["day"]}: logging handlers changed '
+                            f'({len(result["handlers"])} -> {len(day["handlers"])})')
+    rss_growth = max(day['rss_mb'] for day in days) - baseline['rss_mb']
+    if rss_growth > max_rss_growth_mb:
+        failures.append(f'RSS grew by {rss_growth:.1f} MB after day 1, more than {max_rss_growth_mb} MB')
+    fd_growth = max(day['fds'] for day in days) - baseline['fds']
+    if fd_growth > max_fd_growth:
+        failures.append(f'{fd_growth} more open file descriptors than after day 1')
+    for name, used, hard_budget in result['ghosting']:
+        if used > hard_budget:
+            failures.append(f'[{name}] ghosting budget at {used:.1f}, past its hard budget of {hard_budget:.1f}')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak the display service under a virtual clock')
+    parser.add_argument('--days', type=int, default=7, help='simulated days')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generated trace')
+    parser.add_argument('--poll', type=float, default=10.0, help='poll delay of the main loop, seconds')
+    parser.add_argument('--max-rss-growth-mb', type=float, default=16.0)
+    parser.add_argument('--max-fd-growth', type=int, default=4)
+    parser.add_argument('--max-api-calls', type=int, default=None, help='per simulated day')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='keep the service log output')
+    args = parser.parse_args()
+    if args.days < 1:
+        parser.error('--days must be at least 1')
+
+    max_api_calls = args.max_api_calls or int(1.2 * DAY / min(args.poll, IDLE_POLL_S))
+    result = run_soak(args.days, args.seed, args.poll, args.verbose)
+    min_polls = int(0.5 * DAY / max(args.poll, IDLE_POLL_S))
+    failures = check(result, args.max_rss_growth_mb, args.max_fd_growth, max_api_calls, min_polls)
+
+    if args.json:
+        for day in result['days']:
+            day['handlers'] = len(day['handlers'])
+        result['handlers'] = len(result['handlers'])
+        print(json.dumps(dict(result, failures=failures), indent=2))
+    else:
+        print(f'{result["trace"]}: {result["seconds"]:.0f}s for {args.days} simulated days')
+        print(f'{"day":>4}{"changes":>9}{"refresh":>9}{"clean":>7}{"polls":>7}{"errors":>8}'
+              f'{"api":>7}{"covers":>8}{"rss MB":>8}{"fds":>5}')
+        for day in result['days']:
+            print(f'{day["day"]:>4}{day["changes"]:>9}{day["refreshes"]:>9}{day["cleans"]:>7}{day["polls"]:>7}'
+                  f'{day["api_errors"]:>8}{day["api_calls"]:>7}{day["cover_fetches"]:>8}'
+                  f'{day["rss_mb"]:>8.1f}{day["fds"]:>5}')
+        for failure in failures:
+            print(f'FAIL {failure}')
+        if not failures:
+            print('All bounds held')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
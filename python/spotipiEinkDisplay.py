@@ -1,16 +1,25 @@
 import time
+# Start of the process for the time_to_first_poll metric, taken before the other imports
+STARTED_AT = time.monotonic()
 import sys
-import logging
-from logging.handlers import RotatingFileHandler
-import spotipy
-import spotipy.util as util
 import os
 import traceback
 import configparser
-import requests
 import signal
 import random
-from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageEnhance, ImageFilter
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from metrics import registry as metrics, MetricsServer
+from serviceLogging import setup_logging
+from serviceProfiler import ServiceProfiler
+from panel import Panel
+from displayState import DisplayState
+from frameCache import FrameCache, file_cover_id
+from panelRenderer import cover_pyramid, pyramid_cache, render_frame, frame_from_payload
+from admissionPolicy import AdmissionPolicy
+from quotaBudget import QuotaBudget
+from resourceManager import ResourceManager
 
 # Recursion limiter to avoid infinite loops in _get_song_info()
 def limit_recursion(limit):
@@ -18,24 +27,65 @@ def limit_recursion(limit):
         func.count = 0
         def wrapper(*args, **kwargs):
             func.count += 1
-            if func.count < limit:
-                result = func(*args, **kwargs)
-            else:
-                result = None
-            func.count -= 1
-            return result
+            try:
+                if func.count < limit:
+                    return func(*args, **kwargs)
+                return None
+            finally:
+                # Also when func raised, or every failed poll would count against the limit for good
+                func.count -= 1
         return wrapper
     return inner
 
+def song_from_playback(result: dict, logger) -> list:
+    """
+    Returns [song_title, cover_url, artist] for a currently-playing payload,
+    [] if nothing displayable is playing, or None for the 'unknown' type that
+    should be polled again. Raises TypeError on an incomplete payload.
+    """
+    ctype = result.get('currently_playing_type', 'unknown')
+    if ctype == 'episode':
+        song = result["item"]["name"]
+        artist = result["item"]["show"]["name"]
+        cover_url = result["item"]["images"][0]["url"]
+        return [song, cover_url, artist]
+    elif ctype == 'track':
+        song = result["item"]["name"]
+        # combine all artist names
+        artist = ', '.join(a["name"] for a in result["item"]["artists"])
+        cover_url = result["item"]["album"]["images"][0]["url"]
+        return [song, cover_url, artist]
+    elif ctype == 'ad':
+        # Spotify ad playing
+        return []
+    elif ctype == 'unknown':
+        return None
+    logger.error(f"Unsupported currently_playing_type: {ctype}")
+    return []
+
 class SpotipiEinkDisplay:
-    def __init__(self, delay=1):
+    def __init__(self, delay=1, config_file=None):
         # Handle system signals
         signal.signal(signal.SIGTERM, self._handle_sigterm)
 
         self.delay = delay
         self.config = configparser.ConfigParser()
         # Reads ../config/eink_options.ini relative to this Python file's location
-        self.config.read(os.path.join(os.path.dirname(__file__), '..', 'config', 'eink_options.ini'))
+        if config_file is None:
+            config_file = os.path.join(os.path.dirname(__file__), '..', 'config', 'eink_options.ini')
+        self.config.read(config_file)
+        self.config_file = os.path.abspath(config_file)
+        self._stop_event = threading.Event()
+
+        # ---------------------------------------------------------------------
+        # Logging
+        # ---------------------------------------------------------------------
+        self.logger = self._init_logger()
+        self.logger.info('Service instance created')
+
+        # SIGUSR1 toggles a profile capture, SIGUSR2 dumps the thread stacks
+        self.profiler = ServiceProfiler.from_config(self.config)
+        self.profiler.install()
 
         # ---------------------------------------------------------------------
         # "idle" features
@@ -48,64 +98,107 @@ class SpotipiEinkDisplay:
         self.idle_images = self._load_idle_images()
         self.idle_index = 0
 
+        # Track previous song
+        self.song_prev = ''
+        self._first_poll_done = False
+        self.token_store = None
+        # Request budget shared with the button and token refresher services
+        self.api_budget = QuotaBudget.from_config(self.config, metrics)
+        # Which new tracks get a refresh, see admissionPolicy.py
+        self.admission = AdmissionPolicy.from_settings(self.config['DEFAULT'], metrics)
+        self.playback = None
+
         # ---------------------------------------------------------------------
-        # Logging
+        # Metrics: per-stage timings and counters
         # ---------------------------------------------------------------------
-        logging.basicConfig(
-            format='%(asctime)s %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S',
-            filename=self.config.get('DEFAULT', 'spotipy_log'),
-            level=logging.INFO
+        self.metrics = metrics
+        self.metrics_server = MetricsServer(
+            self.metrics,
+            port=self.config.getint('DEFAULT', 'metrics_port', fallback=0),
+            snapshot_path=self.config.get('DEFAULT', 'metrics_snapshot', fallback=None) or None,
+            snapshot_interval=self.config.getfloat('DEFAULT', 'metrics_snapshot_interval', fallback=60.0)
         )
-        logger = logging.getLogger('spotipy_logger')
-        handler = RotatingFileHandler(
-            self.config.get('DEFAULT', 'spotipy_log'),
-            maxBytes=2000,
-            backupCount=3
+
+        # ---------------------------------------------------------------------
+        # Memory and file descriptor telemetry, cache budgets
+        # ---------------------------------------------------------------------
+        pyramid_cache.max_bytes = self.config.getint('DEFAULT', 'cover_cache_mb', fallback=32) * 2 ** 20
+        self.resources = ResourceManager(
+            self.metrics,
+            interval=self.config.getfloat('DEFAULT', 'resource_interval', fallback=60.0),
+            rss_budget=self.config.getint('DEFAULT', 'memory_budget_mb', fallback=0) * 2 ** 20
         )
-        logger.addHandler(handler)
-        self.logger = logger
-        self.logger.info('Logger test: initialization complete')
+        self.resources.register_cache('covers', pyramid_cache)
+        self.metrics_server.add_route('/debug/tracemalloc',
+                                      lambda: ('text/plain', self.resources.tracemalloc_report()))
 
-        # A more verbose console logger
-        self.logger = self._init_logger()
-        self.logger.info('Service instance created')
+        # ---------------------------------------------------------------------
+        # Finished frames on disk, see frameCache.py and warmCache.py
+        # ---------------------------------------------------------------------
+        self.frame_cache = FrameCache(
+            self.config.get('DEFAULT', 'frame_cache_dir',
+                            fallback=os.path.join(os.path.dirname(__file__), '..', 'config', 'frame_cache')),
+            self.config.getint('DEFAULT', 'frame_cache_mb', fallback=0) * 2 ** 20)
 
         # ---------------------------------------------------------------------
-        # Set up display model
+        # Panels: one per [panel:<name>] section, or a single one from [DEFAULT]
         # ---------------------------------------------------------------------
-        if self.config.get('DEFAULT', 'model') == 'inky':
-            from inky.auto import auto
-            from inky.inky_uc8159 import CLEAN
-            self.inky_auto = auto
-            self.inky_clean = CLEAN
-            self.logger.info('Loading Pimoroni Inky library')
-        elif self.config.get('DEFAULT', 'model') == 'waveshare4':
-            from lib import epd4in01f
-            self.wave4 = epd4in01f
-            self.logger.info('Loading Waveshare 4" library')
-
-        # Track previous song and how many times we've refreshed
-        self.song_prev = ''
-        self.pic_counter = 0
+        self.panels = self._load_panels()
+        self._render_pool = None
+        render_workers = self.config.getint('DEFAULT', 'render_workers',
+                                            fallback=min(len(self.panels), os.cpu_count() or 1))
+        if len(self.panels) > 1 and render_workers > 1:
+            # 'spawn' so workers do not inherit the logging and display threads' locks
+            self._render_pool = ProcessPoolExecutor(max_workers=render_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            self.logger.info(f'Rendering {len(self.panels)} panels with {render_workers} worker processes')
+
+        # ---------------------------------------------------------------------
+        # Warm restart: resume the loop and panel state of the last run
+        # ---------------------------------------------------------------------
+        self.state = DisplayState(self.config.get(
+            'DEFAULT', 'state_file',
+            fallback=os.path.join(os.path.dirname(__file__), '..', 'config', 'display_state.json')))
+        self._restore_state(self.state.load())
+        for panel in self.panels:
+            panel.on_change = self._save_state
 
     def _init_logger(self):
         """
-        Creates a console logger at DEBUG level and attaches it
-        to the 'spotipy_logger' we set up above.
+        Returns the 'spotipy_logger'. Console and file output are written by a
+        background listener; the file only receives the in-RAM ring buffer on
+        errors and at shutdown (see serviceLogging.py).
         """
-        logger = logging.getLogger('spotipy_logger')
-        logger.setLevel(logging.DEBUG)
-        stdout_handler = logging.StreamHandler()
-        stdout_handler.setLevel(logging.DEBUG)
-        stdout_handler.setFormatter(logging.Formatter('Spotipi eInk Display - %(message)s'))
-        logger.addHandler(stdout_handler)
-        return logger
+        return setup_logging(self.config)
 
     def _handle_sigterm(self, sig, frame):
         self.logger.warning('SIGTERM received, stopping')
         sys.exit(0)
 
+    def _load_panels(self) -> list:
+        """Creates a Panel for every [panel:<name>] section, or one from [DEFAULT] if there are none."""
+        sections = [name for name in self.config.sections() if name.startswith('panel:')]
+        if not sections:
+            return [Panel('default', self.config['DEFAULT'], self.logger, self.metrics)]
+        return [Panel(name.split(':', 1)[1], self.config[name], self.logger, self.metrics) for name in sections]
+
+    def _restore_state(self, state: dict):
+        if not state:
+            return
+        self.song_prev = state.get('song_prev', '')
+        if self.idle_images:
+            self.idle_index = state.get('idle_index', 0) % len(self.idle_images)
+        for panel in self.panels:
+            panel.restore(state.get('panels', {}).get(panel.name, {}))
+        self.logger.info(f'Resuming from saved state, last song key: {self.song_prev or "-"}')
+
+    def _save_state(self):
+        self.state.save({
+            'song_prev': self.song_prev,
+            'idle_index': self.idle_index,
+            'panels': {panel.name: panel.state() for panel in self.panels},
+        })
+
     def _load_idle_images(self):
         """Load all valid image files from the idle folder for shuffle/cycle."""
         images = []
@@ -119,358 +212,161 @@ class SpotipiEinkDisplay:
             self.logger.error(traceback.format_exc())
         return images
 
-    def _get_idle_image(self):
+    def _get_idle_image_path(self) -> str:
         """
-        Returns an idle image according to idle_mode and idle_shuffle:
+        Returns the path of an idle image according to idle_mode and idle_shuffle:
           - If no images are found, returns the default image.
           - If shuffle is True, picks randomly.
           - Otherwise cycles through the list in order.
         """
         if not self.idle_images:
-            return Image.open(self.default_idle_image)
+            return self.default_idle_image
 
         if self.idle_shuffle:
-            return Image.open(random.choice(self.idle_images))
+            return random.choice(self.idle_images)
         else:
             img_path = self.idle_images[self.idle_index]
             self.idle_index = (self.idle_index + 1) % len(self.idle_images)
-            return Image.open(img_path)
+            return img_path
 
-    def _break_fix(self, text: str, width: int, font: ImageFont, draw: ImageDraw):
-        """
-        Break a string into lines so that each line does not exceed 'width'.
-        """
-        if not text:
-            return
-        if isinstance(text, str):
-            text = text.split()
-        lo = 0
-        hi = len(text)
-        while lo < hi:
-            mid = (lo + hi + 1) // 2
-            t = ' '.join(text[:mid])
-            w = int(draw.textlength(text=t, font=font))
-            if w <= width:
-                lo = mid
-            else:
-                hi = mid - 1
-        t = ' '.join(text[:lo])
-        w = int(draw.textlength(text=t, font=font))
-        yield t, w
-        yield from self._break_fix(text[lo:], width, font, draw)
-
-    def _fit_text_top_down(
-        self, img: Image, text: str, text_color: str, shadow_text_color: str,
-        font: ImageFont, y_offset: int, font_size: int,
-        x_start_offset: int = 0, x_end_offset: int = 0,
-        offset_text_px_shadow: int = 0
-    ) -> int:
-        """
-        Draw text from top to bottom, wrapping as needed, and return the height used.
-        """
-        width = img.width - x_start_offset - x_end_offset - offset_text_px_shadow
-        draw = ImageDraw.Draw(img)
-        pieces = list(self._break_fix(text, width, font, draw))
-        y = y_offset
-        h_taken_by_text = 0
-        for t, _ in pieces:
-            if offset_text_px_shadow > 0:
-                draw.text((x_start_offset + offset_text_px_shadow, y + offset_text_px_shadow),
-                          t, font=font, fill=shadow_text_color)
-            draw.text((x_start_offset, y), t, font=font, fill=text_color)
-            y += font_size
-            h_taken_by_text += font_size
-        return h_taken_by_text
-
-    def _fit_text_bottom_up(
-        self, img: Image, text: str, text_color: str, shadow_text_color: str,
-        font: ImageFont, y_offset: int, font_size: int,
-        x_start_offset: int = 0, x_end_offset: int = 0,
-        offset_text_px_shadow: int = 0
-    ) -> int:
-        """
-        Draw text from bottom upward, wrapping as needed, and return the height used.
-        """
-        width = img.width - x_start_offset - x_end_offset - offset_text_px_shadow
-        draw = ImageDraw.Draw(img)
-        pieces = list(self._break_fix(text, width, font, draw))
-        if len(pieces) > 1:
-            y_offset -= (len(pieces) - 1) * font_size
-        h_taken_by_text = 0
-        for t, _ in pieces:
-            if offset_text_px_shadow > 0:
-                draw.text((x_start_offset + offset_text_px_shadow, y_offset + offset_text_px_shadow),
-                          t, font=font, fill=shadow_text_color)
-            draw.text((x_start_offset, y_offset), t, font=font, fill=text_color)
-            y_offset += font_size
-            h_taken_by_text += font_size
-        return h_taken_by_text
-
-    def _display_clean(self):
-        """
-        Clears the display (two passes) for Inky or Waveshare.
-        """
-        try:
-            if self.config.get('DEFAULT', 'model') == 'inky':
-                inky = self.inky_auto()
-                for _ in range(2):
-                    for y in range(inky.height):
-                        for x in range(inky.width):
-                            inky.set_pixel(x, y, self.inky_clean)
-                    inky.show()
-                    time.sleep(1.0)
-            elif self.config.get('DEFAULT', 'model') == 'waveshare4':
-                epd = self.wave4.EPD()
-                epd.init()
-                epd.Clear()
-        except Exception as e:
-            self.logger.error(f'Display clean error: {e}')
-            self.logger.error(traceback.format_exc())
+    def _read_source(self, path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
 
-    def _convert_image_wave(self, img: Image, saturation: int = 2) -> Image:
-        """
-        Convert an Image to the 7-color format needed by Waveshare 4".
+    def _render_panels(self, source: bytes, artist: str, title: str, show_small_cover: bool) -> list:
         """
-        converter = ImageEnhance.Color(img)
-        img = converter.enhance(saturation)
-        palette_data = [
-            0x00, 0x00, 0x00,   # black
-            0xff, 0xff, 0xff,   # white
-            0x00, 0xff, 0x00,   # green
-            0x00, 0x00, 0xff,   # blue
-            0xff, 0x00, 0x00,   # red
-            0xff, 0xff, 0x00,   # yellow
-            0xff, 0x80, 0x00    # orange
-        ]
-        palette_image = Image.new('P', (1, 1))
-        palette_image.putpalette(palette_data + [0, 0, 0] * 248)
-        img.load()
-        palette_image.load()
-        im = img.im.convert('P', True, palette_image.im)
-        return img._new(im)
-
-    def _display_image(self, image: Image, saturation: float = 0.5):
+        Renders the frame of every panel from the encoded source image. With
+        several panels the work is spread over the process pool.
         """
-        Shows the Image on the Inky or Waveshare display.
+        if self._render_pool is not None:
+            with self.metrics.span('render_panels'):
+                jobs = [self._render_pool.submit(render_frame, self.config_file, panel.section, source,
+                                                 artist, title, show_small_cover, self.default_idle_image)
+                        for panel in self.panels]
+                payloads = [job.result() for job in jobs]
+            for payload in payloads:
+                for stage, seconds in payload['timings'].items():
+                    self.metrics.observe(stage, seconds)
+            return [frame_from_payload(payload) for payload in payloads]
+
+        with self.metrics.span('decode'):
+            cover = cover_pyramid(source, self.default_idle_image)
+        frames = []
+        for panel in self.panels:
+            timings = {}
+            frames.append(panel.render(cover, artist, title, show_small_cover, timings))
+            for stage, seconds in timings.items():
+                self.metrics.observe(stage, seconds)
+        return frames
+
+    def _fetch_cover(self, url: str) -> bytes:
+        import requests
+        with self.metrics.span('fetch'):
+            resp = requests.get(url)
+            resp.raise_for_status()
+        self.metrics.inc('cover_fetches')
+        return resp.content
+
+    def _cached_frames(self, cover_id: str, read_source, artist: str, title: str, show_small_cover: bool) -> list:
         """
-        try:
-            if self.config.get('DEFAULT', 'model') == 'inky':
-                inky = self.inky_auto()
-                inky.set_image(image, saturation=saturation)
-                inky.show()
-            elif self.config.get('DEFAULT', 'model') == 'waveshare4':
-                epd = self.wave4.EPD()
-                epd.init()
-                epd.display(epd.getbuffer(self._convert_image_wave(image)))
-                epd.sleep()
-        except Exception as e:
-            self.logger.error(f'Display image error: {e}')
-            self.logger.error(traceback.format_exc())
-
-    def _gen_pic(self, image: Image, artist: str, title: str, show_small_cover: bool) -> Image:
+        Frames of every panel from the frame cache, or rendered from
+        read_source() and stored there if any of them is missing.
         """
-        Generates the final composite image with the album artwork (or idle image),
-        background blur (if configured), and optional text (title/artist).
-        'show_small_cover' controls whether we paste a small overlay of 'image'.
+        keys = [self.frame_cache.key(panel.settings, cover_id, artist, title, show_small_cover)
+                for panel in self.panels]
+        frames = [self.frame_cache.get(key) for key in keys]
+        if None not in frames:
+            self.metrics.inc('frame_cache_hits')
+            return frames
+        frames = self._render_panels(read_source(), artist, title, show_small_cover)
+        for key, frame in zip(keys, frames):
+            self.frame_cache.put(key, frame)
+        return frames
+
+    def _display_update_process(self, song_request: list) -> list:
         """
-        album_cover_small_px = self.config.getint('DEFAULT', 'album_cover_small_px')
-        offset_px_left = self.config.getint('DEFAULT', 'offset_px_left')
-        offset_px_right = self.config.getint('DEFAULT', 'offset_px_right')
-        offset_px_top = self.config.getint('DEFAULT', 'offset_px_top')
-        offset_px_bottom = self.config.getint('DEFAULT', 'offset_px_bottom')
-        offset_text_px_shadow = self.config.getint('DEFAULT', 'offset_text_px_shadow', fallback=0)
-        text_direction = self.config.get('DEFAULT', 'text_direction', fallback='top-down')
-        background_blur = self.config.getint('DEFAULT', 'background_blur', fallback=0)
-
-        bg_w, bg_h = image.size
-
-        # Fit or repeat background
-        bg_mode = self.config.get('DEFAULT', 'background_mode', fallback='fit')
-        if bg_mode == 'fit':
-            target_size = (self.config.getint('DEFAULT', 'width'),
-                           self.config.getint('DEFAULT', 'height'))
-            if bg_w != target_size[0] or bg_h != target_size[1]:
-                image_new = ImageOps.fit(image, target_size, centering=(0.0, 0.0))
-            else:
-                image_new = image.crop((0, 0, target_size[0], target_size[1]))
-        elif bg_mode == 'repeat':
-            target_w = self.config.getint('DEFAULT', 'width')
-            target_h = self.config.getint('DEFAULT', 'height')
-            image_new = Image.new('RGB', (target_w, target_h))
-            for x in range(0, target_w, bg_w):
-                for y in range(0, target_h, bg_h):
-                    image_new.paste(image, (x, y))
-        else:
-            # fallback
-            target_size = (self.config.getint('DEFAULT', 'width'),
-                           self.config.getint('DEFAULT', 'height'))
-            image_new = image.crop((0, 0, target_size[0], target_size[1]))
-
-        # Optional blur: apply only if small artwork is enabled
-        if self.config.getboolean('DEFAULT', 'album_cover_small') and background_blur > 0:
-            image_new = image_new.filter(ImageFilter.GaussianBlur(background_blur))
-
-        # Paste smaller cover if show_small_cover and config says album_cover_small = True
-        if show_small_cover and self.config.getboolean('DEFAULT', 'album_cover_small'):
-            cover_smaller = image.resize((album_cover_small_px, album_cover_small_px), Image.LANCZOS)
-            album_pos_x = (image_new.width - album_cover_small_px) // 2
-            image_new.paste(cover_smaller, (album_pos_x, offset_px_top))
-
-        # Prepare fonts
-        font_title = ImageFont.truetype(self.config.get('DEFAULT', 'font_path'),
-                                        self.config.getint('DEFAULT', 'font_size_title'))
-        font_artist = ImageFont.truetype(self.config.get('DEFAULT', 'font_path'),
-                                         self.config.getint('DEFAULT', 'font_size_artist'))
-
-        draw = ImageDraw.Draw(image_new)
-
-        # Render text
-        if text_direction == 'top-down':
-            # Use the fixed offsets as in the older version
-            title_position_y = album_cover_small_px + offset_px_top + 10
-            title_height = self._fit_text_top_down(
-                img=image_new,
-                text=title,
-                text_color='white',
-                shadow_text_color='black',
-                font=font_title,
-                font_size=self.config.getint('DEFAULT', 'font_size_title'),
-                y_offset=title_position_y,
-                x_start_offset=offset_px_left,
-                x_end_offset=offset_px_right,
-                offset_text_px_shadow=offset_text_px_shadow
-            )
-            artist_position_y = album_cover_small_px + offset_px_top + 10 + title_height
-            self._fit_text_top_down(
-                img=image_new,
-                text=artist,
-                text_color='white',
-                shadow_text_color='black',
-                font=font_artist,
-                font_size=self.config.getint('DEFAULT', 'font_size_artist'),
-                y_offset=artist_position_y,
-                x_start_offset=offset_px_left,
-                x_end_offset=offset_px_right,
-                offset_text_px_shadow=offset_text_px_shadow
-            )
-        elif text_direction == 'bottom-up':
-            artist_position_y = image_new.height - (offset_px_bottom + self.config.getint('DEFAULT', 'font_size_artist'))
-            artist_height = self._fit_text_bottom_up(
-                img=image_new,
-                text=artist,
-                text_color='white',
-                shadow_text_color='black',
-                font=font_artist,
-                font_size=self.config.getint('DEFAULT', 'font_size_artist'),
-                y_offset=artist_position_y,
-                x_start_offset=offset_px_left,
-                x_end_offset=offset_px_right,
-                offset_text_px_shadow=offset_text_px_shadow
-            )
-            title_position_y = image_new.height - (offset_px_bottom + self.config.getint('DEFAULT', 'font_size_title')) - artist_height
-            self._fit_text_bottom_up(
-                img=image_new,
-                text=title,
-                text_color='white',
-                shadow_text_color='black',
-                font=font_title,
-                font_size=self.config.getint('DEFAULT', 'font_size_title'),
-                y_offset=title_position_y,
-                x_start_offset=offset_px_left,
-                x_end_offset=offset_px_right,
-                offset_text_px_shadow=offset_text_px_shadow
-            )
-
-        return image_new
-
-    def _display_update_process(self, song_request: list):
-        """
-        Generates and displays the final image. Cleans after 'display_refresh_counter' cycles.
+        Fetches the cover once, renders it for every panel and queues the
+        frames. Returns the Futures of the panel refreshes.
         """
         if song_request:
             # song_request: [song_title, album_url, artist]
+            title, artist, show_small_cover = song_request[0], song_request[2], True
             try:
-                resp = requests.get(song_request[1], stream=True)
-                resp.raise_for_status()
-                cover = Image.open(resp.raw)
-
-                # show_small_cover=True for active track
-                image = self._gen_pic(
-                    cover,
-                    artist=song_request[2],
-                    title=song_request[0],
-                    show_small_cover=True
-                )
+                frames = self._cached_frames(song_request[1], lambda: self._fetch_cover(song_request[1]),
+                                             artist, title, show_small_cover)
             except Exception as e:
                 self.logger.error(f"Failed to fetch/open album cover: {e}")
                 self.logger.error(traceback.format_exc())
-
-                fallback_cover = Image.open(self.default_idle_image)
-                image = self._gen_pic(
-                    fallback_cover,
-                    artist=song_request[2],
-                    title=song_request[0],
-                    show_small_cover=True
-                )
+                frames = self._render_panels(self._read_source(self.default_idle_image),
+                                             artist, title, show_small_cover)
+            expected_idle = None
         else:
-            # Idle: no text, no small cover
-            idle_img = self._get_idle_image()
-            image = self._gen_pic(
-                idle_img,
-                artist="",
-                title="",
-                show_small_cover=False
-            )
-
-        # Clean screen occasionally
-        refresh_limit = self.config.getint('DEFAULT', 'display_refresh_counter', fallback=20)
-        if self.pic_counter > refresh_limit:
-            self._display_clean()
-            self.pic_counter = 0
-
-        # Show final image
-        self._display_image(image)
-        self.pic_counter += 1
+            # Idle: no text, no small cover.
+            # An idle image stays up for idle_display_time, so the panel can sleep right after it.
+            path = self._get_idle_image_path()
+            frames = self._cached_frames(file_cover_id(path), lambda: self._read_source(path), "", "", False)
+            expected_idle = self.idle_display_time
+
+        return [panel.update(frame, expected_idle) for panel, frame in zip(self.panels, frames)]
+
+    def _get_token_store(self):
+        if self.token_store is None:
+            from tokenStore import TokenStore
+            self.token_store = TokenStore(
+                self.config.get('DEFAULT', 'token_file'),
+                refresh_margin=self.config.getfloat('DEFAULT', 'token_refresh_margin', fallback=600.0))
+        return self.token_store
+
+    def _admit(self, song_request: list, song_key: str) -> bool:
+        """Whether the new track of the last poll is worth a panel refresh (see admissionPolicy.py)."""
+        playback = self.playback or {}
+        item = playback.get('item') or {}
+        decision = self.admission.decide(song_key, playback.get('progress_ms'), item.get('duration_ms'),
+                                         label=f'{song_request[0]} by {song_request[2]}')
+        return decision == 'show'
 
     @limit_recursion(limit=10)
     def _get_song_info(self) -> list:
         """
         Returns [song_title, cover_url, artist] or [] if no track.
         """
-        scope = 'user-read-currently-playing,user-modify-playback-state'
+        # Imported here so the service is up before spotipy (and requests) are loaded
+        import spotipy
         username = self.config.get('DEFAULT', 'username')
-        token_file = self.config.get('DEFAULT', 'token_file')
-        token = util.prompt_for_user_token(username=username, scope=scope, cache_path=token_file)
+        token = self._get_token_store().access_token()
 
         if token:
             sp = spotipy.Spotify(auth=token)
-            result = sp.currently_playing(additional_types='episode')
+            api_prefix = self.config.get('DEFAULT', 'spotify_api_prefix', fallback=None)
+            if api_prefix:
+                # Points the client at a local stand-in such as mockSpotify.py
+                sp.prefix = api_prefix
+            self.api_budget.acquire('poll')
+            self.metrics.inc('api_calls')
+            try:
+                with self.metrics.span('poll'):
+                    result = sp.currently_playing(additional_types='episode')
+            except Exception as e:
+                self.metrics.inc('api_errors')
+                self.api_budget.note_error(e)
+                raise
+            self.playback = result
+            if not self._first_poll_done:
+                self._first_poll_done = True
+                elapsed = time.monotonic() - STARTED_AT
+                self.metrics.observe('time_to_first_poll', elapsed)
+                self.logger.info(f'First poll answered {elapsed:.2f}s after start')
             if result:
                 try:
-                    ctype = result.get('currently_playing_type', 'unknown')
-                    if ctype == 'episode':
-                        song = result["item"]["name"]
-                        artist = result["item"]["show"]["name"]
-                        cover_url = result["item"]["images"][0]["url"]
-                        return [song, cover_url, artist]
-                    elif ctype == 'track':
-                        song = result["item"]["name"]
-                        # combine all artist names
-                        artist = ', '.join(a["name"] for a in result["item"]["artists"])
-                        cover_url = result["item"]["album"]["images"][0]["url"]
-                        return [song, cover_url, artist]
-                    elif ctype == 'ad':
-                        # Spotify ad playing
-                        return []
-                    elif ctype == 'unknown':
-                        time.sleep(0.01)
-                        return self._get_song_info()
-                    self.logger.error(f"Unsupported currently_playing_type: {ctype}")
-                    return []
+                    song_request = song_from_playback(result, self.logger)
                 except TypeError:
                     self.logger.error("TypeError from Spotipy, retrying...")
                     time.sleep(0.01)
                     return self._get_song_info()
+                if song_request is None:
+                    time.sleep(0.01)
+                    return self._get_song_info()
+                return song_request
             else:
                 # None -> no track playing
                 return []
@@ -478,35 +374,56 @@ class SpotipiEinkDisplay:
             self.logger.error(f"Error: Can't get token for {username}")
             return []
 
+    def _startup(self):
+        self.logger.info('Service started')
+        self.metrics_server.start()
+        self.resources.start()
+        for panel in self.panels:
+            if panel.frame_hash is None:
+                panel.clean()
+            else:
+                self.logger.info(f'[{panel.name}] Panel still shows the last frame, skipping the initial clean')
+
+    def _shutdown(self):
+        for panel in self.panels:
+            panel.display_driver.close()
+        if self._render_pool is not None:
+            self._render_pool.shutdown(cancel_futures=True)
+        self.resources.stop()
+        self.api_budget.close()
+        self.metrics_server.stop()
+
     def start(self):
         """
         Main loop: polls Spotify for current track, or idle if none.
         """
-        self.logger.info('Service started')
-        self._display_clean()
-
+        self._startup()
         try:
-            while True:
+            while not self._stop_event.is_set():
                 try:
                     song_request = self._get_song_info()
                     self.logger.debug(f"Song info returned: {song_request}")
                     if song_request:
+                        self.admission.playing()
                         new_song_key = song_request[0] + song_request[1]
-                        if self.song_prev != new_song_key:
+                        if self.song_prev != new_song_key and self._admit(song_request, new_song_key):
                             self.logger.info(f"New song detected: {song_request[0]} by {song_request[2]}")
                             self.song_prev = new_song_key
                             self._display_update_process(song_request)
-                    else:
+                            self._save_state()
+                    elif self.admission.admit_idle():
+                        # Not for a short gap between tracks, see admissionPolicy.py
                         self.logger.info("No track detected - switching to idle image.")
                         self.song_prev = 'NO_SONG'
                         self._display_update_process([])
+                        self._save_state()
 
                         # Instead of a long sleep, break the idle wait into increments
                         self.logger.debug(f"Entering idle sleep mode: up to {self.idle_display_time} seconds, polling every 5 seconds")
                         sleep_increment = 5
                         elapsed = 0
-                        while elapsed < self.idle_display_time:
-                            time.sleep(sleep_increment)
+                        while elapsed < self.idle_display_time and not self._stop_event.is_set():
+                            self._stop_event.wait(sleep_increment)
                             elapsed += sleep_increment
                             if self._get_song_info():
                                 self.logger.info("Track detected during idle sleep; breaking idle sleep early.")
@@ -516,11 +433,19 @@ class SpotipiEinkDisplay:
                     self.logger.error(f"Error in main loop: {e}")
                     self.logger.error(traceback.format_exc())
 
-                time.sleep(self.delay)
+                self._stop_event.wait(self.delay)
 
         except KeyboardInterrupt:
             self.logger.info("Service stopping via KeyboardInterrupt")
             sys.exit(0)
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        """
+        Asks the main loop to return after the current iteration.
+        """
+        self._stop_event.set()
 
 
 if __name__ == "__main__":
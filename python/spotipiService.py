@@ -0,0 +1,176 @@
+"""
+Display, buttons and token refresh in one process.
+
+Instead of the three services spotipi-eink-display, spotipi-eink-buttons
+and spotipi-eink-token-refresher, each with its own interpreter, spotipy
+import and token handling, one asyncio event loop runs:
+    - the Spotify poll and idle image cycle of spotipiEinkDisplay.py
+    - the button handler of buttonActions.py (if 'buttons' is enabled)
+    - the token refresh, just before the token is due
+
+Blocking Spotify calls and button actions run on a small thread pool,
+rendering runs on its own executor so it never holds up a button press,
+and the panel refreshes stay on each panel's DisplayDriver thread. All of
+them share one TokenStore and one QuotaBudget.
+
+Settings (in the [DEFAULT] section of eink_options.ini):
+    buttons = True       ; handle the Pimoroni buttons (default: True for inky)
+    idle_poll_interval = 5
+
+Usage:
+    python spotipiService.py [--config eink_options.ini]
+Installed with setup/service_template/spotipi-eink.service, see the README.
+"""
+import argparse
+import asyncio
+import signal
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from spotipiEinkDisplay import SpotipiEinkDisplay
+
+
+class UnifiedService:
+    def __init__(self, config_file: str = None):
+        self.display = SpotipiEinkDisplay(config_file=config_file)
+        self.config = self.display.config
+        self.logger = self.display.logger
+        self.idle_poll_interval = self.config.getfloat('DEFAULT', 'idle_poll_interval', fallback=5.0)
+        model = self.config.get('DEFAULT', 'model', fallback='inky')
+        self.buttons_enabled = self.config.getboolean('DEFAULT', 'buttons', fallback=model == 'inky')
+        self._io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='service-io')
+        self._render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='service-render')
+        self.stopping = False
+        self._stop_event = None
+        self._loop = None
+
+    async def run_io(self, func, *args):
+        return await self._loop.run_in_executor(self._io_pool, func, *args)
+
+    async def run_render(self, func, *args):
+        return await self._loop.run_in_executor(self._render_pool, func, *args)
+
+    async def wait_stopped(self, timeout: float) -> bool:
+        """Sleeps up to 'timeout' seconds, returning early (True) once the service is stopping."""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping
+
+    def _show(self, song_request: list):
+        self.display._display_update_process(song_request)
+        self.display._save_state()
+
+    async def _poll_loop(self):
+        display = self.display
+        idle_shown_at = None
+        while not self.stopping:
+            wait = display.delay
+            try:
+                song_request = await self.run_io(display._get_song_info)
+                if song_request:
+                    display.admission.playing()
+                    new_song_key = song_request[0] + song_request[1]
+                    if display.song_prev != new_song_key and display._admit(song_request, new_song_key):
+                        self.logger.info(f"New song detected: {song_request[0]} by {song_request[2]}")
+                        display.song_prev = new_song_key
+                        await self.run_render(self._show, song_request)
+                elif display.admission.admit_idle():
+                    now = self._loop.time()
+                    if (display.song_prev != 'NO_SONG' or idle_shown_at is None
+                            or now - idle_shown_at >= display.idle_display_time):
+                        self.logger.info("No track detected - switching to idle image.")
+                        display.song_prev = 'NO_SONG'
+                        idle_shown_at = now
+                        await self.run_render(self._show, [])
+                    wait = self.idle_poll_interval
+            except Exception as e:
+                self.logger.error(f"Error in poll loop: {e}")
+                self.logger.error(traceback.format_exc())
+            await self.wait_stopped(wait)
+
+    async def _token_loop(self):
+        """Refreshes the token when it is due, so a poll never has to wait for it."""
+        token_store = self.display._get_token_store()
+        while not self.stopping:
+            due_in = token_store.refresh_due_in()
+            if due_in is None:
+                due_in = 60
+            elif due_in == 0:
+                try:
+                    await self.run_io(token_store.refresh)
+                    due_in = token_store.refresh_due_in() or 30
+                except Exception as e:
+                    self.logger.error(f"Token refresh failed: {e}")
+                    due_in = 30
+            await self.wait_stopped(min(due_in, 3600))
+
+    async def _button_loop(self):
+        try:
+            import buttonActions
+            from RPi import GPIO
+        except Exception as e:
+            self.logger.warning(f"Buttons disabled: {e}")
+            return
+        # Same config, token and request budget as the display
+        buttonActions.setup(self.config, self.display._get_token_store(), self.display.api_budget)
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(buttonActions.BUTTONS, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        self.logger.info('Button handler started')
+        try:
+            while not self.stopping:
+                for pin in buttonActions.BUTTONS:
+                    if GPIO.input(pin) == GPIO.LOW:
+                        try:
+                            await self.run_io(buttonActions.handle_button, pin)
+                        except Exception as e:
+                            self.logger.error(f"Button action failed: {e}")
+                        await self.wait_stopped(0.2)  # Debounce delay
+                await self.wait_stopped(0.1)
+        finally:
+            GPIO.cleanup()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        if self.stopping:
+            self._stop_event.set()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(sig, self.stop)
+            except (ValueError, RuntimeError):
+                # Not the main thread
+                pass
+        await self.run_render(self.display._startup)
+        tasks = [self._poll_loop(), self._token_loop()]
+        if self.buttons_enabled:
+            tasks.append(self._button_loop())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self._io_pool.shutdown(cancel_futures=True)
+            self._render_pool.shutdown(wait=True)
+            self.display._shutdown()
+            self.logger.info('Service stopped')
+
+    def start(self):
+        asyncio.run(self.run())
+
+    def stop(self):
+        """Stops every loop; safe to call from any thread."""
+        self.stopping = True
+        self.display.stop()
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Display, buttons and token refresh in one process')
+    parser.add_argument('--config', default=None, help='path of eink_options.ini')
+    args = parser.parse_args()
+    UnifiedService(args.config).start()
+
+
+if __name__ == '__main__':
+    main()
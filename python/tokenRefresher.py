@@ -1,9 +1,11 @@
 import os
+import configparser
 import time
 import threading
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
 import logging
+from quotaBudget import QuotaBudget
+from tokenStore import TokenStore
 
 # Basic logging configuration
 logging.basicConfig(
@@ -32,6 +34,12 @@ if os.path.exists(ENV_FILE):
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CACHE_PATH = os.path.join(SCRIPT_DIR, "../config/.cache")
 
+# API request budget shared with the display and button services; keep-alives
+# are background requests and wait whenever the budget runs low
+config = configparser.ConfigParser()
+config.read(os.path.join(SCRIPT_DIR, "../config/eink_options.ini"))
+api_budget = QuotaBudget.from_config(config)
+
 # Get required Spotify credentials from environment
 CLIENT_ID = os.environ.get("SPOTIPY_CLIENT_ID")
 CLIENT_SECRET = os.environ.get("SPOTIPY_CLIENT_SECRET")
@@ -41,60 +49,62 @@ if not all([CLIENT_ID, CLIENT_SECRET, REDIRECT_URI]):
     logger.error("Missing Spotify API environment variables! Check your systemd-env-file.")
     exit(1)
 
-# Set up Spotify OAuth
-sp_oauth = SpotifyOAuth(
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    redirect_uri=REDIRECT_URI,
+# Token cache shared with the display and button services: reads and writes
+# are file-locked and a refresh happens in only one of them at a time
+token_store = TokenStore(
+    CACHE_PATH,
     scope="user-read-currently-playing user-modify-playback-state user-read-playback-state",
-    cache_path=CACHE_PATH
+    refresh_margin=600
 )
 
-# Global Spotify instance
+# Global Spotify instance and the token it was created with
 sp = None
+sp_token = None
 
 def refresh_and_keepalive():
     """Background function to refresh the token and send keep-alive pings."""
-    global sp
-    check_interval = 60  # seconds between checks
+    global sp, sp_token
+    check_interval = 60  # seconds between keep-alive requests
     backoff = 1          # initial backoff in seconds
     max_backoff = 60     # maximum backoff
 
     while True:
         start_time = time.time()
         try:
-            token_info = sp_oauth.get_cached_token()
-            if not token_info:
+            remaining = token_store.expires_in()
+            if remaining is None:
                 logger.error("No cached token found! Please authenticate manually once.")
             else:
-                expires_at = token_info.get("expires_at")
-                current_time = int(time.time())
-                remaining = expires_at - current_time if expires_at else None
-                logger.info(f"Token expires in {remaining} seconds (expires_at: {expires_at}, current_time: {current_time}).")
-                
-                # Refresh token if it's about to expire in less than 60 seconds
-                if remaining is not None and remaining < 60:
-                    logger.info("Token is about to expire. Refreshing token...")
-                    new_token_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
+                logger.info(f"Token expires in {int(remaining)} seconds.")
+
+                # Refresh well before expiry, unless another service already did
+                if token_store.refresh_due_in() == 0:
+                    logger.info("Token is due for a refresh. Refreshing token...")
+                    new_token_info = token_store.refresh()
                     if new_token_info and "access_token" in new_token_info:
                         logger.info("Token refreshed successfully.")
-                        sp = spotipy.Spotify(auth=new_token_info["access_token"])
-                        backoff = 1  # reset backoff after successful refresh
                     else:
                         logger.error("Failed to refresh token!")
                         raise Exception("Token refresh failed.")
-                else:
-                    # If we don't have an instance yet, initialize it.
-                    if sp is None:
-                        sp = spotipy.Spotify(auth=token_info["access_token"])
 
-                    # Keep-alive: Send a simple API request
-                    logger.info("Sending keep-alive request to Spotify API...")
+                access_token = token_store.get_cached_token()["access_token"]
+                # A new client whenever the token changed, also when another service refreshed it
+                if sp is None or sp_token != access_token:
+                    sp = spotipy.Spotify(auth=access_token)
+                    sp_token = access_token
+
+                # Keep-alive: Send a simple API request
+                logger.info("Sending keep-alive request to Spotify API...")
+                api_budget.acquire("background")
+                try:
                     current_playback = sp.current_playback()
-                    if current_playback:
-                        logger.info("Spotify playback detected.")
-                    else:
-                        logger.info("No active playback (keep-alive still successful).")
+                except Exception as e:
+                    api_budget.note_error(e)
+                    raise
+                if current_playback:
+                    logger.info("Spotify playback detected.")
+                else:
+                    logger.info("No active playback (keep-alive still successful).")
             # Reset backoff on successful run
             backoff = 1
         except Exception as e:
@@ -104,8 +114,10 @@ def refresh_and_keepalive():
             backoff = min(backoff * 2, max_backoff)
             continue  # Skip normal sleep, retry after backoff
 
+        # Wake up for the next keep-alive, or earlier when the refresh is due
         elapsed = time.time() - start_time
-        sleep_time = max(check_interval - elapsed, 0)
+        due_in = token_store.refresh_due_in()
+        sleep_time = max(min(check_interval, due_in if due_in is not None else check_interval) - elapsed, 0)
         time.sleep(sleep_time)
 
 def start_background_thread():
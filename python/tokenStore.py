@@ -0,0 +1,190 @@
+"""
+Spotify token cache shared by the display, button and token refresher
+services.
+
+All three read and refresh the same token file (config/.cache). The file
+is only read under a shared lock and only replaced, by an atomic rename,
+under an exclusive lock on a separate '<token file>.lock', so no process
+ever sees a half written token.
+
+The token is refreshed 'refresh_margin' seconds before it expires instead
+of when it is about to run out. The refresh is single-flight: the process
+that gets the exclusive lock first refreshes, the others wait on the lock
+and then pick up the new token from the file instead of refreshing again.
+
+TokenStore is also a spotipy cache handler, so SpotifyOAuth saves the
+refreshed token through it.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import fcntl
+from spotipy.cache_handler import CacheHandler
+
+logger = logging.getLogger('spotipy_logger')
+
+DEFAULT_SCOPE = 'user-read-currently-playing,user-modify-playback-state'
+
+
+class _FileLock:
+    """flock() on a lock file, re-entrant within the process."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self, exclusive: bool):
+        self._lock.acquire()
+        if self._depth == 0:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+    def shared(self):
+        return _Held(self, False)
+
+    def exclusive(self):
+        return _Held(self, True)
+
+
+class _Held:
+    def __init__(self, lock: _FileLock, exclusive: bool):
+        self.lock = lock
+        self.exclusive = exclusive
+
+    def __enter__(self):
+        self.lock.acquire(self.exclusive)
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+class TokenStore(CacheHandler):
+    def __init__(self, path: str, scope: str = DEFAULT_SCOPE, refresh_margin: float = 600.0):
+        self.path = path
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self._lock = _FileLock(f'{path}.lock')
+        self._token_info = None
+        self._stat = None
+        self._oauth = None
+        self._retry_at = 0.0
+
+    @property
+    def oauth(self):
+        if self._oauth is None:
+            from spotipy.oauth2 import SpotifyOAuth
+            # Client id, secret and redirect URI come from the SPOTIPY_* environment variables
+            self._oauth = SpotifyOAuth(scope=self.scope, cache_handler=self, open_browser=False)
+        return self._oauth
+
+    def get_cached_token(self) -> dict:
+        """The token in the file, re-read only when the file was replaced."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stat != self._stat:
+            with self._lock.shared():
+                try:
+                    with open(self.path) as f:
+                        self._token_info = json.load(f)
+                    self._stat = stat
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Couldn't read token file {self.path}: {e}")
+                    return None
+        return self._token_info
+
+    def save_token_to_cache(self, token_info: dict):
+        tmp_path = f'{self.path}.tmp'
+        with self._lock.exclusive():
+            try:
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(token_info, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.error(f"Couldn't write token file {self.path}: {e}")
+                return
+        self._token_info = token_info
+        self._stat = None
+
+    def expires_in(self) -> float:
+        """Seconds until the cached token expires, None if there is no token."""
+        token_info = self.get_cached_token()
+        if not token_info or 'expires_at' not in token_info:
+            return None
+        return token_info['expires_at'] - time.time()
+
+    def refresh_due_in(self) -> float:
+        """Seconds until the token should be refreshed (0 if it should be now), None if there is no token."""
+        remaining = self.expires_in()
+        if remaining is None:
+            return None
+        return max(0.0, remaining - self.refresh_margin)
+
+    def refresh(self, force: bool = False) -> dict:
+        """
+        Refreshes the token unless another process did while this one was
+        waiting for the lock. Returns the current token info.
+        """
+        with self._lock.exclusive():
+            # Picks up a token another process saved while we waited
+            self._stat = None
+            token_info = self.get_cached_token()
+            if not token_info or 'refresh_token' not in token_info:
+                self._log_invalid(token_info)
+                return None
+            due_in = self.refresh_due_in()
+            if not force and due_in is not None and due_in > 0:
+                return token_info
+            if due_in is None:
+                logger.warning(f'Token in {self.path} has no expiry time, refreshing it')
+            logger.info('Refreshing the Spotify token')
+            return self.oauth.refresh_access_token(token_info['refresh_token'])
+
+    def access_token(self) -> str:
+        """A valid access token, refreshed first if it is due; None if there is none."""
+        token_info = self.get_cached_token()
+        if not token_info or 'access_token' not in token_info:
+            self._log_invalid(token_info)
+            return None
+        # A token without an expiry time is treated as due
+        due_in = self.refresh_due_in()
+        if (due_in is None or due_in == 0) and time.monotonic() >= self._retry_at:
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keeps using the old token while it is still valid
+                remaining = self.expires_in()
+                if remaining is None or remaining <= 0:
+                    raise
+                self._retry_at = time.monotonic() + 30
+                logger.warning(f'Token refresh failed, retrying in 30s: {e}')
+        token_info = self.get_cached_token()
+        if not token_info or 'access_token' not in token_info:
+            self._log_invalid(token_info)
+            return None
+        return token_info['access_token']
+
+    def _log_invalid(self, token_info: dict):
+        if token_info is None:
+            logger.error(f'Token file {self.path} is missing or unreadable, run generateToken.py once to authorize')
+        else:
+            logger.error(f'Token file {self.path} has no usable token, run generateToken.py once to authorize')
@@ -0,0 +1,190 @@
+"""
+Renders frames into the frame cache ahead of time, so the first play of a
+track after a new install or a cache wipe shows up without the fetch and
+render delay.
+
+The frames are rendered by render_frame(), the same pipeline the service
+uses, for every configured panel, in worker processes on all cores. Local
+images are rendered as the service renders idle images (no text, no small
+cover) and need no network access at all.
+
+Usage:
+    python warmCache.py spotify:playlist:<id>
+    python warmCache.py --tracks <id> [<id> ...]
+    python warmCache.py --images ../config/idle_images
+Options:
+    --config FILE   eink_options.ini to read (default ../config/eink_options.ini)
+    --workers N     render processes (default: one per core)
+    --force         render frames that are already cached
+"""
+import argparse
+import configparser
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from frameCache import FrameCache, file_cover_id
+from panelRenderer import render_frame, frame_from_payload
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class Job:
+    """One frame set to render: a cover with its text, for every panel."""
+
+    def __init__(self, cover_id: str, artist: str, title: str, show_small_cover: bool,
+                 url: str = None, path: str = None):
+        self.cover_id = cover_id
+        self.artist = artist
+        self.title = title
+        self.show_small_cover = show_small_cover
+        self.url = url
+        self.path = path
+
+
+def image_jobs(folder: str) -> list:
+    jobs = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(('.png', '.jpg', '.jpeg')):
+            path = os.path.join(folder, name)
+            jobs.append(Job(file_cover_id(path), '', '', False, path=path))
+    return jobs
+
+
+def spotify_jobs(config, playlist: str = None, track_ids: list = None) -> list:
+    import spotipy
+    import spotipy.util as util
+    from spotipiEinkDisplay import song_from_playback
+
+    token = util.prompt_for_user_token(username=config.get('DEFAULT', 'username'),
+                                       scope='playlist-read-private,playlist-read-collaborative',
+                                       cache_path=config.get('DEFAULT', 'token_file'))
+    if not token:
+        sys.exit('Error unable to get token')
+    sp = spotipy.Spotify(auth=token)
+    api_prefix = config.get('DEFAULT', 'spotify_api_prefix', fallback=None)
+    if api_prefix:
+        sp.prefix = api_prefix
+
+    items = []
+    if playlist:
+        page = sp.playlist_items(playlist, additional_types=('track', 'episode'))
+        while page:
+            items += [entry['item'] if 'item' in entry else entry['track'] for entry in page['items']]
+            page = sp.next(page) if page.get('next') else None
+    else:
+        for i in range(0, len(track_ids), 50):
+            items += sp.tracks(track_ids[i:i + 50])['tracks']
+
+    jobs = []
+    for item in items:
+        if not item:
+            continue
+        try:
+            # Same fields the service takes from the currently playing item
+            song = song_from_playback({'currently_playing_type': item.get('type', 'track'), 'item': item},
+                                      logging.getLogger('spotipy_logger'))
+        except (KeyError, IndexError, TypeError):
+            song = None
+        if not song:
+            print(f'Skipping {item.get("name", "?")}: no cover', file=sys.stderr)
+            continue
+        title, url, artist = song
+        jobs.append(Job(url, artist, title, True, url=url))
+    return jobs
+
+
+def fetch_sources(jobs: list, threads: int = 8) -> dict:
+    """Encoded cover of every job, by cover id; each distinct cover is read once."""
+    session = None
+    if any(job.url for job in jobs):
+        import requests
+        session = requests.Session()
+
+    def read(job):
+        if job.path:
+            with open(job.path, 'rb') as f:
+                return f.read()
+        resp = session.get(job.url, timeout=30)
+        resp.raise_for_status()
+        return resp.content
+
+    unique = {job.cover_id: job for job in jobs}
+    sources = {}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = {pool.submit(read, job): cover_id for cover_id, job in unique.items()}
+        for future in as_completed(futures):
+            try:
+                sources[futures[future]] = future.result()
+            except Exception as e:
+                print(f'Could not read cover {futures[future]}: {e}', file=sys.stderr)
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render frames into the frame cache ahead of time')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('playlist', nargs='?', help='Spotify playlist URI, URL or id')
+    source.add_argument('--tracks', nargs='+', metavar='ID', help='Spotify track ids')
+    source.add_argument('--images', metavar='DIR', help='folder of local images, rendered offline')
+    parser.add_argument('--config', default=os.path.join(BASE_DIR, 'config', 'eink_options.ini'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+
+    config_file = os.path.abspath(args.config)
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    sections = [name for name in config.sections() if name.startswith('panel:')] or ['DEFAULT']
+    cache = FrameCache(config.get('DEFAULT', 'frame_cache_dir',
+                                  fallback=os.path.join(BASE_DIR, 'config', 'frame_cache')),
+                       config.getint('DEFAULT', 'frame_cache_mb', fallback=0) * 2 ** 20)
+    if not cache.enabled:
+        sys.exit('The frame cache is disabled, set frame_cache_mb (for example 64) in the [DEFAULT] section first')
+
+    start = time.perf_counter()
+    if args.images:
+        jobs = image_jobs(args.images)
+    else:
+        jobs = spotify_jobs(config, args.playlist, args.tracks)
+
+    tasks = []
+    for job in jobs:
+        for section in sections:
+            key = cache.key(config[section], job.cover_id, job.artist, job.title, job.show_small_cover)
+            if args.force or key not in cache:
+                tasks.append((job, section, key))
+    skipped = len(jobs) * len(sections) - len(tasks)
+    sources = fetch_sources([job for job, _, _ in tasks])
+    fetched = time.perf_counter()
+
+    rendered = failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {}
+        for job, section, key in tasks:
+            if job.cover_id not in sources:
+                failed += 1
+                continue
+            # No fallback image: a cover that cannot be decoded must not be cached under its id
+            futures[pool.submit(render_frame, config_file, section, sources[job.cover_id], job.artist,
+                                job.title, job.show_small_cover, None)] = key
+        for future in as_completed(futures):
+            try:
+                cache.put(futures[future], frame_from_payload(future.result()))
+                rendered += 1
+            except Exception as e:
+                print(f'Render failed: {e}', file=sys.stderr)
+                failed += 1
+    elapsed = time.perf_counter() - fetched
+
+    print(f'{len(jobs)} covers x {len(sections)} panels: {rendered} rendered, {skipped} already cached, '
+          f'{failed} failed')
+    print(f'fetch {fetched - start:.1f}s, render {elapsed:.1f}s with {args.workers} workers, '
+          f'{rendered / elapsed if elapsed > 0 else 0:.1f} frames/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -167,6 +167,7 @@ options=(
     "Waveshare 4.01inch ACeP 4 (640x400)"
     "Pimoroni Inky Impression 5.7 (600x448)"
     "Pimoroni Inky Impression 7.3 (800x480)"
+    "Waveshare 7.3inch ACeP 7.3 (800x480)"
 )
 select opt in "${options[@]}"
 do
@@ -205,6 +206,16 @@ do
             BUTTONS=1
             break
             ;;
+        "Waveshare 7.3inch ACeP 7.3 (800x480)")
+            echo "width = 800" >> "$EINK_CONFIG_FILE"
+            echo "height = 480" >> "$EINK_CONFIG_FILE"
+            echo "album_cover_small_px = 300" >> "$EINK_CONFIG_FILE"
+            echo "model = waveshare7" >> "$EINK_CONFIG_FILE"
+            echo "Applying Waveshare GPIO patch to epdconfig.py..."
+            cp "${install_path}/setup/waveshare_fixes/epdconfig.py" "${install_path}/python/lib/epdconfig.py"
+            BUTTONS=0
+            break
+            ;;
         *)
             echo "invalid option $REPLY"
             ;;
@@ -34,12 +34,56 @@ import os
 import logging
 import sys
 import time
+from collections import deque
 import subprocess
 
 from ctypes import *
 
 logger = logging.getLogger(__name__)
 
+# SPI clock, can be changed with set_spi_speed_hz() before module_init()
+DEFAULT_SPI_SPEED_HZ = int(os.environ.get('EPD_SPI_SPEED_HZ', 4000000))
+
+
+def spidev_bufsiz():
+    # Largest single transfer the spidev kernel driver accepts
+    try:
+        with open('/sys/module/spidev/parameters/bufsiz') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 4096
+
+
+def spi_chunks(data, chunk_size):
+    # Yields zero-copy slices of bytes/bytearray/memoryview buffers
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def poll_for_level(read, pin, level, timeout_ms, interval_ms=10):
+    # Fallback busy wait for GPIO libraries without edge detection
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    while read(pin) != level:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval_ms / 1000.0)
+    return True
+
+
+def edge_wait_for_level(gpio, pin, level, timeout_ms, slice_ms=500):
+    # Sleeps in wait_for_edge() until 'pin' reads 'level'. The wait is cut in
+    # slices so an edge that lands between the read and the wait costs at
+    # most one slice instead of the whole timeout.
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    edge = gpio.RISING if level else gpio.FALLING
+    while gpio.input(pin) != level:
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if remaining_ms <= 0:
+            return False
+        gpio.wait_for_edge(pin, edge, timeout=max(1, min(slice_ms, remaining_ms)))
+    return True
+
 
 class RaspberryPi:
     # Pin definition
@@ -56,6 +100,8 @@ class RaspberryPi:
         import gpiozero
         
         self.SPI = spidev.SpiDev()
+        self.spi_speed_hz = DEFAULT_SPI_SPEED_HZ
+        self.chunk_size = spidev_bufsiz()
         self.GPIO_RST_PIN    = gpiozero.LED(self.RST_PIN)
         self.GPIO_DC_PIN     = gpiozero.LED(self.DC_PIN)
         # self.GPIO_CS_PIN     = gpiozero.LED(self.CS_PIN)
@@ -101,11 +147,26 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_level(self, pin, level, timeout_ms):
+        # gpiozero waits on the pin's edge events, no polling
+        if pin == self.BUSY_PIN:
+            if level:
+                return self.GPIO_BUSY_PIN.wait_for_press(timeout=timeout_ms / 1000.0)
+            return self.GPIO_BUSY_PIN.wait_for_release(timeout=timeout_ms / 1000.0)
+        return poll_for_level(self.digital_read, pin, level, timeout_ms)
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        self.SPI.writebytes2(data)
+        if isinstance(data, list):
+            self.SPI.writebytes2(data)
+            return
+        for chunk in spi_chunks(data, self.chunk_size):
+            self.SPI.writebytes2(chunk)
+
+    def set_spi_speed_hz(self, speed_hz):
+        self.spi_speed_hz = int(speed_hz)
 
     def DEV_SPI_write(self, data):
         self.DEV_SPI.DEV_SPI_SendData(data)
@@ -144,7 +205,7 @@ class RaspberryPi:
         else:
             # SPI device, bus = 0, device = 0
             self.SPI.open(0, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = self.spi_speed_hz
             self.SPI.mode = 0b00
         return 0
 
@@ -191,9 +252,12 @@ class JetsonNano:
                 break
         if self.SPI is None:
             raise RuntimeError('Cannot find sysfs_software_spi.so')
+        self.SPI.SYSFS_software_spi_transfer.argtypes = [ctypes.c_uint8]
+        self.SPI.SYSFS_software_spi_transfer.restype = None
 
         import Jetson.GPIO
         self.GPIO = Jetson.GPIO
+        self._edge_wait = hasattr(self.GPIO, 'wait_for_edge')
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -204,12 +268,29 @@ class JetsonNano:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_level(self, pin, level, timeout_ms):
+        # Returns False if 'pin' did not reach 'level' within 'timeout_ms'
+        if self._edge_wait:
+            try:
+                return edge_wait_for_level(self.GPIO, pin, level, timeout_ms)
+            except RuntimeError as e:
+                logger.warning(f"Edge detection unavailable ({e}), polling busy pin")
+                self._edge_wait = False
+        return poll_for_level(self.digital_read, pin, level, timeout_ms)
+
     def spi_writebyte(self, data):
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
     def spi_writebyte2(self, data):
-        for i in range(len(data)):
-            self.SPI.SYSFS_software_spi_transfer(data[i])
+        # The software SPI library only clocks one byte per call, so keep the
+        # Python side of the loop as small as possible
+        transfer = self.SPI.SYSFS_software_spi_transfer
+        for byte in (data if isinstance(data, list) else memoryview(data).cast('B')):
+            transfer(byte)
+
+    def set_spi_speed_hz(self, speed_hz):
+        # Software SPI, the clock is set by the sysfs library
+        pass
 
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
@@ -252,6 +333,9 @@ class SunriseX3:
 
         self.GPIO = Hobot.GPIO
         self.SPI = spidev.SpiDev()
+        self._edge_wait = hasattr(self.GPIO, 'wait_for_edge')
+        self.spi_speed_hz = DEFAULT_SPI_SPEED_HZ
+        self.chunk_size = spidev_bufsiz()
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -262,13 +346,28 @@ class SunriseX3:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_level(self, pin, level, timeout_ms):
+        # Returns False if 'pin' did not reach 'level' within 'timeout_ms'
+        if self._edge_wait:
+            try:
+                return edge_wait_for_level(self.GPIO, pin, level, timeout_ms)
+            except RuntimeError as e:
+                logger.warning(f"Edge detection unavailable ({e}), polling busy pin")
+                self._edge_wait = False
+        return poll_for_level(self.digital_read, pin, level, timeout_ms)
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        # for i in range(len(data)):
-        #     self.SPI.writebytes([data[i]])
-        self.SPI.xfer3(data)
+        if isinstance(data, list):
+            self.SPI.xfer3(data)
+            return
+        for chunk in spi_chunks(data, self.chunk_size):
+            self.SPI.writebytes2(chunk)
+
+    def set_spi_speed_hz(self, speed_hz):
+        self.spi_speed_hz = int(speed_hz)
 
     def module_init(self):
         if self.Flag == 0:
@@ -285,7 +384,7 @@ class SunriseX3:
         
             # SPI device, bus = 0, device = 0
             self.SPI.open(2, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = self.spi_speed_hz
             self.SPI.mode = 0b00
             return 0
         else:
@@ -312,14 +411,128 @@ output, _ = process.communicate()
 if sys.version_info[0] == 2:
     output = output.decode(sys.stdout.encoding)
 
-if "Raspberry" in output:
+class Fake:
+    # Recording stand-in for the hardware (EPD_PLATFORM=fake), for checking
+    # drivers without a panel. Every GPIO write, SPI command, SPI data
+    # transfer, delay and busy wait is appended to 'events' as
+    # (seconds, kind, value) on a simulated clock: delays, busy waits and
+    # SPI transfers at spi_speed_hz advance it, nothing actually sleeps.
+    #   gpio       (pin, level)
+    #   command    command byte, sent with DC low
+    #   data       bytes of one SPI transfer with DC high
+    #   data_list  a transfer handed over as a list, converted per element
+    #   delay      milliseconds
+    #   busy       (level waited for, seconds, released)
+    # The busy pin releases after 'busy_ms' (EPD_FAKE_BUSY_MS, default 0),
+    # or never with 'busy_stuck' (EPD_FAKE_BUSY_STUCK=1). Every event is
+    # kept unless EPD_FAKE_EVENTS caps the recording, then only the last
+    # EPD_FAKE_EVENTS are and 'dropped' counts the ones discarded. The
+    # recording and all state are read through epdconfig.implementation.
+    RST_PIN = 17
+    DC_PIN = 25
+    CS_PIN = 8
+    BUSY_PIN = 24
+    PWR_PIN = 18
+
+    def __init__(self):
+        self.spi_speed_hz = DEFAULT_SPI_SPEED_HZ
+        self.chunk_size = spidev_bufsiz()
+        self.busy_ms = float(os.environ.get('EPD_FAKE_BUSY_MS', 0))
+        self.busy_stuck = os.environ.get('EPD_FAKE_BUSY_STUCK', '') == '1'
+        self.levels = {}
+        max_events = int(os.environ.get('EPD_FAKE_EVENTS', 0))
+        self.events = deque(maxlen=max_events) if max_events > 0 else []
+        self.dropped = 0
+        self.clock = 0.0
+
+    def _record(self, kind, value):
+        if isinstance(self.events, deque) and len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append((self.clock, kind, value))
+
+    def _transfer(self, data, kind):
+        data = bytes(data)
+        if self.levels.get(self.DC_PIN):
+            self._record(kind, data)
+        else:
+            for command in data:
+                self._record('command', command)
+        self.clock += len(data) * 8 / self.spi_speed_hz
+
+    def digital_write(self, pin, value):
+        self.levels[pin] = value
+        self._record('gpio', (pin, value))
+
+    def digital_read(self, pin):
+        return self.levels.get(pin, 0)
+
+    def delay_ms(self, delaytime):
+        self._record('delay', delaytime)
+        self.clock += delaytime / 1000.0
+
+    def wait_for_level(self, pin, level, timeout_ms):
+        waited = timeout_ms / 1000.0 if self.busy_stuck else min(self.busy_ms, timeout_ms) / 1000.0
+        self.clock += waited
+        if not self.busy_stuck:
+            self.levels[pin] = level
+        self._record('busy', (level, waited, not self.busy_stuck))
+        return not self.busy_stuck
+
+    def spi_writebyte(self, data):
+        self._transfer(data, 'data')
+
+    def spi_writebyte2(self, data):
+        if isinstance(data, list):
+            self._transfer(data, 'data_list')
+            return
+        for chunk in spi_chunks(data, self.chunk_size):
+            self._transfer(chunk, 'data')
+
+    def set_spi_speed_hz(self, speed_hz):
+        self.spi_speed_hz = int(speed_hz)
+
+    def module_init(self):
+        self.digital_write(self.PWR_PIN, 1)
+        return 0
+
+    def module_exit(self):
+        self.digital_write(self.RST_PIN, 0)
+        self.digital_write(self.DC_PIN, 0)
+        self.digital_write(self.PWR_PIN, 0)
+
+    def clear_events(self):
+        self.events.clear()
+        self.dropped = 0
+        self.clock = 0.0
+
+    def commands(self):
+        # [(command, data bytes sent after it, number of data transfers)] from 'events'
+        sequence = []
+        for _, kind, value in self.events:
+            if kind == 'command':
+                sequence.append([value, bytearray(), 0])
+            elif kind in ('data', 'data_list') and sequence:
+                sequence[-1][1] += value
+                sequence[-1][2] += 1
+        return [(command, bytes(data), transfers) for command, data, transfers in sequence]
+
+
+# EPD_PLATFORM=raspberrypi|sunrisex3|jetsonnano|fake skips the detection below
+PLATFORMS = {'raspberrypi': RaspberryPi, 'sunrisex3': SunriseX3, 'jetsonnano': JetsonNano, 'fake': Fake}
+
+if os.environ.get('EPD_PLATFORM'):
+    implementation = PLATFORMS[os.environ['EPD_PLATFORM'].lower()]()
+elif "Raspberry" in output:
     implementation = RaspberryPi()
 elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
     implementation = SunriseX3()
 else:
     implementation = JetsonNano()
 
+# Functions and pin numbers only: state such as spi_speed_hz stays on
+# 'implementation', a module-level copy would go stale
 for func in [x for x in dir(implementation) if not x.startswith('_')]:
-    setattr(sys.modules[__name__], func, getattr(implementation, func))
+    if func.endswith('_PIN') or callable(getattr(implementation, func)):
+        setattr(sys.modules[__name__], func, getattr(implementation, func))
 
 ### END OF FILE ###